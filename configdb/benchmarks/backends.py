@@ -0,0 +1,128 @@
+"""Database backends to run the benchmarks against.
+
+Every backend is created by a function taking the schema, a scratch
+directory and the command-line options, and returning a (db,
+cleanup_fn) tuple. The etcd, ZooKeeper and Doozer backends need a
+local server, whose address is set on the command line; they are
+reported as unavailable if the server (or the client library) can't
+be found.
+"""
+
+import os
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+def _close(db):
+    db.close()
+
+
+def _inmemory(schema_obj, tmpdir, opts):
+    from configdb.db.interface import inmemory_interface
+    return inmemory_interface.InMemoryDbInterface(schema_obj), _close
+
+
+def _leveldb(schema_obj, tmpdir, opts):
+    try:
+        from configdb.db.interface import leveldb_interface
+    except ImportError, e:
+        raise BackendUnavailable(str(e))
+    return (leveldb_interface.LevelDbInterface(
+            os.path.join(tmpdir, 'leveldb'), schema_obj), _close)
+
+
+def _sqlalchemy(schema_obj, tmpdir, opts):
+    from configdb.db.interface import sa_interface
+    return (sa_interface.SqlAlchemyDbInterface(
+            'sqlite:///%s' % os.path.join(tmpdir, 'configdb.sqlite'),
+            schema_obj), _close)
+
+
+def _root():
+    return '/configdb-bench-%d' % os.getpid()
+
+
+def _etcd(schema_obj, tmpdir, opts):
+    try:
+        from configdb.db.interface import etcd_interface
+        db = etcd_interface.EtcdInterface(
+            opts.etcd_url, schema_obj, _root(), timeout=opts.timeout)
+        db.conn.write(_root() + '/_bench', 'x')
+    except Exception, e:
+        raise BackendUnavailable(str(e))
+
+    def _cleanup(db):
+        db.conn.delete(db.root, recursive=True)
+        db.close()
+    return db, _cleanup
+
+
+def _zookeeper(schema_obj, tmpdir, opts):
+    try:
+        from configdb.db.interface import zookeeper_interface
+        db = zookeeper_interface.ZookeeperInterface(
+            opts.zk_hosts, schema_obj, _root(), timeout=opts.timeout)
+    except Exception, e:
+        raise BackendUnavailable(str(e))
+
+    def _cleanup(db):
+        db.conn.delete(db.root, recursive=True)
+        db.close()
+    return db, _cleanup
+
+
+def _doozer_delete_all(conn, path):
+    from doozer.client import IsDirectory
+    for entry in conn.getdir(path):
+        fullp = os.path.join(path, entry.path)
+        try:
+            item = conn.get(fullp)
+            conn.delete(fullp, item.rev)
+        except IsDirectory:
+            _doozer_delete_all(conn, fullp)
+
+
+def _doozer(schema_obj, tmpdir, opts):
+    try:
+        from configdb.db.interface import doozer_interface
+        db = doozer_interface.DoozerInterface(
+            opts.doozer_uri, schema_obj, _root(), timeout=opts.timeout)
+    except Exception, e:
+        raise BackendUnavailable(str(e))
+
+    def _cleanup(db):
+        _doozer_delete_all(db.conn, db.root)
+        db.close()
+    return db, _cleanup
+
+
+BACKENDS = {
+    'inmemory': _inmemory,
+    'leveldb': _leveldb,
+    'sqlalchemy': _sqlalchemy,
+    'etcd': _etcd,
+    'zookeeper': _zookeeper,
+    'doozer': _doozer,
+    }
+
+# Backends that run without any external service.
+LOCAL_BACKENDS = ('inmemory', 'leveldb', 'sqlalchemy')
+
+# Backends supported by the HTTP API server, with the configuration
+# they need.
+HTTP_BACKENDS = {
+    'sqlalchemy': lambda tmpdir: {
+        'DB_DRIVER': 'sqlalchemy',
+        'DB_URI': 'sqlite:///%s' % os.path.join(tmpdir, 'http.sqlite')},
+    'leveldb': lambda tmpdir: {
+        'DB_DRIVER': 'leveldb',
+        'DB_URI': os.path.join(tmpdir, 'http-leveldb')},
+    }
+
+
+def create_backend(name, schema_obj, tmpdir, opts):
+    if name not in BACKENDS:
+        raise BackendUnavailable('unknown backend "%s"' % name)
+    return BACKENDS[name](schema_obj, tmpdir, opts)
@@ -0,0 +1,102 @@
+import random
+from datetime import datetime, timedelta
+
+
+class Dataset(object):
+    """Synthetic data for the 'schema-large-noacl.json' schema.
+
+    The size of the dataset is controlled by 'scale', the number of
+    hosts. There are a tenth as many users, a hundredth as many
+    groups, and enough roles to satisfy the relation 'fanout', which
+    is the maximum number of objects on the other side of a relation
+    (each host has a random number of roles and login users, each
+    group a random number of users, up to 'fanout').
+
+    The data is generated lazily, in the network format accepted by
+    AdmDbApi.create(), and is deterministic for a given 'seed'.
+    """
+
+    def __init__(self, scale=1000, fanout=10, seed=1):
+        self.scale = scale
+        self.fanout = fanout
+        self.seed = seed
+        self.num_hosts = scale
+        self.num_users = max(scale // 10, fanout, 1)
+        self.num_groups = max(scale // 100, 1)
+        self.num_roles = max(fanout * 2, 10)
+
+    def __len__(self):
+        return (self.num_hosts + self.num_users + self.num_groups
+                + self.num_roles)
+
+    def host_name(self, i):
+        return u'host%07d' % i
+
+    def user_name(self, i):
+        return u'user%07d' % i
+
+    def group_name(self, i):
+        return u'group%05d' % i
+
+    def role_name(self, i):
+        return u'role%04d' % i
+
+    def _sample(self, rng, name_fn, count):
+        n = rng.randint(0, min(self.fanout, count))
+        return [name_fn(i) for i in sorted(rng.sample(xrange(count), n))]
+
+    def _stamp(self, rng):
+        return (datetime(2013, 1, 1)
+                + timedelta(seconds=rng.randint(0, 86400 * 365))).isoformat().decode('ascii')
+
+    def random_roles(self, rng):
+        """Return a random list of role names for a host."""
+        return self._sample(rng, self.role_name, self.num_roles)
+
+    def roles(self):
+        for i in xrange(self.num_roles):
+            yield {'name': self.role_name(i)}
+
+    def users(self):
+        rng = random.Random(self.seed)
+        for i in xrange(self.num_users):
+            name = self.user_name(i)
+            yield {'name': name,
+                   'uid': 10000 + i,
+                   'password': u'x' * 13,
+                   'email': u'%s@example.com' % name,
+                   'home': u'/home/%s' % name,
+                   'created_at': self._stamp(rng)}
+
+    def groups(self):
+        rng = random.Random(self.seed + 1)
+        for i in xrange(self.num_groups):
+            yield {'name': self.group_name(i),
+                   'gid': 1000 + i,
+                   'users': self._sample(rng, self.user_name,
+                                         self.num_users)}
+
+    def hosts(self):
+        rng = random.Random(self.seed + 2)
+        for i in xrange(self.num_hosts):
+            yield {'name': self.host_name(i),
+                   'ip': u'10.%d.%d.%d' % ((i >> 16) & 255, (i >> 8) & 255,
+                                          i & 255),
+                   'public_id': i,
+                   'location': u'rack%03d' % rng.randint(0, 999),
+                   'created_at': self._stamp(rng),
+                   'roles': self.random_roles(rng),
+                   'login_users': self._sample(rng, self.user_name,
+                                               self.num_users)}
+
+    def objects(self):
+        """Iterate over (entity_name, data) pairs, in creation order.
+
+        Objects are created after all the objects they refer to.
+        """
+        for entity_name, gen in (('role', self.roles),
+                                 ('user', self.users),
+                                 ('group', self.groups),
+                                 ('host', self.hosts)):
+            for data in gen():
+                yield entity_name, data
@@ -0,0 +1,158 @@
+"""Run the configdb benchmarks.
+
+Benchmarks every selected backend, both directly through AdmDbApi
+and (for the 'http-*' backends) through the HTTP API, on a synthetic
+dataset. The results are printed, and optionally saved as JSON. If a
+baseline report is given, the run fails when any operation is slower
+than in the baseline by more than the given threshold.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from configdb.benchmarks import backends
+from configdb.benchmarks import dataset
+from configdb.benchmarks import report
+from configdb.benchmarks import suite
+from configdb.db import schema
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SCHEMA_FILE = os.path.join(
+    os.path.dirname(__file__), 'schema-large-noacl.json')
+
+# The 'micro' pseudo-backend runs the backend-independent benchmarks.
+DEFAULT_BACKENDS = ['micro'] + list(backends.LOCAL_BACKENDS) + [
+    'http-%s' % x for x in sorted(backends.HTTP_BACKENDS)]
+
+
+def _make_driver(name, schema_file, schema_obj, tmpdir, opts):
+    """Return a (driver, cleanup_fn) tuple for the named backend."""
+    if name.startswith('http-'):
+        backend_name = name[5:]
+        if backend_name not in backends.HTTP_BACKENDS:
+            raise backends.BackendUnavailable(
+                'unknown HTTP backend "%s"' % backend_name)
+        from configdb.server import wsgiapp
+        config = {'SCHEMA_FILE': schema_file,
+                  'SECRET_KEY': 'benchmark',
+                  'AUTH_BYPASS': True}
+        config.update(backends.HTTP_BACKENDS[backend_name](tmpdir))
+        try:
+            app = wsgiapp.make_app(config)
+        except ImportError, e:
+            raise backends.BackendUnavailable(str(e))
+        return suite.HttpDriver(app), lambda: app.api.db.close()
+
+    db, cleanup_fn = backends.create_backend(name, schema_obj, tmpdir, opts)
+    return suite.ApiDriver(schema_obj, db), lambda: cleanup_fn(db)
+
+
+def run(opts):
+    """Run the benchmarks, return a report."""
+    with open(opts.schema_file) as fd:
+        schema_obj = schema.Schema(fd.read())
+    data = dataset.Dataset(opts.scale, opts.fanout, opts.seed)
+    results = {}
+    for name in opts.backends:
+        if name == 'micro':
+            log.info('running micro-benchmarks')
+            results[name] = suite.run_micro(opts.samples)
+            continue
+        tmpdir = tempfile.mkdtemp()
+        try:
+            try:
+                driver, cleanup_fn = _make_driver(
+                    name, opts.schema_file, schema_obj, tmpdir, opts)
+            except backends.BackendUnavailable, e:
+                log.warning('skipping backend %s: %s', name, e)
+                continue
+            try:
+                log.info('running benchmarks for %s (%d objects)',
+                         name, len(data))
+                results[name] = suite.run_suite(
+                    driver, data, opts.samples, opts.seed)
+            finally:
+                cleanup_fn()
+        finally:
+            shutil.rmtree(tmpdir)
+    return report.make_report(results, {'scale': opts.scale,
+                                        'fanout': opts.fanout,
+                                        'samples': opts.samples,
+                                        'seed': opts.seed})
+
+
+def _print_report(rep, out=sys.stdout):
+    out.write('%-20s %-15s %8s %12s\n' % ('backend', 'operation', 'ops',
+                                          'ms/op'))
+    for backend, ops in sorted(rep['results'].iteritems()):
+        for op, result in sorted(ops.iteritems()):
+            out.write('%-20s %-15s %8d %12.3f\n' % (
+                    backend, op, result['ops'],
+                    result['seconds_per_op'] * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--schema-file', default=DEFAULT_SCHEMA_FILE,
+                        help='Schema to use (default: the benchmark schema '
+                        'schema-large-noacl.json)')
+    parser.add_argument('--backends', default=','.join(DEFAULT_BACKENDS),
+                        help='Comma-separated list of backends, among: %s '
+                        '(default: %%(default)s)' % ', '.join(
+                            ['micro'] + sorted(backends.BACKENDS)
+                            + ['http-%s' % x for x in
+                               sorted(backends.HTTP_BACKENDS)]))
+    parser.add_argument('--scale', type=int, default=1000,
+                        help='Number of hosts in the dataset (default 1000)')
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='Maximum number of objects in a relation '
+                        '(default 10)')
+    parser.add_argument('--samples', type=int, default=100,
+                        help='Number of times each operation is run '
+                        '(default 100)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output',
+                        help='Save the results as JSON to this file')
+    parser.add_argument('--baseline',
+                        help='Compare the results against this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Maximum slowdown with respect to the baseline, '
+                        'as a fraction (default 0.25)')
+    parser.add_argument('--etcd-url', default='http://127.0.0.1:4001')
+    parser.add_argument('--zk-hosts', default='127.0.0.1:2181')
+    parser.add_argument('--doozer-uri', default=None)
+    parser.add_argument('--timeout', type=int, default=5,
+                        help='Connection timeout for the etcd, ZooKeeper '
+                        'and Doozer backends (default 5)')
+    opts = parser.parse_args(argv)
+    opts.backends = [x for x in opts.backends.split(',') if x]
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s: %(message)s')
+
+    rep = run(opts)
+    _print_report(rep)
+    if opts.output:
+        report.save_report(rep, opts.output)
+
+    if opts.baseline:
+        baseline = report.load_report(opts.baseline)
+        if baseline['params'] != rep['params']:
+            log.error('the baseline was run with different parameters: %s',
+                      baseline['params'])
+            return 2
+        regressions = report.compare(rep, baseline, opts.threshold)
+        for backend, op, base_time, cur_time in regressions:
+            log.error('regression: %s %s: %.3f ms/op (baseline %.3f ms/op)',
+                      backend, op, cur_time * 1000, base_time * 1000)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
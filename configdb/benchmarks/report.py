@@ -0,0 +1,50 @@
+import json
+import platform
+import time
+
+
+def make_report(results, params):
+    """Build the JSON-serializable report of a benchmark run.
+
+    'results' is a dictionary of run_suite() results by backend name,
+    'params' the parameters of the run (scale, fanout, ...).
+    """
+    return {'version': 1,
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'params': params,
+            'results': results}
+
+
+def save_report(report, path):
+    with open(path, 'w') as fd:
+        json.dump(report, fd, indent=2, sort_keys=True)
+
+
+def load_report(path):
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def compare(report, baseline, threshold=0.25):
+    """Compare a report against a baseline.
+
+    Returns a list of (backend, op, baseline_time, time) tuples for
+    the operations whose time per operation increased by more than
+    'threshold' (a fraction of the baseline value). Operations that
+    are missing from either report are ignored, as are runs with
+    different parameters.
+    """
+    if report['params'] != baseline['params']:
+        return []
+    regressions = []
+    for backend, ops in sorted(report['results'].iteritems()):
+        base_ops = baseline['results'].get(backend, {})
+        for op, result in sorted(ops.iteritems()):
+            if op not in base_ops:
+                continue
+            base_time = base_ops[op]['seconds_per_op']
+            cur_time = result['seconds_per_op']
+            if cur_time > base_time * (1 + threshold):
+                regressions.append((backend, op, base_time, cur_time))
+    return regressions
@@ -0,0 +1,199 @@
+import json
+import random
+import time
+from datetime import datetime
+from configdb import exceptions
+from configdb.db import acl
+from configdb.db import db_api
+from configdb.db import schema
+
+
+class ApiDriver(object):
+    """Run operations through AdmDbApi."""
+
+    def __init__(self, schema_obj, db):
+        self.api = db_api.AdmDbApi(schema_obj, db)
+        self.ctx = acl.AuthContext('bench')
+
+    def create(self, entity_name, data):
+        return self.api.create(entity_name, data, self.ctx)
+
+    def get(self, entity_name, object_name):
+        return self.api.get(entity_name, object_name, self.ctx)
+
+    def find(self, entity_name, query):
+        return list(self.api.find(entity_name, query, self.ctx))
+
+    def update(self, entity_name, object_name, data):
+        return self.api.update(entity_name, object_name, data, self.ctx)
+
+    def delete(self, entity_name, object_name):
+        return self.api.delete(entity_name, object_name, self.ctx)
+
+
+class HttpDriver(object):
+    """Run operations through the HTTP API of a WSGI application.
+
+    Requests are made in-process with the Flask test client, so the
+    results include the request handling and JSON serialization, but
+    no network overhead. The application should be configured with
+    AUTH_BYPASS.
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def _check(self, rv):
+        if rv.status_code != 200:
+            raise exceptions.Error('HTTP status %d' % rv.status_code)
+        data = json.loads(rv.data)
+        if not data['ok']:
+            raise exceptions.Error(data['error'])
+        return data['result']
+
+    def _post(self, path, data):
+        return self._check(self.client.post(
+                path, data=json.dumps(data), content_type='application/json'))
+
+    def create(self, entity_name, data):
+        return self._post('/create/%s' % entity_name, data)
+
+    def get(self, entity_name, object_name):
+        return self._check(self.client.get(
+                '/get/%s/%s' % (entity_name, object_name)))
+
+    def find(self, entity_name, query):
+        return self._post('/find/%s' % entity_name, query)
+
+    def update(self, entity_name, object_name, data):
+        return self._post('/update/%s/%s' % (entity_name, object_name), data)
+
+    def delete(self, entity_name, object_name):
+        return self._check(self.client.get(
+                '/delete/%s/%s' % (entity_name, object_name)))
+
+
+def _timed(results, op, args_iter, fn):
+    n = 0
+    start = time.time()
+    for args in args_iter:
+        fn(*args)
+        n += 1
+    elapsed = time.time() - start
+    results[op] = {'ops': n,
+                   'seconds': elapsed,
+                   'seconds_per_op': elapsed / n if n else 0}
+
+
+def run_suite(driver, dataset, samples=100, seed=1):
+    """Run all the benchmarks with the given driver.
+
+    The dataset is loaded first (which is the 'create' benchmark),
+    then every other operation is run 'samples' times on random
+    hosts (a tenth as many times for full table scans). Returns a
+    dictionary of results by operation name.
+    """
+    rng = random.Random(seed)
+    results = {}
+
+    _timed(results, 'create', dataset.objects(), driver.create)
+
+    def _hosts(n):
+        return [dataset.host_name(i) for i in
+                rng.sample(xrange(dataset.num_hosts),
+                           min(n, dataset.num_hosts))]
+
+    _timed(results, 'get', [('host', x) for x in _hosts(samples)],
+           driver.get)
+    _timed(results, 'find_indexed',
+           [('host', {'name': {'type': 'eq', 'value': x}})
+            for x in _hosts(samples)],
+           driver.find)
+    _timed(results, 'find_scan',
+           [('host', {'location': {'type': 'eq',
+                                   'value': u'rack%03d' % rng.randint(0, 999)}})
+            for i in xrange(max(samples // 10, 1))],
+           driver.find)
+    _timed(results, 'update',
+           [('host', x, {'location': u'rack%03d' % rng.randint(0, 999)})
+            for x in _hosts(samples)],
+           driver.update)
+    _timed(results, 'relation_diff',
+           [('host', x, {'roles': dataset.random_roles(rng)})
+            for x in _hosts(samples)],
+           driver.update)
+    _timed(results, 'delete', [('host', x) for x in _hosts(samples)],
+           driver.delete)
+    return results
+
+
+def _wide_schema(width):
+    """Schema with a 'wide' entity of about 'width' fields."""
+    fields = {'name': {'type': 'string'},
+              'peers': {'type': 'relation', 'rel': 'wide'}}
+    for i in xrange(width):
+        ftype = ('string', 'int', 'number', 'bool')[i % 4]
+        fields['f%03d' % i] = {'type': ftype}
+    fields['f000']['validator'] = 'email'
+    dated = {'name': {'type': 'string'}}
+    for i in xrange(4):
+        dated['d%d' % i] = {'type': 'datetime'}
+    return schema.Schema(json.dumps({'wide': fields, 'dated': dated}))
+
+
+def _wide_data(width, i):
+    data = {'name': u'wide%07d' % i, 'peers': [u'wide0000000']}
+    for j in xrange(width):
+        data['f%03d' % j] = (u'value%d' % i, i, i * 0.5, True)[j % 4]
+    data['f000'] = u'user%d@example.com' % i
+    return data
+
+
+class _WideObject(object):
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+
+def run_micro(samples=100, width=100):
+    """Benchmark CPU-bound operations that don't involve a backend.
+
+    Measures the deserialization and validation of writes and of
+    find queries, and the serialization of objects (and dictionaries),
+    on an entity with 'width' fields, and the decoding of datetimes.
+    """
+    schema_obj = _wide_schema(width)
+    entity = schema_obj.get_entity('wide')
+    api = db_api.AdmDbApi(schema_obj, None)
+    results = {}
+    n = samples * 10
+    _timed(results, 'unpack_wide',
+           [(entity, _wide_data(width, i)) for i in xrange(n)],
+           api._unpack)
+    query_validation = lambda field, value: value
+    _timed(results, 'unpack_query',
+           [(entity, {'name': {'type': 'eq', 'value': u'wide%07d' % i},
+                      'f001': {'type': 'eq', 'value': 1}},
+             query_validation)
+            for i in xrange(n)],
+           api._unpack)
+
+    objs = [_WideObject(entity.from_net(_wide_data(width, i)))
+            for i in xrange(n)]
+    _timed(results, 'to_net_wide', [(x,) for x in objs], entity.to_net)
+    _timed(results, 'to_net_wide_dict', [(x.__dict__,) for x in objs],
+           entity.to_net)
+
+    # Decode find results with timestamps, where groups of objects
+    # share the same values (as when they have been created together).
+    dated = schema_obj.get_entity('dated')
+    rows = [dict([('name', u'dated%07d' % i)] +
+                 [('d%d' % j, datetime(2013, 1, 1 + j, 0, i // 600 % 60,
+                                       i // 10 % 60, j * 1000).isoformat())
+                  for j in xrange(4)])
+            for i in xrange(n)]
+    _timed(results, 'from_net_dated', [(x,) for x in rows], dated.from_net)
+    batches = [rows[i:i + 100] for i in xrange(0, n, 100)]
+    _timed(results, 'from_net_many_dated', [(x,) for x in batches],
+           dated.from_net_many)
+    return results
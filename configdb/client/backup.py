@@ -43,17 +43,40 @@ class Dumper(object):
         self.conn = conn
 
     def dump(self, fd):
-        for entity in self.conn._schema.get_dependency_sequence():
-            for obj in self.conn.find(entity, {'name': {'type': 'regexp', 'pattern': '^.*$'}}):
-                record_write(fd, entity, obj)
+        levels, unused = self.conn._schema.get_dependency_levels()
+        for level in levels:
+            for entity in level:
+                for obj in self.conn.find(entity, {'name': {'type': 'regexp', 'pattern': '^.*$'}}):
+                    record_write(fd, entity, obj)
 
     def restore(self, fd):
+        """Create the objects of a dump.
+
+        Relations that are part of a cycle between entities can't be
+        set when the objects are created, since the objects they refer
+        to might not exist yet: they are set with a second pass of
+        updates, once all the objects have been created.
+        """
+        unused, deferred = self.conn._schema.get_dependency_levels()
+        updates = []
         while True:
             try:
                 entity_name, obj = record_read(fd)
+                update = {}
+                for field_name in deferred.get(entity_name, ()):
+                    if obj.get(field_name):
+                        update[field_name] = obj.pop(field_name)
                 self.conn.create(entity_name, obj)
+                if update:
+                    updates.append((entity_name, obj['name'], update))
             except EOFError:
                 break
             except Exception, e:
                 log.error('skipped record: %s', e)
 
+        for entity_name, object_name, update in updates:
+            try:
+                self.conn.update(entity_name, object_name, update)
+            except Exception, e:
+                log.error('could not restore relations of %s %s: %s',
+                          entity_name, object_name, e)
@@ -1,19 +1,47 @@
+import collections
 import cookielib
 import getpass
-import gzip
 import json
 import logging
 import os
 import sys
 import urllib
 import urllib2
-import StringIO
+import zlib
 from configdb import exceptions
 from configdb.client import query
 
 log = logging.getLogger(__name__)
 
 
+# zlib window bits selecting the gzip format.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class GzipReader(object):
+    """Decompress a gzip-encoded stream as it is being read."""
+
+    def __init__(self, read, chunk_size=65536):
+        self._read = read
+        self._chunk_size = chunk_size
+        self._decompressor = zlib.decompressobj(GZIP_WBITS)
+        self._buf = ''
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            chunk = self._read(self._chunk_size)
+            if chunk:
+                self._buf += self._decompressor.decompress(chunk)
+            else:
+                self._buf += self._decompressor.flush()
+                self._eof = True
+        if size < 0:
+            size = len(self._buf)
+        result, self._buf = self._buf[:size], self._buf[size:]
+        return result
+
+
 class GzipProcessor(urllib2.BaseHandler):
     """HTTP handler that supports the 'gzip' content encoding."""
 
@@ -23,16 +51,80 @@ class GzipProcessor(urllib2.BaseHandler):
 
     def http_response(self, req, resp):
         if resp.headers.get('content-encoding') == 'gzip':
-            gz = gzip.GzipFile(
-                fileobj=StringIO.StringIO(resp.read()),
-                mode='r')
-            resp.read = gz.read
+            resp.read = GzipReader(resp.read).read
         return resp
 
     https_request = http_request
     https_response = http_response
 
 
+STREAM_PREFIX = '{"ok": true, "result": ['
+
+
+def iter_json_results(fd, chunk_size=65536):
+    """Incrementally decode a streamed JSON response.
+
+    Yields the elements of the 'result' list of the response as soon
+    as they have been received. If the response does not use the
+    streaming format, it is decoded all at once.
+
+    Raises:
+      exceptions.RpcError
+    """
+    decoder = json.JSONDecoder()
+    buf = fd.read(len(STREAM_PREFIX))
+    if buf != STREAM_PREFIX:
+        response_data = json.loads(buf + fd.read())
+        if not response_data.get('ok'):
+            raise exceptions.RpcError(response_data['error'])
+        for item in response_data['result']:
+            yield item
+        return
+
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        # Skip separators between list elements.
+        while pos < len(buf) and buf[pos] in ', \t\r\n':
+            pos += 1
+        if pos < len(buf):
+            if buf[pos] == ']':
+                # End of the list: the rest of the response tells us
+                # whether there were errors.
+                trailer = buf[pos + 1:] + fd.read()
+                status = json.loads('{' + trailer.lstrip().lstrip(','))
+                if status.get('ok') is False:
+                    raise exceptions.RpcError(status['error'])
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+                yield item
+                continue
+            except ValueError:
+                if eof:
+                    raise exceptions.RpcError('truncated response')
+        elif eof:
+            raise exceptions.RpcError('truncated response')
+        chunk = fd.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+class ResultPage(list):
+    """A page of the results of a paginated find().
+
+    The 'cursor' attribute holds the continuation token to pass to
+    the next find() call, or None if there are no more results.
+    """
+
+    def __init__(self, results, cursor):
+        list.__init__(self, results)
+        self.cursor = cursor
+
+
 class Connection(object):
     """Proxy for a remote configdb server.
 
@@ -48,7 +140,7 @@ class Connection(object):
     """
 
     def __init__(self, url, schema, username=None, password=None,
-                 auth_file=None):
+                 auth_file=None, cache_size=100, compress_requests=False):
         """Initialize a new Connection object.
 
         Args:
@@ -58,6 +150,10 @@ class Connection(object):
           password: string (optional), password for authentication
           auth_file: string (optional), file where we will store
             permanent authentication credentials
+          cache_size: int (optional), number of responses to keep
+            for conditional requests (0 disables the cache)
+          compress_requests: bool (optional), send gzip-compressed
+            request bodies (the server must support them)
         """
         self._schema = schema
         self._url = url.rstrip('/')
@@ -75,46 +171,99 @@ class Connection(object):
                          self._auth_file, e)
         self._username = username or getpass.getuser()
         self._password = password
+        self._compress_requests = compress_requests
+        # Responses with an ETag, indexed by (url, request data).
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
         self._opener = urllib2.build_opener(
             urllib2.HTTPCookieProcessor(self._cj) ,
             GzipProcessor())
 
-    def _request(self, path, data=None, logged_in=False):
-        """Perform a HTTP request.
+    def _make_url(self, path, params=None):
+        url = '%s/%s' % (
+            self._url,
+            '/'.join([urllib.quote(x, safe='') for x in path]))
+        if params:
+            url += '?' + urllib.urlencode(params)
+        return url
+
+    def _open(self, path, data=None, logged_in=False, params=None,
+              headers=None):
+        """Perform a HTTP request, and return the response object.
 
         POST requests contain JSON-encoded data, with a Content-Type
-        of 'application/json'.
+        of 'application/json'. If the server asks for authentication,
+        we will log in and retry the request. A '304 Not Modified'
+        response is returned like a successful one.
 
         Raises:
           exceptions.RpcError
         """
-        url = '%s/%s' % (
-            self._url,
-            '/'.join([urllib.quote(x, safe='') for x in path]))
-        if data:
+        url = self._make_url(path, params)
+        headers = dict(headers or {})
+        if data is not None:
             log.debug('POST: %s %s', url, data)
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(data)
+            if self._compress_requests:
+                compressor = zlib.compressobj(
+                    zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, GZIP_WBITS)
+                body = compressor.compress(body) + compressor.flush()
+                headers['Content-Encoding'] = 'gzip'
             request = urllib2.Request(
                 url,
-                data=json.dumps(data),
-                headers={'Content-Type': 'application/json'})
+                data=body,
+                headers=headers)
         else:
             log.debug('GET: %s', url)
-            request = urllib2.Request(url)
+            request = urllib2.Request(url, headers=headers)
         try:
-            response = self._opener.open(request)
-            response_data = json.loads(response.read())
-            if not response_data.get('ok'):
-                raise exceptions.RpcError(response_data['error'])
-            return response_data['result']
+            return self._opener.open(request)
         except urllib2.HTTPError, e:
+            if e.code == 304:
+                return e
             if e.code == 403 and not logged_in:
                 self._login()
-                return self._request(path, data, logged_in=True)
+                return self._open(path, data, logged_in=True,
+                                  params=params, headers=headers)
             raise exceptions.RpcError('HTTP status code %d' % e.code)
         except urllib2.URLError, e:
             raise exceptions.RpcError(str(e))
 
-    def _call(self, entity_name, op, arg=None, data=None):
+    def _request(self, path, data=None, params=None):
+        """Perform a HTTP request, and return the decoded result.
+
+        Successful responses carrying an ETag are cached, and the
+        cached copy is used when the server replies that it has not
+        changed.
+
+        Raises:
+          exceptions.RpcError
+        """
+        cache_key = cached = None
+        headers = {}
+        if self._cache_size:
+            cache_key = (self._make_url(path, params),
+                         json.dumps(data, sort_keys=True))
+            cached = self._cache.pop(cache_key, None)
+            if cached:
+                headers['If-None-Match'] = cached[0]
+        response = self._open(path, data, params=params, headers=headers)
+        if cached and getattr(response, 'code', None) == 304:
+            etag, body = cached
+        else:
+            body = response.read()
+            etag = cache_key and response.info().get('ETag')
+        response_data = json.loads(body)
+        if not response_data.get('ok'):
+            raise exceptions.RpcError(response_data['error'])
+        if etag:
+            self._cache[cache_key] = (etag, body)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return response_data['result']
+
+    def _call(self, entity_name, op, arg=None, data=None, params=None):
         entity = self._schema.get_entity(entity_name)
         if not entity:
             raise exceptions.NotFound('No such entity "%s"' % entity_name)
@@ -123,7 +272,7 @@ class Connection(object):
         args = [op, entity_name]
         if arg:
             args.append(arg)
-        return self._request(args, data)
+        return self._request(args, data, params=params)
 
     def _from_net(self, entity_name, data):
         return self._schema.get_entity(entity_name).from_net(data)
@@ -181,7 +330,8 @@ class Connection(object):
       
         return self._call(entity_name, 'delete', object_name)
 
-    def find(self, entity_name, data):
+    def find(self, entity_name, data, limit=None, cursor=None, fields=None,
+             stream=False):
         """Perform a query.
 
         The 'query' argument should represent a valid query. It should
@@ -190,27 +340,68 @@ class Connection(object):
         expressed either in its raw dictionary form, or as a class in
         the configdb.client.query module.
 
+        Results can be paginated by setting 'limit': the result will
+        then be a ResultPage, sorted by name, whose 'cursor' attribute
+        should be passed to the next call to fetch the following page.
+
+        Alternatively, setting 'stream' will ask the server to stream
+        the results, and an iterator will be returned that decodes
+        objects as they are received.
+
         Args:
           entity_name: string, entity name
           data: query data
+          limit: int (optional), maximum number of results
+          cursor: string (optional), continuation token
+          fields: list (optional), only return these fields (and 'name')
+          stream: bool (optional), stream the results
 
         Returns:
-          A list of database objects.
+          A list (or an iterator, if streaming) of database objects.
 
         Raises:
           exceptions.NotFound if the entity does not exist
         """
         if isinstance(data, query.Query):
             data = data.to_net()
-        return [self._from_net(entity_name, x)
-                for x in self._call(entity_name, 'find', data=data)]
+        if stream:
+            if limit is not None or cursor is not None:
+                raise ValueError('can not paginate a streamed find')
+            return self._find_stream(entity_name, data, fields)
+        params = {}
+        if limit is not None:
+            params['limit'] = limit
+        if cursor is not None:
+            params['cursor'] = cursor
+        paginated = bool(params)
+        if fields:
+            params['fields'] = ','.join(fields)
+        result = self._call(entity_name, 'find', data=data, params=params)
+        entity = self._schema.get_entity(entity_name)
+        if not paginated:
+            return entity.from_net_many(result)
+        return ResultPage(entity.from_net_many(result['results']),
+                          result['cursor'])
     
-    def get(self, entity_name, object_name):
+    def _find_stream(self, entity_name, data, fields):
+        entity = self._schema.get_entity(entity_name)
+        if not entity:
+            raise exceptions.NotFound('No such entity "%s"' % entity_name)
+        if data:
+            data = entity.to_net(data, ignore_missing=True)
+        params = {'stream': 1}
+        if fields:
+            params['fields'] = ','.join(fields)
+        response = self._open(['find', entity_name], data, params=params)
+        return (entity.from_net(x) for x in iter_json_results(response))
+
+    def get(self, entity_name, object_name, fields=None):
         """Fetch a single object.
 
         Args:
           entity_name: string, entity name
           object_name: string, primary key (name) of the object
+          fields: list (optional), only return these fields (and 'name')
 
         Returns:
           A database object.
@@ -218,9 +409,12 @@ class Connection(object):
         Raises:
           exceptions.NotFound if the object or entity do not exist.
         """
+        params = None
+        if fields:
+            params = {'fields': ','.join(fields)}
         return self._from_net(
             entity_name,
-            self._call(entity_name, 'get', object_name))
+            self._call(entity_name, 'get', object_name, params=params))
 
     def update(self, entity_name, object_name, data):
         """Update the contents of an object.
@@ -240,6 +434,39 @@ class Connection(object):
         """
         return self._call(entity_name, 'update', object_name, data)
 
+    def bulk(self, ops):
+        """Run many create/update/delete operations at once.
+
+        The operations are executed by the server in a single
+        transaction: either they all succeed, or none of them is
+        applied.
+
+        Args:
+          ops: list of dicts, each with the 'op' ('create', 'update'
+            or 'delete'), 'entity', and (depending on the operation)
+            'name' and 'data' attributes
+
+        Returns:
+          A list with the result of each operation.
+
+        Raises:
+          exceptions.NotFound if an entity does not exist
+          exceptions.RpcError if any of the operations fails.
+        """
+        net_ops = []
+        for op in ops:
+            entity = self._schema.get_entity(op.get('entity'))
+            if not entity:
+                raise exceptions.NotFound(
+                    'No such entity "%s"' % op.get('entity'))
+            op = dict(op)
+            if op.get('data'):
+                op['data'] = entity.to_net(op['data'], ignore_missing=True)
+            net_ops.append(op)
+        if not net_ops:
+            return []
+        return self._request(['bulk'], net_ops)
+
     def get_audit(self, query):
         """Query the audit log.
 
@@ -251,6 +478,59 @@ class Connection(object):
         """
         return self._request(['audit'], query)
 
+    def get_changes(self, since=0, entity_name=None, wait=0, limit=None):
+        """Fetch the changes made after a sequence number.
+
+        Args:
+          since: int, sequence number of the last change seen (0 to
+            get all the changes, -1 to only get the sequence number of
+            the last change)
+          entity_name: string (optional), only return changes to
+            this entity
+          wait: float (optional), if there are no changes, wait up to
+            this many seconds for new ones
+          limit: int (optional), maximum number of changes returned
+
+        Returns:
+          A (changes, seq) tuple: 'changes' is a list of dictionaries
+          with 'seq', 'entity', 'name', 'op' and 'stamp' attributes,
+          and 'seq' is the value of 'since' for the next call.
+        """
+        params = {'since': since}
+        if entity_name:
+            params['entity'] = entity_name
+        if wait:
+            params['wait'] = wait
+        if limit:
+            params['limit'] = limit
+        result = self._request(['changes'], params=params)
+        return result['changes'], result['seq']
+
+    def iter_changes(self, since=0, entity_name=None, wait=30,
+                     follow=True):
+        """Iterate over the changes made after a sequence number.
+
+        Mirrors can use this to apply changes incrementally: each
+        change has a 'seq' attribute, which can be saved and passed
+        as 'since' to resume from there.
+
+        Args:
+          since: int, sequence number of the last change seen
+          entity_name: string (optional), only return changes to
+            this entity
+          wait: float, how long each request waits for new changes
+          follow: bool, if False, stop when there are no more
+            changes, instead of waiting for new ones forever
+        """
+        while True:
+            last_seq = since
+            changes, since = self.get_changes(
+                since, entity_name, wait if follow else 0)
+            for change in changes:
+                yield change
+            if not follow and since == last_seq:
+                return
+
     def get_timestamp(self, entity_name):
         """Fetch the timestamp of last update to a entity.
 
@@ -0,0 +1,344 @@
+"""HTTP load generator for the configdb API server.
+
+Runs a mix of operations against a live server, using a number of
+concurrent connections, for a given duration, optionally limiting
+the total request rate. Reports the throughput and the latency
+percentiles of each operation.
+
+The synthetic workload reads and updates random existing objects of
+a single entity: updates set a string field to a random value, so
+don't run it against a production database! Alternatively, the
+writes can be replayed from an audit log (as returned by the
+'configdb-client audit' command, or fetched from the server itself),
+in which case the reads target the objects found in the log.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+from configdb.client import connection
+from configdb.db import schema
+
+log = logging.getLogger(__name__)
+
+OPS = ('get', 'find', 'update')
+
+
+def parse_mix(value):
+    """Parse a mix specification such as 'get=70,find=20,update=10'."""
+    mix = {}
+    for part in value.split(','):
+        try:
+            op, weight = part.split('=')
+            weight = float(weight)
+        except ValueError:
+            raise ValueError('invalid mix specification "%s"' % part)
+        if op not in OPS:
+            raise ValueError('unknown operation "%s"' % op)
+        if weight < 0:
+            raise ValueError('negative weight for "%s"' % op)
+        mix[op] = weight
+    if not sum(mix.values()):
+        raise ValueError('empty mix')
+    return mix
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return None
+    idx = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(idx, len(sorted_values) - 1))]
+
+
+class Stats(object):
+    """Latencies and errors of the operations, by type."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, op, elapsed, error=False):
+        with self._lock:
+            if error:
+                self.errors[op] = self.errors.get(op, 0) + 1
+            else:
+                self.latencies.setdefault(op, []).append(elapsed)
+
+    def summary(self, duration):
+        """Return a dictionary of per-operation results."""
+        result = {}
+        for op in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(op, []))
+            result[op] = {
+                'count': len(values),
+                'errors': self.errors.get(op, 0),
+                'throughput': len(values) / duration if duration else 0,
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99)}
+        return result
+
+
+class RateLimiter(object):
+    """Spread requests evenly to achieve a total rate (per second).
+
+    Shared by all the workers. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Workload(object):
+    """Synthetic workload on the existing objects of an entity.
+
+    'targets' is a list of (entity_name, object_name) pairs to read
+    from. Updates set 'update_field' of a target to a random value.
+    """
+
+    def __init__(self, schema_obj, mix, targets, update_field=None):
+        self.schema = schema_obj
+        self.targets = targets
+        self.update_field = update_field
+        self._ops = sorted(mix)
+        self._weights = [mix[x] for x in self._ops]
+        self._total = float(sum(self._weights))
+
+    def choose_op(self, rng):
+        r = rng.random() * self._total
+        for op, weight in zip(self._ops, self._weights):
+            r -= weight
+            if r < 0:
+                return op
+        return self._ops[-1]
+
+    def get(self, conn, rng):
+        entity_name, object_name = rng.choice(self.targets)
+        conn.get(entity_name, object_name)
+
+    def find(self, conn, rng):
+        entity_name, object_name = rng.choice(self.targets)
+        conn.find(entity_name, {'name': {'type': 'eq',
+                                         'value': object_name}})
+
+    def update(self, conn, rng):
+        if not self.update_field:
+            raise ValueError('no field to update')
+        entity_name, object_name = rng.choice(self.targets)
+        conn.update(entity_name, object_name,
+                    {self.update_field: 'loadgen-%08x' % rng.getrandbits(32)})
+
+    def run_op(self, op, conn, rng):
+        getattr(self, op)(conn, rng)
+
+
+class ReplayWorkload(Workload):
+    """Replay the writes recorded in an audit log.
+
+    Writes are taken from the log in order (starting over when it is
+    exhausted), reads are spread over the objects found in the log.
+    """
+
+    def __init__(self, schema_obj, mix, audit_log):
+        self.audit_log = [x for x in audit_log
+                          if x.get('op') in ('create', 'update', 'delete')]
+        if not self.audit_log:
+            raise ValueError('no write operations in the audit log')
+        targets = sorted(set((x['entity'], x['object'])
+                             for x in self.audit_log))
+        Workload.__init__(self, schema_obj, mix, targets)
+        self._pos = 0
+        self._lock = threading.Lock()
+
+    def _next_entry(self):
+        with self._lock:
+            entry = self.audit_log[self._pos]
+            self._pos = (self._pos + 1) % len(self.audit_log)
+        return entry
+
+    def update(self, conn, rng):
+        entry = self._next_entry()
+        entity_name, object_name = entry['entity'], entry['object']
+        if entry['op'] == 'delete':
+            return conn.delete(entity_name, object_name)
+        data = entry.get('data') or {}
+        if isinstance(data, basestring):
+            data = json.loads(data)
+        data = self.schema.get_entity(entity_name).from_net(data)
+        if entry['op'] == 'create':
+            return conn.create(entity_name, data)
+        return conn.update(entity_name, object_name, data)
+
+
+def _find_update_field(schema_obj, entity_name):
+    """Pick a string field of the entity that accepts random values."""
+    entity = schema_obj.get_entity(entity_name)
+    for name, field in sorted(entity.fields.iteritems()):
+        if name == 'name' or field.type != 'string':
+            continue
+        try:
+            field.validate('loadgen-00000000')
+        except Exception:
+            continue
+        return name
+
+
+def run(workload, conn_factory, concurrency, duration, rate=0, seed=None):
+    """Run the workload, return a Stats object and the elapsed time."""
+    stats = Stats()
+    limiter = RateLimiter(rate)
+    deadline = time.time() + duration
+
+    def _worker(idx):
+        rng = random.Random(None if seed is None else seed + idx)
+        conn = conn_factory()
+        while time.time() < deadline:
+            limiter.wait()
+            op = workload.choose_op(rng)
+            start = time.time()
+            try:
+                workload.run_op(op, conn, rng)
+            except Exception, e:
+                log.debug('%s error: %s', op, e)
+                stats.record(op, time.time() - start, error=True)
+            else:
+                stats.record(op, time.time() - start)
+
+    start = time.time()
+    threads = [threading.Thread(target=_worker, args=(i,))
+               for i in xrange(concurrency)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return stats, time.time() - start
+
+
+def _print_summary(summary, out=sys.stdout):
+    out.write('%-8s %8s %7s %10s %9s %9s %9s\n' % (
+            'op', 'count', 'errors', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+
+    def _ms(value):
+        return '%9.2f' % (value * 1000) if value is not None else '%9s' % '-'
+    for op, r in sorted(summary.iteritems()):
+        out.write('%-8s %8d %7d %10.1f %s %s %s\n' % (
+                op, r['count'], r['errors'], r['throughput'],
+                _ms(r['p50']), _ms(r['p95']), _ms(r['p99'])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url',
+                        default=os.getenv('CONFIGDB_URL',
+                                          'http://localhost:3000'),
+                        help='URL of the configdb API server')
+    parser.add_argument('--user')
+    parser.add_argument('--password',
+                        default=os.getenv('CONFIGDB_PASSWORD'),
+                        help='Password (default: $CONFIGDB_PASSWORD)')
+    parser.add_argument('--entity', default='host',
+                        help='Entity to run the synthetic workload on '
+                        '(default: host)')
+    parser.add_argument('--update-field',
+                        help='String field modified by the updates '
+                        '(default: the first suitable one)')
+    parser.add_argument('--mix', default='get=70,find=20,update=10',
+                        type=parse_mix,
+                        help='Relative weight of the operations '
+                        '(default: get=70,find=20,update=10)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Number of concurrent connections (default 4)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Target rate, in total requests per second '
+                        '(default: unlimited)')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Test duration, in seconds (default 30)')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='Replay the writes of an audit log, in JSON '
+                        'format ("-" to fetch the log of ENTITY from the '
+                        'server)')
+    parser.add_argument('--cache', action='store_true',
+                        help='Use the client-side response cache')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results in JSON format')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s: %(message)s')
+
+    schema_file = os.getenv('SCHEMA_FILE')
+    if not schema_file:
+        log.error('The SCHEMA_FILE environment variable is not set, '
+                  'please point it at your JSON schema file.')
+        return 1
+    with open(schema_file) as fd:
+        schema_obj = schema.Schema(fd.read())
+
+    def conn_factory():
+        conn = connection.Connection(
+            args.url, schema_obj, username=args.user,
+            password=args.password, cache_size=100 if args.cache else 0)
+        conn.batch = True
+        return conn
+
+    try:
+        if args.replay:
+            if args.replay == '-':
+                audit_log = conn_factory().get_audit({'entity': args.entity})
+            else:
+                with open(args.replay) as fd:
+                    audit_log = json.load(fd)
+            workload = ReplayWorkload(schema_obj, args.mix, audit_log)
+        else:
+            if not schema_obj.get_entity(args.entity):
+                raise ValueError('unknown entity "%s"' % args.entity)
+            targets = [(args.entity, x['name']) for x in
+                       conn_factory().find(
+                           args.entity,
+                           {'name': {'type': 'substring', 'value': ''}},
+                           fields=['name'])]
+            if not targets:
+                raise ValueError('no %s objects found' % args.entity)
+            workload = Workload(
+                schema_obj, args.mix, targets,
+                args.update_field or _find_update_field(schema_obj,
+                                                        args.entity))
+    except Exception, e:
+        log.error('%s', e)
+        return 1
+
+    stats, elapsed = run(workload, conn_factory, args.concurrency,
+                         args.duration, args.rate, args.seed)
+    summary = stats.summary(elapsed)
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        _print_summary(summary)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import copy
 from configdb import exceptions
 
 
@@ -13,15 +14,31 @@ class AuthContext(object):
     authentication middleware in the WSGI server to set it to the
     appropriate object (usually the one representing the logged-in
     user).
+
+    ACL decisions are memoized in the context. The memo only lives
+    for the duration of a single AdmDbApi call, which clears it on
+    entry and on exit; contexts shared between requests should still
+    be copied (see copy()).
     """
 
     def __init__(self, username, groups=None):
         self.user = username
         self.groups = groups or frozenset()
         self.self_obj = None
+        self.acl_memo = {}
+
+    def copy(self):
+        """Return a copy of the context, with no memoized decisions."""
+        ctx = copy.copy(self)
+        ctx.acl_memo = {}
+        return ctx
+
+    def clear_acl_memo(self):
+        self.acl_memo.clear()
 
     def set_self(self, obj):
         self.self_obj = obj
+        self.acl_memo.clear()
 
     def is_self(self, obj):
         return (obj and (self.self_obj is not None)
@@ -84,11 +101,143 @@ class RuleMatchUserByRelation(AclRule):
     def match(self, ctx, obj):
         if not obj:
             return True
-        user_rel_obj = getattr(obj, self.rel_attr)
         self_obj = ctx.get_self()
         return ((self_obj is not None)
-                and (user_rel_obj is not None)
-                and (self_obj in user_rel_obj))
+                and _relation_contains(getattr(obj, self.rel_attr),
+                                       self_obj.name))
+
+
+def _relation_contains(rel, name):
+    """Check if a relation attribute contains the named object.
+
+    Objects are compared by name, since the 'self' object usually
+    comes from a different database session. Relations that are not
+    plain lists (like the in-memory relation proxies) are expected to
+    support lookups by name with the 'in' operator, using their own
+    index.
+    """
+    if rel is None:
+        return False
+    if isinstance(rel, (list, tuple)):
+        return any(x.name == name for x in rel)
+    return name in rel
+
+
+def _always(ctx, obj):
+    return True
+
+
+def _never(ctx, obj):
+    return False
+
+
+def compile_acl_rules(rules):
+    """Build a decision function for a list of ACL rules.
+
+    Returns a (fn, uses_obj) tuple, where fn(ctx, obj) is equivalent
+    to checking whether any of the rules match, and 'uses_obj' tells
+    whether the decision depends on the object at all.
+    """
+    users = set()
+    groups = set()
+    match_self = False
+    rel_attrs = []
+    others = []
+    for rule in rules:
+        if isinstance(rule, RuleAny):
+            return _always, False
+        elif isinstance(rule, RuleNone):
+            continue
+        elif isinstance(rule, RuleMatchUser):
+            users.add(rule.ok_user)
+        elif isinstance(rule, RuleMatchGroup):
+            groups.add(rule.ok_group)
+        elif isinstance(rule, RuleMatchSelf):
+            match_self = True
+        elif isinstance(rule, RuleMatchUserByRelation):
+            rel_attrs.append(rule.rel_attr)
+        else:
+            others.append(rule)
+    if not (users or groups or match_self or rel_attrs or others):
+        return _never, False
+    users = frozenset(users)
+    groups = frozenset(groups)
+
+    def _acl_fn(ctx, obj):
+        if ctx.user in users:
+            return True
+        if groups and not groups.isdisjoint(ctx.groups):
+            return True
+        if match_self and ctx.is_self(obj):
+            return True
+        if rel_attrs:
+            if not obj:
+                return True
+            self_obj = ctx.get_self()
+            if self_obj is not None:
+                for attr in rel_attrs:
+                    if _relation_contains(getattr(obj, attr), self_obj.name):
+                        return True
+        return any(x.match(ctx, obj) for x in others)
+    return _acl_fn, bool(match_self or rel_attrs or others)
+
+
+class RowFilter(object):
+    """Filter on the objects that can be accessed in an auth context.
+
+    Holds the object-dependent ACL rules that are left to check once
+    the context alone is not enough to grant access. A RowFilter can
+    be called on an object, but backends can also translate the
+    '@self' rule ('match_self') and the relation rules ('rel_attrs')
+    to native queries on the 'self_name' object name, as long as
+    there are no 'other_rules' (which can only be checked in Python).
+    """
+
+    def __init__(self, ctx, match_self, rel_attrs, other_rules):
+        self.ctx = ctx
+        self_obj = ctx.get_self()
+        self.self_name = self_obj.name if self_obj is not None else None
+        self.match_self = match_self
+        self.rel_attrs = rel_attrs
+        self.other_rules = other_rules
+
+    def matches_nothing(self):
+        return self.self_name is None and not self.other_rules
+
+    def __call__(self, obj):
+        if self.self_name is not None:
+            if self.match_self and obj.name == self.self_name:
+                return True
+            for attr in self.rel_attrs:
+                if _relation_contains(getattr(obj, attr, None),
+                                      self.self_name):
+                    return True
+        return any(x.match(self.ctx, obj) for x in self.other_rules)
+
+
+def make_row_filter(rules, ctx):
+    """Build a RowFilter for a list of ACL rules.
+
+    Returns None if the rules grant access regardless of the object,
+    and False if they never do.
+    """
+    match_self = False
+    rel_attrs = []
+    other_rules = []
+    for rule in rules:
+        if isinstance(rule, (RuleAny, RuleNone, RuleMatchUser,
+                             RuleMatchGroup)):
+            if rule.match(ctx, None):
+                return None
+        elif isinstance(rule, RuleMatchSelf):
+            match_self = True
+        elif isinstance(rule, RuleMatchUserByRelation):
+            rel_attrs.append(rule.rel_attr)
+        else:
+            other_rules.append(rule)
+    if not (match_self or rel_attrs or other_rules):
+        return False
+    return RowFilter(ctx, match_self, rel_attrs, other_rules)
 
 
 def _parse_acl_rules(acl_spec):
@@ -138,11 +287,23 @@ class AclMixin(object):
 
     def set_acl(self, acl_dict=None):
         self._acl = parse_acl(acl_dict) if acl_dict else None
+        self._acl_fns = dict(
+            (op, compile_acl_rules(rules))
+            for op, rules in self._acl.iteritems()) if self._acl else {}
 
     def has_acl(self):
         return hasattr(self, '_acl') and bool(self._acl)
 
+    def get_acl_rules(self, op):
+        if not self.has_acl():
+            return []
+        return self._acl.get(op, [])
+
+    def get_acl_fn(self, op):
+        """Return the compiled (fn, uses_obj) decision for 'op'."""
+        if not self.has_acl():
+            return _never, False
+        return self._acl_fns.get(op, (_never, False))
+
     def acl_check(self, auth_context, op, obj):
-        return (self.has_acl()
-                and any(x.match(auth_context, obj)
-                        for x in self._acl.get(op, [])))
+        return self.get_acl_fn(op)[0](auth_context, obj)
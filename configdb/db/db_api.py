@@ -1,18 +1,52 @@
+import base64
 import functools
+import json
+import sys
+import threading
 import time
 
 from configdb import exceptions
 from configdb.db import acl
 from configdb.db import query
 from configdb.db import schema
-from configdb.db import validation
+from configdb.db import slowlog
+from configdb.db import timestamps
+from configdb.db.interface import base
 
 
 def with_session(fn):
+    """Run the method in a new session.
+
+    Coalesced timestamps of the entities modified by the method are
+    only recorded once the session has been committed, so that other
+    processes never see a timestamp before the data it refers to.
+
+    The ACL decisions memoized in the auth contexts passed to the
+    method only last for the duration of the call.
+    """
     @functools.wraps(fn)
     def _with_session_wrapper(self, *args, **kwargs):
-        with self.db.session() as session:
-            return fn(self, session, *args, **kwargs)
+        outer = getattr(self._local, 'touched', None)
+        touched = self._local.touched = set()
+        auth_contexts = [x for x in args + tuple(kwargs.values())
+                         if isinstance(x, acl.AuthContext)]
+        if outer is None:
+            for ctx in auth_contexts:
+                ctx.clear_acl_memo()
+        try:
+            with self.db.session() as session:
+                res = fn(self, session, *args, **kwargs)
+        finally:
+            # The timestamps of rolled back changes are dropped.
+            self._local.touched = outer
+            if outer is None:
+                for ctx in auth_contexts:
+                    ctx.clear_acl_memo()
+        if touched:
+            now = time.time()
+            for entity_name in touched:
+                self.timestamps.touch(entity_name, now)
+        return res
     return _with_session_wrapper
 
 
@@ -25,54 +59,74 @@ def with_timestamp(fn):
     return _with_timestamp_wrapper
 
 
-def _field_validation(field, value):
-    return field.validate(value)
+def with_change_notification(fn):
+    @functools.wraps(fn)
+    def _with_change_notification_wrapper(self, *args, **kwargs):
+        res = fn(self, *args, **kwargs)
+        # The changes have been committed, wake up wait_for_changes().
+        with self._changes_cond:
+            self._changes_generation += 1
+            self._changes_cond.notify_all()
+        return res
+    return _with_change_notification_wrapper
 
 
-class AdmDbApi(object):
-    """High-level interface to the database."""
+def encode_cursor(object_name):
+    """Build the continuation token of a paginated find."""
+    return base64.urlsafe_b64encode(json.dumps({'after': object_name}))
 
-    def __init__(self, schema, db):
-        self.db = db
-        self.schema = schema
 
-    def _unpack(self, entity, data, validation_fn=_field_validation):
-        """Unpack input data and perform a base sanity check."""
+def decode_cursor(cursor):
+    """Return the object name encoded in a continuation token."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))['after']
+    except (TypeError, ValueError, KeyError):
+        raise exceptions.QueryError('invalid cursor')
 
-        # Complain about extra fields.
-        extra_fields = []
-        for field in set(data.keys()):
-            if field not in entity.fields:
-                extra_fields.append(field)
-        if extra_fields:
-            raise exceptions.ValidationError(
-                'Unknown extra fields for "%s": %s' % (
-                    entity.name, ', '.join(extra_fields)))
 
-        # Deserialize the input data.
-        try:
-            data = entity.from_net(data)
-        except (ValueError, TypeError), e:
-            raise exceptions.ValidationError(
-                'Validation error in deserialization: %s' % str(e))
+class AdmDbApi(object):
+    """High-level interface to the database.
 
-        # Perform validation on all fields.
-        out = {}
-        errors = []
-        for field in entity.fields.itervalues():
-            try:
-                out[field.name] = validation_fn(field, data[field.name])
-            except KeyError:
-                continue
-            except validation.Invalid, e:
-                errors.append('%s: %s' % (field.name, e))
+    If 'slow_threshold' is set, operations taking longer than that
+    many seconds are logged to the 'configdb.slowlog' logger.
 
-        # If there have been any errors, raise a ValidationError.
-        if errors:
-            raise exceptions.ValidationError(
-                'Validation error for "%s": %s' % (
-                    entity.name, ', '.join(errors)))
-        return out
+    If 'timestamp_flush_interval' is set, the timestamps of the
+    modified entities are written in the background, at most that
+    many seconds later (see timestamps.TimestampCoalescer).
+    """
+
+    # How often wait_for_changes() checks for changes made by other
+    # processes, in seconds.
+    CHANGES_POLL_INTERVAL = 1
+
+    def __init__(self, schema, db, slow_threshold=None,
+                 timestamp_flush_interval=None):
+        self.db = db
+        self.schema = schema
+        self._changes_cond = threading.Condition()
+        self._changes_generation = 0
+        # Per-thread state of the current session (see with_session).
+        self._local = threading.local()
+        self.timestamps = None
+        if timestamp_flush_interval:
+            self.timestamps = timestamps.TimestampCoalescer(
+                db, timestamp_flush_interval)
+        self.slowlog = None
+        if slow_threshold is not None:
+            # Find the name of the actual backend, skipping wrappers.
+            backend = db
+            while (not isinstance(backend, base.DbInterface)
+                   and hasattr(backend, 'db')):
+                backend = backend.db
+            self.slowlog = slowlog.SlowLog(slow_threshold,
+                                           backend.__class__.__name__)
+
+    def _unpack(self, entity, data, validation_fn=None):
+        """Unpack input data and perform a base sanity check.
+
+        See schema.Entity.unpack().
+        """
+        return entity.unpack(data, validation_fn)
 
     def _diff_object(self, entity, obj, new_data):
         """Returns a list of modified fields."""
@@ -98,18 +152,22 @@ class AdmDbApi(object):
                 to_add = new_value - old_value
                 to_remove = old_value - new_value
                 relation = getattr(obj, field_name)
-                for rel_name in to_add:
-                    rel_obj = self.db.get_by_name(
-                        field.remote_name, rel_name, session)
-                    if not rel_obj:
+                if to_add:
+                    rel_objs = self.db.get_many(
+                        field.remote_name, to_add, session)
+                    missing = to_add - set(rel_objs)
+                    if missing:
                         raise exceptions.RelationError(
                             'no such object, %s=%s' % (
-                                field.remote_name, rel_name))
-                    relation.append(rel_obj)
-                for rel_name in to_remove:
-                    rel_obj = self.db.get_by_name(
-                        field.remote_name, rel_name, session)
-                    relation.remove(rel_obj)
+                                field.remote_name,
+                                ', '.join(sorted(missing))))
+                    for rel_name in to_add:
+                        relation.append(rel_objs[rel_name])
+                if to_remove:
+                    # The objects to remove are already in the relation.
+                    for rel_obj in [x for x in relation
+                                    if x.name in to_remove]:
+                        relation.remove(rel_obj)
             else:
                 setattr(obj, field_name, new_value)
 
@@ -118,23 +176,24 @@ class AdmDbApi(object):
             #Avoid updating timestamp for tables that are not part of the schema.
             return True
 
-        data = {'name': entity_name, 'ts': time.time() }
-        ts = self.schema.get_entity('__timestamp')
-        data = self._unpack(ts, data)
-
-        obj = self.db.get_by_name('__timestamp', entity_name, session)
-        if obj:
-            diffs = self._diff_object(ts, obj, data)
-            self._apply_diff(ts, obj, diffs, session)
-            session.add(obj)
+        touched = getattr(self._local, 'touched', None)
+        if self.timestamps and touched is not None:
+            # Recorded when the session commits, see with_session.
+            touched.add(entity_name)
+        elif self.timestamps:
+            # The caller owns the session, and commits it right away.
+            self.timestamps.touch(entity_name, time.time())
         else:
-            obj = self.db.create('__timestamp', data, session)
+            self.db.set_timestamp(entity_name, time.time(), session)
         return True
 
-    @with_session
-    @with_timestamp
-    def update(self, session, entity_name, object_name, data, auth_context):
-        """Update an existing instance."""
+    def close(self):
+        """Write the pending timestamps, and close the database."""
+        if self.timestamps:
+            self.timestamps.close()
+        self.db.close()
+
+    def _update(self, session, entity_name, object_name, data, auth_context):
         ent = self.schema.get_entity(entity_name)
         if not ent:
             raise exceptions.NotFound(entity_name)
@@ -148,16 +207,17 @@ class AdmDbApi(object):
         self.schema.acl_check_fields(
             ent, diffs.keys(), auth_context, 'w', obj)
         self._apply_diff(ent, obj, diffs, session)
+        # Relations might have changed, invalidate the ACL decisions.
+        auth_context.clear_acl_memo()
         self.db.add_audit(entity_name, object_name, 'update',
                           data, auth_context, session)
+        if diffs:
+            self.db.add_change(entity_name, object_name, 'update', session)
         session.add(obj)
 
         return True
 
-    @with_session
-    @with_timestamp
-    def delete(self, session, entity_name, object_name, auth_context):
-        """Delete an instance."""
+    def _delete(self, session, entity_name, object_name, auth_context):
         ent = self.schema.get_entity(entity_name)
         if not ent:
             raise exceptions.NotFound(entity_name)
@@ -166,15 +226,14 @@ class AdmDbApi(object):
         if obj:
             self.schema.acl_check_entity(ent, auth_context, 'w', obj)
             self.db.delete(entity_name, object_name, session)
+            auth_context.clear_acl_memo()
             self.db.add_audit(entity_name, object_name, 'delete',
                               None, auth_context, session)
+            self.db.add_change(entity_name, object_name, 'delete', session)
 
         return True
 
-    @with_session
-    @with_timestamp
-    def create(self, session, entity_name, data, auth_context):
-        """Create a new instance."""
+    def _create(self, session, entity_name, data, auth_context):
         ent = self.schema.get_entity(entity_name)
         if not ent:
             raise exceptions.NotFound(entity_name)
@@ -187,11 +246,102 @@ class AdmDbApi(object):
             raise exceptions.ValidationError('No object name specified')
 
         obj = self.db.create(entity_name, data, session)
+        auth_context.clear_acl_memo()
         self.db.add_audit(entity_name, object_name, 'create',
                           data, auth_context, session)
+        self.db.add_change(entity_name, object_name, 'create', session)
 
         return True
 
+    @slowlog.slowlogged('update')
+    @with_change_notification
+    @with_session
+    @with_timestamp
+    def update(self, session, entity_name, object_name, data, auth_context):
+        """Update an existing instance."""
+        return self._update(session, entity_name, object_name, data,
+                            auth_context)
+
+    @slowlog.slowlogged('delete')
+    @with_change_notification
+    @with_session
+    @with_timestamp
+    def delete(self, session, entity_name, object_name, auth_context):
+        """Delete an instance."""
+        return self._delete(session, entity_name, object_name, auth_context)
+
+    @slowlog.slowlogged('create')
+    @with_change_notification
+    @with_session
+    @with_timestamp
+    def create(self, session, entity_name, data, auth_context):
+        """Create a new instance."""
+        return self._create(session, entity_name, data, auth_context)
+
+    def _bulk_op(self, session, op, auth_context):
+        """Dispatch a single operation of a bulk request."""
+        if not isinstance(op, dict):
+            raise exceptions.ValidationError('operation must be a dictionary')
+        op_type = op.get('op')
+        entity_name = op.get('entity')
+        if not entity_name:
+            raise exceptions.ValidationError('No entity specified')
+        if op_type == 'create':
+            return self._create(session, entity_name, op.get('data') or {},
+                                auth_context)
+        object_name = op.get('name')
+        if not object_name:
+            raise exceptions.ValidationError('No object name specified')
+        if op_type == 'update':
+            return self._update(session, entity_name, object_name,
+                                op.get('data') or {}, auth_context)
+        elif op_type == 'delete':
+            return self._delete(session, entity_name, object_name,
+                                auth_context)
+        raise exceptions.ValidationError('unknown operation "%s"' % op_type)
+
+    @slowlog.slowlogged('bulk')
+    @with_change_notification
+    @with_session
+    def bulk(self, session, ops, auth_context):
+        """Run many create/update/delete operations in a single session.
+
+        Each operation is a dictionary with an 'op' attribute (one of
+        'create', 'update' or 'delete'), the 'entity' name and, as
+        required by the operation, the object 'name' and its 'data'.
+
+        All operations share the same backend session, which is
+        committed only once at the end, and the timestamp of every
+        modified entity is updated just once. Returns the list of
+        per-operation results. If any operation fails, the whole batch
+        is rolled back and the error is raised again, annotated with
+        the index of the offending operation.
+
+        Note that backends without transaction support (etcd,
+        ZooKeeper, Doozer) apply changes as they go, so a failure
+        can't undo the operations that preceded it.
+        """
+        if not isinstance(ops, list):
+            raise exceptions.ValidationError('bulk request must be a list')
+        results = []
+        touched = set()
+        for idx, op in enumerate(ops):
+            try:
+                results.append(self._bulk_op(session, op, auth_context))
+                # Make the changes visible to the following operations.
+                flush = getattr(session, 'flush', None)
+                if flush:
+                    flush()
+            except exceptions.Error, e:
+                # Keep the original traceback.
+                error = e.__class__('operation %d: %s' % (idx, e))
+                raise error.__class__, error, sys.exc_info()[2]
+            touched.add(op['entity'])
+        for entity_name in touched:
+            self.update_timestamp(session, entity_name)
+        return results
+
+    @slowlog.slowlogged('get')
     @with_session
     def get(self, session, entity_name, object_name, auth_context):
         """Return a specific instance."""
@@ -207,21 +357,79 @@ class AdmDbApi(object):
         self.schema.acl_check_entity(ent, auth_context, 'r', obj)
         return obj
 
+    def check_fields(self, entity, fields):
+        """Validate a list of field names for a projection.
+
+        The 'name' field is always added to the list.
+        """
+        unknown = [x for x in fields if x not in entity.fields]
+        if unknown:
+            raise exceptions.ValidationError(
+                'Unknown fields for "%s": %s' % (
+                    entity.name, ', '.join(unknown)))
+        if 'name' not in fields:
+            fields = ['name'] + list(fields)
+        return fields
+
+    @slowlog.slowlogged('find', with_query=True)
     @with_session
-    def find(self, session, entity_name, query, auth_context):
-        """Find all instances matching a query."""
+    def find(self, session, entity_name, query, auth_context,
+             limit=None, cursor=None, fields=None):
+        """Find all instances matching a query.
+
+        Results can be paginated by specifying a maximum number of
+        results with 'limit', and the continuation token returned by
+        find_page() as 'cursor': in this case they will be sorted by
+        name.
+
+        If 'fields' is set, the returned objects are only guaranteed
+        to contain those fields (and 'name').
+
+        Only the objects that can be read in the given auth context
+        are returned: read ACLs that depend on the object (like
+        '@self') are passed to the backend as a filter.
+        """
         ent = self.schema.get_entity(entity_name)
         if not ent:
             raise exceptions.NotFound(entity_name)
 
-        self.schema.acl_check_entity(ent, auth_context, 'r', None)
+        if limit is not None and (not isinstance(limit, (int, long))
+                                  or limit <= 0):
+            raise exceptions.QueryError('limit must be a positive integer')
+        after = decode_cursor(cursor) if cursor else None
+        if fields is not None:
+            fields = self.check_fields(ent, fields)
+
+        # Arguments are validated first, so that errors don't depend
+        # on the caller's permissions.
+        row_filter = self.schema.get_row_filter(ent, auth_context, 'r')
+        if row_filter is not None and row_filter.matches_nothing():
+            return iter([])
 
         def query_validation(field, value):
             return self.db.parse_query_spec(value)
+        kwargs = {}
+        if row_filter is not None:
+            kwargs['acl_filter'] = row_filter
         return self.db.find(
             entity_name,
             self._unpack(ent, query, validation_fn=query_validation),
-            session)
+            session, limit=limit, after=after, fields=fields, **kwargs)
+
+    def find_page(self, entity_name, query, auth_context, limit,
+                  cursor=None, fields=None):
+        """Return a page of the results of a query.
+
+        Returns a (results, cursor) tuple, where 'cursor' is the
+        continuation token to be passed to the next call to get the
+        following page, or None if there are no more results.
+        """
+        results = list(self.find(entity_name, query, auth_context,
+                                 limit=limit, cursor=cursor, fields=fields))
+        next_cursor = None
+        if limit and len(results) == limit:
+            next_cursor = encode_cursor(results[-1].name)
+        return results, next_cursor
 
     @with_session
     def get_audit(self, session, query, auth_context):
@@ -240,6 +448,71 @@ class AdmDbApi(object):
         self.schema.acl_check_entity(ent, auth_context, 'r', None)
         return self.db.get_audit(query, session)
 
+    @with_session
+    def get_changes(self, session, since, auth_context, entity_name=None,
+                    limit=None):
+        """Return the changes recorded after the sequence number 'since'.
+
+        Returns a (changes, seq) tuple, where 'changes' is a list of
+        dictionaries (see DbInterface.get_changes()) and 'seq' is the
+        sequence number to pass as 'since' to get the following
+        changes. Changes to entities that the auth context can't read
+        in full (because their read ACL depends on the object) are
+        skipped. If 'since' is negative, no changes are returned, only
+        the sequence number of the last one.
+        """
+        if not self.db.CHANGES_SUPPORT:
+            raise exceptions.Error(
+                'change feed not supported by this backend')
+        if since < 0:
+            return [], self.db.get_changes_seq(session)
+        if entity_name:
+            ent = self.schema.get_entity(entity_name)
+            if not ent:
+                raise exceptions.NotFound(entity_name)
+            self.schema.acl_check_entity(ent, auth_context, 'r', None)
+
+        readable = {}
+        changes = self.db.get_changes(since, entity_name, limit, session)
+        out = []
+        for change in changes:
+            name = change['entity']
+            if name not in readable:
+                try:
+                    readable[name] = self.schema.get_row_filter(
+                        self.schema.get_entity(name), auth_context) is None
+                except exceptions.AclError:
+                    readable[name] = False
+            if readable[name]:
+                out.append(change)
+        if changes:
+            since = changes[-1]['seq']
+        return out, since
+
+    def wait_for_changes(self, since, auth_context, entity_name=None,
+                         limit=None, timeout=0):
+        """Like get_changes(), but wait for new changes if there are none.
+
+        Waits at most 'timeout' seconds. Changes made through this
+        object are noticed immediately, those made by other processes
+        every CHANGES_POLL_INTERVAL seconds.
+        """
+        if since < 0:
+            return self.get_changes(since, auth_context, entity_name, limit)
+        deadline = time.time() + timeout
+        while True:
+            generation = self._changes_generation
+            changes, seq = self.get_changes(since, auth_context,
+                                            entity_name, limit)
+            remaining = deadline - time.time()
+            if changes or remaining <= 0:
+                return changes, seq
+            since = seq
+            with self._changes_cond:
+                if generation == self._changes_generation:
+                    self._changes_cond.wait(
+                        min(remaining, self.CHANGES_POLL_INTERVAL))
+
     @with_session
     def get_timestamp(self, session, entity_name, auth_context):
         """Get the timestamp of the last update on an entity.
@@ -251,7 +524,35 @@ class AdmDbApi(object):
 
         self.schema.acl_check_entity(ent, auth_context, 'r', None)
 
+        if self.timestamps and self.timestamps.pending([entity_name]):
+            self.timestamps.flush()
         obj = self.db.get_by_name('__timestamp', entity_name, session)
         if not obj:
             raise ValueError('no timestamp for %s' % entity_name)
         return obj
+
+    @with_session
+    def get_last_modified(self, session, entity_name, auth_context):
+        """Get the time of the last update that might affect an entity.
+
+        Objects refer to related objects by name, so the timestamps of
+        the related entities are taken into account too. Returns None
+        if no update has been recorded yet.
+        """
+        ent = self.schema.get_entity(entity_name)
+        if not ent:
+            raise exceptions.NotFound(entity_name)
+
+        self.schema.acl_check_entity(ent, auth_context, 'r', None)
+
+        names = set([entity_name])
+        for field in ent.fields.itervalues():
+            if field.is_relation():
+                names.add(field.remote_name)
+        stamps = [x.ts for x in self.db.get_many(
+                '__timestamp', sorted(names), session).itervalues()]
+        if self.timestamps:
+            stamps.extend(self.timestamps.pending(names).itervalues())
+        if not stamps:
+            return None
+        return max(stamps)
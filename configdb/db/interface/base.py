@@ -1,6 +1,9 @@
+import bisect
 import contextlib
+import itertools
 from configdb import exceptions
 from configdb.db import query
+from configdb.db import slowlog
 
 
 @contextlib.contextmanager
@@ -28,6 +31,10 @@ class DbInterface(object):
         }
 
     AUDIT_SUPPORT = False
+    CHANGES_SUPPORT = False
+
+    # How many times set_timestamp() retries conflicting writes.
+    TIMESTAMP_RETRIES = 3
 
     def session(self):
         """Return a session object.
@@ -42,8 +49,43 @@ class DbInterface(object):
     def get_by_name(self, class_name, object_name, session):
         """Return an instance of an entity, by name."""
 
-    def find(self, class_name, query, session):
-        """Query an entity."""
+    def detach(self, obj, session):
+        """Make an object usable after its session has been closed.
+
+        Backends whose objects are bound to a session should override
+        this, the default implementation does nothing.
+        """
+
+    def get_many(self, class_name, object_names, session):
+        """Return many instances of an entity, by name.
+
+        Returns a {name: instance} dictionary, names that do not match
+        any instance are not included. Backends should override this
+        with a batched lookup, the default implementation simply calls
+        get_by_name() once for each name.
+        """
+        out = {}
+        for object_name in object_names:
+            obj = self.get_by_name(class_name, object_name, session)
+            if obj is not None:
+                out[object_name] = obj
+        return out
+
+    def find(self, class_name, query, session, limit=None, after=None,
+             fields=None, acl_filter=None):
+        """Query an entity.
+
+        If either 'limit' or 'after' are specified, results are
+        sorted by name: only objects whose name follows 'after' are
+        returned, up to a maximum of 'limit' objects.
+
+        The optional 'fields' list tells the backend which fields the
+        caller is interested in, so that it can avoid loading the
+        others (which can then be missing from the results).
+
+        If set, 'acl_filter' is an acl.RowFilter: only the objects it
+        accepts should be returned (and count towards the limit).
+        """
 
     def delete(self, class_name, object_name, session):
         """Delete an instance."""
@@ -51,6 +93,30 @@ class DbInterface(object):
     def create(self, class_name, attrs, session):
         """Create a new instance of an entity."""
 
+    def set_timestamp(self, entity_name, ts, session):
+        """Raise the '__timestamp' of an entity to 'ts'.
+
+        The stored value is only written if it is lower than 'ts', so
+        concurrent writers can't move it backwards. On conflicting
+        writes the value is read again, and written only if still
+        needed.
+        """
+        for attempt in xrange(self.TIMESTAMP_RETRIES):
+            obj = self.get_by_name('__timestamp', entity_name, session)
+            if obj is not None and obj.ts is not None and obj.ts >= ts:
+                return
+            try:
+                if obj is None:
+                    self.create('__timestamp',
+                                {'name': entity_name, 'ts': ts}, session)
+                else:
+                    obj.ts = ts
+                    session.add(obj)
+                return
+            except exceptions.IntegrityError:
+                if attempt == self.TIMESTAMP_RETRIES - 1:
+                    raise
+
     def parse_query_spec(self, query_spec):
         """Parse a query spec (a dictionary)."""
         try:
@@ -60,9 +126,12 @@ class DbInterface(object):
         except TypeError:
             raise exceptions.QueryError('Query must be a dictionary specifyng type and value of the query')
 
-    def _run_query(self, entity, query, items):
-        """Apply a query filter to a list of items."""
+    def _run_query(self, entity, query, items, acl_filter=None):
+        """Apply a query filter (and an ACL filter) to a list of items."""
         for item in items:
+            slowlog.count_rows_scanned()
+            if acl_filter is not None and not acl_filter(item):
+                continue
             ok = True
             for field_name, q in query.iteritems():
                 field = entity.fields[field_name]
@@ -77,6 +146,19 @@ class DbInterface(object):
             if ok:
                 yield item
 
+    def _paginate(self, items, limit):
+        """Apply the 'limit' of a paginated find() to its results."""
+        if limit is not None:
+            return itertools.islice(items, limit)
+        return items
+
+    def _sorted_names(self, names, after):
+        """Sort object names, dropping the ones up to 'after'."""
+        names = sorted(names)
+        if after is not None:
+            names = names[bisect.bisect_right(names, after):]
+        return names
+
     def close(self):
         """Release resources associated with the db."""
 
@@ -87,3 +169,20 @@ class DbInterface(object):
     def get_audit(self, query, session):
         """Query the audit log."""
         raise NotImplementedError()
+
+    def add_change(self, entity_name, object_name, operation, session):
+        """Add an entry in the change log."""
+
+    def get_changes(self, since, entity_name, limit, session):
+        """Return the changes recorded after the sequence number 'since'.
+
+        Changes are dictionaries with 'seq', 'entity', 'name', 'op'
+        and 'stamp' attributes, sorted by their sequence number 'seq'.
+        Only changes to 'entity_name' are returned, if set, up to a
+        maximum of 'limit' changes.
+        """
+        raise NotImplementedError()
+
+    def get_changes_seq(self, session):
+        """Return the sequence number of the last change (0 if none)."""
+        raise NotImplementedError()
@@ -0,0 +1,236 @@
+import collections
+import contextlib
+import copy
+import threading
+import time
+
+
+class CachingSession(object):
+    """Session wrapper used by CachingDbInterface.
+
+    Keeps track of the objects read and written within the session,
+    so that the cache can be kept consistent with the changes. Any
+    other attribute is looked up in the wrapped session.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.read_keys = set()
+        self.written_keys = set()
+
+    def add(self, obj, *args, **kwargs):
+        self.written_keys.add(_obj_key(obj))
+        return self.session.add(obj, *args, **kwargs)
+
+    def delete(self, obj, *args, **kwargs):
+        self.written_keys.add(_obj_key(obj))
+        return self.session.delete(obj, *args, **kwargs)
+
+    def _revision_path(self, key):
+        # The key/value backends keep track, in their sessions, of the
+        # revision of each object they read, and use it to detect
+        # conflicting writes: these revisions need to be cached along
+        # with the objects.
+        if hasattr(self.session, 'revisions'):
+            return self.session._mkpath(*key)
+
+    def get_revision(self, key):
+        path = self._revision_path(key)
+        if path is not None:
+            return self.session.revisions.get(path)
+
+    def set_revision(self, key, rev):
+        path = self._revision_path(key)
+        if path is not None and rev is not None:
+            self.session.revisions[path] = rev
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def _obj_key(obj):
+    # Objects from the key/value backends carry their entity name,
+    # SQLAlchemy objects have it as their table name.
+    entity_name = getattr(obj, '_entity_name', None)
+    if entity_name is None:
+        entity_name = getattr(obj, '__tablename__', None)
+    return (entity_name, obj.name)
+
+
+class CachingDbInterface(object):
+    """Read-through object cache for any DbInterface.
+
+    Wraps another database interface, keeping an LRU cache of the
+    objects returned by get_by_name(), indexed by (entity, name).
+    All other methods are passed through to the wrapped interface.
+
+    Cache entries are dropped when the corresponding objects are
+    created, modified or deleted through this interface, and every
+    object read within a session that is rolled back is dropped too
+    (as it might have been modified in place). To notice changes made
+    by other processes, the '__timestamp' of an entity is checked at
+    most once every 'ts_check_interval' seconds, and all the cached
+    objects of that entity are dropped when it has changed.
+
+    The cache keeps private copies of the objects, and every read
+    gets a copy of its own, so that changes made to an object before
+    they are committed (or rolled back) are never seen by other
+    sessions. The wrapped backend must thus return objects that are
+    not bound to a session, as all the key/value backends do: this is
+    not suitable for use with SQLAlchemy.
+    """
+
+    def __init__(self, db, size=1000, ts_check_interval=1):
+        self.db = db
+        self.size = size
+        self.ts_check_interval = ts_check_interval
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._entity_keys = collections.defaultdict(set)
+        self._timestamps = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def stats(self):
+        """Return the cache hit/miss counters."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._cache)}
+
+    def _cache_get(self, key):
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._cache[key] = entry
+            return entry
+
+    def _cache_put(self, key, obj, rev):
+        obj = copy.deepcopy(obj)
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (obj, rev)
+            self._entity_keys[key[0]].add(key)
+            while len(self._cache) > self.size:
+                old_key, unused = self._cache.popitem(last=False)
+                self._entity_keys[old_key[0]].discard(old_key)
+
+    def invalidate(self, keys):
+        """Drop the given (entity, name) keys from the cache."""
+        with self._lock:
+            for key in keys:
+                if self._cache.pop(key, None) is not None:
+                    self._entity_keys[key[0]].discard(key)
+
+    def invalidate_entity(self, entity_name):
+        """Drop all the cached objects of an entity."""
+        with self._lock:
+            for key in self._entity_keys.pop(entity_name, ()):
+                self._cache.pop(key, None)
+
+    def _check_timestamp(self, entity_name, session):
+        now = time.time()
+        checked = self._timestamps.get(entity_name)
+        if checked and now - checked[0] < self.ts_check_interval:
+            return
+        ts_obj = self.db.get_by_name('__timestamp', entity_name, session)
+        ts = ts_obj.ts if ts_obj else None
+        if checked and checked[1] != ts:
+            self.invalidate_entity(entity_name)
+        self._timestamps[entity_name] = (now, ts)
+
+    @contextlib.contextmanager
+    def session(self):
+        with self.db.session() as session:
+            caching_session = CachingSession(session)
+            try:
+                yield caching_session
+            except:
+                self.invalidate(caching_session.read_keys)
+                self.invalidate(caching_session.written_keys)
+                raise
+        self.invalidate(caching_session.written_keys)
+
+    def get_by_name(self, entity_name, object_name, session):
+        if entity_name.startswith('__'):
+            # Never cache the system tables.
+            return self.db.get_by_name(entity_name, object_name,
+                                       session.session)
+        self._check_timestamp(entity_name, session.session)
+        key = (entity_name, object_name)
+        session.read_keys.add(key)
+        entry = self._cache_get(key)
+        if entry is not None:
+            obj, rev = entry
+            session.set_revision(key, rev)
+            return copy.deepcopy(obj)
+        obj = self.db.get_by_name(entity_name, object_name, session.session)
+        if obj is not None:
+            self._cache_put(key, obj, session.get_revision(key))
+        return obj
+
+    def get_many(self, entity_name, object_names, session):
+        if entity_name.startswith('__'):
+            return self.db.get_many(entity_name, object_names,
+                                    session.session)
+        self._check_timestamp(entity_name, session.session)
+        out = {}
+        missing = []
+        for object_name in object_names:
+            key = (entity_name, object_name)
+            session.read_keys.add(key)
+            entry = self._cache_get(key)
+            if entry is None:
+                missing.append(object_name)
+            else:
+                obj, rev = entry
+                out[object_name] = copy.deepcopy(obj)
+                session.set_revision(key, rev)
+        if missing:
+            found = self.db.get_many(entity_name, missing, session.session)
+            for object_name, obj in found.iteritems():
+                key = (entity_name, object_name)
+                self._cache_put(key, obj, session.get_revision(key))
+            out.update(found)
+        return out
+
+    def find(self, entity_name, query, session, *args, **kwargs):
+        return self.db.find(entity_name, query, session.session,
+                            *args, **kwargs)
+
+    def set_timestamp(self, entity_name, ts, session):
+        return self.db.set_timestamp(entity_name, ts, session.session)
+
+    def create(self, entity_name, attrs, session):
+        session.written_keys.add((entity_name, attrs.get('name')))
+        return self.db.create(entity_name, attrs, session.session)
+
+    def delete(self, entity_name, object_name, session):
+        key = (entity_name, object_name)
+        session.written_keys.add(key)
+        self.invalidate([key])
+        return self.db.delete(entity_name, object_name, session.session)
+
+    def add_change(self, entity_name, object_name, operation, session):
+        return self.db.add_change(entity_name, object_name, operation,
+                                  session.session)
+
+    def get_changes(self, since, entity_name, limit, session):
+        return self.db.get_changes(since, entity_name, limit,
+                                   session.session)
+
+    def get_changes_seq(self, session):
+        return self.db.get_changes_seq(session.session)
+
+    def add_audit(self, entity_name, object_name, operation,
+                  data, auth_ctx, session):
+        return self.db.add_audit(entity_name, object_name, operation,
+                                 data, auth_ctx, session.session)
+
+    def get_audit(self, query, session):
+        return self.db.get_audit(query, session.session)
@@ -6,6 +6,7 @@ import doozer
 from doozer.client import RevMismatch, NoEntity, BadPath
 
 from configdb import exceptions
+from configdb.db import slowlog
 from configdb.db.interface import base
 from configdb.db.interface import inmemory_interface
 
@@ -81,14 +82,16 @@ class DoozerSession(object):
             return None
         return self._deserialize_if_not_none(item.value)
 
-    def _find(self, entity_name):
+    def _find(self, entity_name, after=None, sort=False):
         path = self._mkpath(entity_name)
         try:
             folder = self.db.conn.getdir(path)
         except NoEntity:
             return
-        for entry in folder:
-            obj_name = entry.path.decode('hex')
+        names = [entry.path.decode('hex') for entry in folder]
+        if sort or after is not None:
+            names = self.db._sorted_names(names, after)
+        for obj_name in names:
             yield self._get(entity_name, obj_name)
 
     def commit(self):
@@ -108,7 +111,8 @@ class DoozerInterface(base.DbInterface):
     """
 
     def __init__(self, doozer_uri, schema, root='/configdb', timeout=30):
-        self.conn = doozer.connect(doozer_uri, timeout)
+        self.conn = slowlog.RoundTripCounter(
+            doozer.connect(doozer_uri, timeout))
         self.schema = schema
         self.root = root
 
@@ -124,10 +128,15 @@ class DoozerInterface(base.DbInterface):
     def get_by_name(self, entity_name, object_name, session):
         return session._get(entity_name, object_name)
 
-    def find(self, entity_name, query, session):
+    def find(self, entity_name, query, session, limit=None, after=None,
+             fields=None, acl_filter=None):
         entity = self.schema.get_entity(entity_name)
-        return self._run_query(entity, query,
-                               session._find(entity_name))
+        return self._paginate(
+            self._run_query(entity, query,
+                            session._find(entity_name, after,
+                                          sort=limit is not None),
+                            acl_filter),
+            limit)
 
     def create(self, entity_name, attrs, session):
         entity = self.schema.get_entity(entity_name)
@@ -11,6 +11,7 @@ import json
 import etcd
 
 from configdb import exceptions
+from configdb.db import slowlog
 from configdb.db.interface import base
 from configdb.db.interface import inmemory_interface
 
@@ -92,13 +93,50 @@ class EtcdSession(inmemory_interface.InMemorySession):
         except KeyError:
             pass
 
-    def _find(self, entity_name):
+    def _get_many(self, entity_name, obj_names):
+        obj_names = set(obj_names)
+        if len(obj_names) < 2:
+            out = {}
+            for obj_name in obj_names:
+                obj = self._get(entity_name, obj_name)
+                if obj is not None:
+                    out[obj_name] = obj
+            return out
+        # Fetch the whole entity with a single recursive read, and
+        # pick the objects we're interested in.
         path = self._mkpath(entity_name)
-        for r in self.db.conn.read(path, recursive = True).children:
-            if not r.dir:
-                curpath = r.key.replace(self.db.conn.key_endpoint,'')
+        try:
+            result = self.db.conn.read(path, recursive=True)
+        except KeyError:
+            return {}
+        out = {}
+        for r in result.children:
+            if r.dir:
+                continue
+            curpath = r.key.replace(self.db.conn.key_endpoint, '')
+            obj_name = self._unescape(os.path.basename(curpath))
+            if obj_name in obj_names:
                 self.revisions[curpath] = r.modifiedIndex
-                yield self._deserialize_if_not_none(r.value)
+                obj = self._deserialize_if_not_none(r.value)
+                if obj is not None:
+                    out[obj_name] = obj
+        return out
+
+    def _find(self, entity_name, after=None, sort=False):
+        path = self._mkpath(entity_name)
+        children = [r for r in self.db.conn.read(path, recursive = True).children
+                    if not r.dir]
+        if sort or after is not None:
+            # Sort the children on the (unescaped) object name.
+            by_name = dict(
+                (self._unescape(os.path.basename(r.key)), r)
+                for r in children)
+            children = [by_name[name]
+                        for name in self.db._sorted_names(by_name, after)]
+        for r in children:
+            curpath = r.key.replace(self.db.conn.key_endpoint,'')
+            self.revisions[curpath] = r.modifiedIndex
+            yield self._deserialize_if_not_none(r.value)
 
     def commit(self):
         pass
@@ -130,8 +168,8 @@ class EtcdInterface(base.DbInterface):
                 'Url {} is not in the host:port format'.format(p.netloc))
 
         #TODO: find a way to allow use of SSL client certificates.
-        self.conn = etcd.Client(
-            host=host, port=int(port), protocol = p.scheme, allow_reconnect = True)
+        self.conn = slowlog.RoundTripCounter(etcd.Client(
+            host=host, port=int(port), protocol = p.scheme, allow_reconnect = True))
 
 
     def _serialize(self, obj):
@@ -148,10 +186,18 @@ class EtcdInterface(base.DbInterface):
     def get_by_name(self, entity_name, object_name, session):
         return session._get(entity_name, object_name)
 
-    def find(self, entity_name, query, session):
+    def get_many(self, entity_name, object_names, session):
+        return session._get_many(entity_name, object_names)
+
+    def find(self, entity_name, query, session, limit=None, after=None,
+             fields=None, acl_filter=None):
         entity = self.schema.get_entity(entity_name)
-        return self._run_query(entity, query,
-                               session._find(entity_name))
+        return self._paginate(
+            self._run_query(entity, query,
+                            session._find(entity_name, after,
+                                          sort=limit is not None),
+                            acl_filter),
+            limit)
 
 
     def create(self, entity_name, attrs, session):
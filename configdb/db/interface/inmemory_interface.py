@@ -1,3 +1,5 @@
+import threading
+import time
 from collections import defaultdict
 from configdb import exceptions
 from configdb.db import schema
@@ -63,12 +65,26 @@ class InMemoryObject(object):
 
 class InMemorySession(object):
 
+    def __init__(self, db=None):
+        self.db = db
+        # Objects created or saved in this session, that must be
+        # indexed again at commit time (relations can be modified
+        # in-place after the object has been saved).
+        self._touched = {}
+
     def add(self, obj):
         # Does not handle renames.
-        pass
+        if self.db is not None:
+            # The object might be a copy (see CachingDbInterface).
+            self.db._entities[obj._entity_name][obj.name] = obj
+            self.db._index_obj(obj)
+            self._touched[(obj._entity_name, obj.name)] = obj
 
     def commit(self):
-        pass
+        if self.db is not None:
+            for obj in self._touched.itervalues():
+                self.db._index_obj(obj)
+            self._touched.clear()
 
     def rollback(self):
         pass
@@ -78,17 +94,115 @@ class InMemoryDbInterface(base.DbInterface):
     """Reference in-memory db implementation.
 
     Only useful for testing purposes.
+
+    Equality queries are answered using hash indexes, on the fields
+    marked with 'index' in the schema and on relations (mapping the
+    name of a related object to the names of the objects that refer to
+    it). Modified objects must be passed to session.add() to be
+    indexed again.
     """
 
     AUDIT_SUPPORT = True
+    CHANGES_SUPPORT = True
 
     def __init__(self, schema):
         self.schema = schema
         self._entities = defaultdict(dict)
         self._audit = []
+        # The sequence number of a change is its position in the list,
+        # plus one.
+        self._changes = []
+        self._changes_lock = threading.Lock()
+        # Indexes, by (entity name, field name): every index maps a
+        # value to the set of names of the objects having it.
+        self._indexes = {}
+        self._indexed_fields = defaultdict(list)
+        for entity in schema.get_entities():
+            for field in entity.fields.itervalues():
+                if field.name == 'name':
+                    # Objects are already stored by name.
+                    continue
+                if field.is_relation() or field.attrs.get('index'):
+                    self._indexes[(entity.name, field.name)] = \
+                        defaultdict(set)
+                    self._indexed_fields[entity.name].append(field.name)
+        # Index keys of every object, by (entity name, object name).
+        self._index_keys = {}
+        self._index_lock = threading.Lock()
 
     def session(self):
-        return base.session_context_manager(InMemorySession())
+        return base.session_context_manager(InMemorySession(self))
+
+    def _get_index_keys(self, entity_name, obj):
+        keys = {}
+        for field_name in self._indexed_fields.get(entity_name, ()):
+            value = getattr(obj, field_name, None)
+            if isinstance(value, InMemoryRelationProxy):
+                keys[field_name] = frozenset(value._objs)
+            else:
+                keys[field_name] = frozenset([value])
+        return keys
+
+    def _index_obj(self, obj):
+        """Update the indexes with the current values of 'obj'."""
+        entity_name = obj._entity_name
+        new_keys = self._get_index_keys(entity_name, obj)
+        if not new_keys:
+            return
+        with self._index_lock:
+            old_keys = self._index_keys.get((entity_name, obj.name), {})
+            for field_name, keys in new_keys.iteritems():
+                index = self._indexes[(entity_name, field_name)]
+                old = old_keys.get(field_name, frozenset())
+                for key in old - keys:
+                    self._index_discard(index, key, obj.name)
+                for key in keys - old:
+                    index[key].add(obj.name)
+            self._index_keys[(entity_name, obj.name)] = new_keys
+
+    def _unindex_obj(self, entity_name, object_name):
+        with self._index_lock:
+            old_keys = self._index_keys.pop((entity_name, object_name), {})
+            for field_name, keys in old_keys.iteritems():
+                index = self._indexes[(entity_name, field_name)]
+                for key in keys:
+                    self._index_discard(index, key, object_name)
+
+    def _index_discard(self, index, key, object_name):
+        names = index.get(key)
+        if names is not None:
+            names.discard(object_name)
+            if not names:
+                del index[key]
+
+    def _index_lookup(self, entity_name, query):
+        """Find the candidate results of a query with the indexes.
+
+        Returns the names of the objects that can match the most
+        selective equality criteria of 'query', or None if no index
+        can be used.
+        """
+        objs = self._entities[entity_name]
+        best = None
+        for field_name, q in query.iteritems():
+            if not isinstance(q, self.QUERY_TYPE_MAP['eq']):
+                continue
+            try:
+                if field_name == 'name':
+                    names = [q.target] if q.target in objs else []
+                elif (entity_name, field_name) in self._indexes:
+                    index = self._indexes[(entity_name, field_name)]
+                    with self._index_lock:
+                        names = list(index.get(q.target, ()))
+                else:
+                    continue
+            except TypeError:
+                # Unhashable values can't match anything stored in an
+                # index, let the query scan the objects.
+                continue
+            if best is None or len(names) < len(best):
+                best = names
+        return best
 
     def add_audit(self, entity_name, object_name, operation,
                   data, auth_ctx, session):
@@ -98,19 +212,63 @@ class InMemoryDbInterface(base.DbInterface):
         # FIXME: apply the query.
         return self._audit
 
+    def add_change(self, entity_name, object_name, operation, session):
+        with self._changes_lock:
+            self._changes.append({'seq': len(self._changes) + 1,
+                                  'entity': entity_name,
+                                  'name': object_name,
+                                  'op': operation,
+                                  'stamp': time.time()})
+
+    def get_changes(self, since, entity_name, limit, session):
+        out = []
+        for change in self._changes[max(since, 0):]:
+            if entity_name and change['entity'] != entity_name:
+                continue
+            out.append(dict(change))
+            if limit and len(out) >= limit:
+                break
+        return out
+
+    def get_changes_seq(self, session):
+        return len(self._changes)
+
     def get_by_name(self, entity_name, object_name, session):
         return self._entities[entity_name].get(object_name, None)
 
+    def get_many(self, entity_name, object_names, session):
+        objs = self._entities[entity_name]
+        return dict((name, objs[name]) for name in object_names
+                    if name in objs)
+
     def create(self, entity_name, attrs, session):
         entity = self.schema.get_entity(entity_name)
         obj = InMemoryObject(entity, attrs)
         self._entities[entity_name][obj.name] = obj
+        session.add(obj)
         return obj
 
     def delete(self, entity_name, object_name, session):
         self._entities[entity_name].pop(object_name)
+        self._unindex_obj(entity_name, object_name)
+        session._touched.pop((entity_name, object_name), None)
 
-    def find(self, entity_name, query, session):
+    def find(self, entity_name, query, session, limit=None, after=None,
+             fields=None, acl_filter=None):
         entity = self.schema.get_entity(entity_name)
-        return self._run_query(entity, query,
-                               self._entities[entity_name].itervalues())
+        objs = self._entities[entity_name]
+        names = self._index_lookup(entity_name, query)
+        if names is None:
+            if limit is None and after is None:
+                items = objs.itervalues()
+            else:
+                items = (objs[name]
+                         for name in self._sorted_names(objs.keys(), after))
+        else:
+            if limit is not None or after is not None:
+                names = self._sorted_names(names, after)
+            # Objects might have been deleted in the meantime.
+            items = (obj for obj in (objs.get(name) for name in names)
+                     if obj is not None)
+        return self._paginate(self._run_query(entity, query, items,
+                                               acl_filter), limit)
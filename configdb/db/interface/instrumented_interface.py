@@ -0,0 +1,64 @@
+import contextlib
+import functools
+import time
+
+
+class InstrumentedDbInterface(object):
+    """Measure the calls to any DbInterface.
+
+    Wraps another database interface, calling observe_fn(method,
+    duration) for every call to one of the standard DbInterface
+    methods. When a method returns an iterator, the time spent
+    consuming it is accounted for too, and the call is reported once
+    the iterator has been exhausted or discarded. Everything else is
+    passed through to the wrapped interface.
+    """
+
+    METHODS = ('get_by_name', 'get_many', 'find', 'create', 'delete',
+               'set_timestamp', 'add_audit', 'get_audit', 'add_change',
+               'get_changes', 'get_changes_seq')
+
+    def __init__(self, db, observe_fn):
+        self.db = db
+        self.observe_fn = observe_fn
+        for method in self.METHODS:
+            setattr(self, method, self._instrument(method))
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def _timed_iter(self, method, start, elapsed, result):
+        try:
+            for item in result:
+                elapsed += time.time() - start
+                yield item
+                start = time.time()
+            elapsed += time.time() - start
+        finally:
+            self.observe_fn(method, elapsed)
+
+    def _instrument(self, method):
+        fn = getattr(self.db, method)
+
+        @functools.wraps(fn)
+        def _instrumented(*args, **kwargs):
+            start = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                self.observe_fn(method, time.time() - start)
+                raise
+            if hasattr(result, 'next'):
+                return self._timed_iter(method, time.time(),
+                                        time.time() - start, result)
+            self.observe_fn(method, time.time() - start)
+            return result
+        return _instrumented
+
+    @contextlib.contextmanager
+    def session(self):
+        with self.db.session() as session:
+            yield session
+            # Measure the time spent committing the transaction.
+            start = time.time()
+        self.observe_fn('commit', time.time() - start)
@@ -1,9 +1,12 @@
 import json
 import leveldb
+import threading
+import time
 import cPickle as pickle
 
 from configdb import exceptions
 from configdb.db import schema
+from configdb.db import slowlog
 from configdb.db.interface import base
 from configdb.db.interface import inmemory_interface
 
@@ -15,19 +18,40 @@ class LevelDbSession(object):
     def __init__(self, db):
         self._db = db
         self._batch = leveldb.WriteBatch()
+        # Objects written in this session, so that they are visible
+        # to later reads before the batch is committed.
+        self._pending = {}
+        self._changes = []
 
     def _key_for_obj(self, obj):
         return self._db._key(obj._entity_name, obj.name)
 
     def add(self, obj):
-        self._batch.Put(self._key_for_obj(obj),
-                        self._db._serialize(obj))
+        key = self._key_for_obj(obj)
+        self._batch.Put(key, self._db._serialize(obj))
+        self._pending[key] = obj
 
     def delete(self, obj):
-        self._batch.Delete(self._key_for_obj(obj))
+        key = self._key_for_obj(obj)
+        self._batch.Delete(key)
+        self._pending[key] = None
+
+    def add_change(self, change):
+        self._changes.append(change)
 
     def commit(self):
-        self._db.db.Write(self._batch, sync=True)
+        if not self._changes:
+            self._db.db.Write(self._batch, sync=True)
+            return
+        # Sequence numbers are assigned at commit time, so that they
+        # are written in order.
+        with self._db._changes_lock:
+            for change in self._changes:
+                self._db._last_seq += 1
+                change['seq'] = self._db._last_seq
+                self._batch.Put(self._db._change_key(change['seq']),
+                                json.dumps(change))
+            self._db.db.Write(self._batch, sync=True)
 
     def rollback(self):
         if hasattr(self, '_batch'):
@@ -45,9 +69,26 @@ class LevelDbInterface(base.DbInterface):
     is done using the 'pickle' module.
     """
 
+    CHANGES_SUPPORT = True
+
+    # Prefix of the keys of the change log entries.
+    CHANGES_PREFIX = '__changes:'
+
     def __init__(self, path, schema, **kwargs):
-        self.db = leveldb.LevelDB(path, **kwargs)
+        self.db = slowlog.RoundTripCounter(leveldb.LevelDB(path, **kwargs))
         self.schema = schema
+        # LevelDB databases can only be opened by a single process,
+        # so the next sequence number can be kept in memory.
+        self._changes_lock = threading.Lock()
+        self._last_seq = 0
+        for key in self.db.RangeIter(self.CHANGES_PREFIX,
+                                     self.CHANGES_PREFIX + '\xff',
+                                     include_value=False, reverse=True):
+            self._last_seq = int(key[len(self.CHANGES_PREFIX):])
+            break
+
+    def _change_key(self, seq):
+        return '%s%020d' % (self.CHANGES_PREFIX, seq)
 
     def _key(self, entity_name, object_name):
         return '%s:%s' % (entity_name, object_name)
@@ -62,22 +103,74 @@ class LevelDbInterface(base.DbInterface):
         return base.session_context_manager(LevelDbSession(self))
 
     def get_by_name(self, entity_name, object_name, session):
+        key = self._key(entity_name, object_name)
+        if key in session._pending:
+            return session._pending[key]
         try:
-            return self._deserialize(
-                self.db.Get(self._key(entity_name, object_name)))
+            return self._deserialize(self.db.Get(key))
         except KeyError:
             return None
 
-    def _find_all(self, entity_name):
+    def get_many(self, entity_name, object_names, session):
+        # Read from a snapshot, for a consistent view of all objects.
+        snapshot = self.db.CreateSnapshot()
+        out = {}
+        for object_name in object_names:
+            key = self._key(entity_name, object_name)
+            if key in session._pending:
+                obj = session._pending[key]
+            else:
+                try:
+                    obj = self._deserialize(snapshot.Get(key))
+                except KeyError:
+                    obj = None
+            if obj is not None:
+                out[object_name] = obj
+        return out
+
+    def _find_all(self, entity_name, after=None):
+        # Keys are sorted, so results come out ordered by name. When
+        # paginating, start the scan from the last key seen.
         final = entity_name.encode('utf-8') + '\xff'
-        cursor = self.db.RangeIter(u'%s:' % entity_name, final)
+        if after is None:
+            start = u'%s:' % entity_name
+        else:
+            start = self._key(entity_name, after)
+            if isinstance(start, unicode):
+                start = start.encode('utf-8')
+        cursor = self.db.RangeIter(start, final)
         for key, serialized_data in cursor:
+            if after is not None and key == start:
+                continue
             yield self._deserialize(serialized_data)
 
-    def find(self, entity_name, query, session):
+    def find(self, entity_name, query, session, limit=None, after=None,
+             fields=None, acl_filter=None):
         entity = self.schema.get_entity(entity_name)
-        return self._run_query(entity, query,
-                               self._find_all(entity_name))
+        return self._paginate(
+            self._run_query(entity, query,
+                            self._find_all(entity_name, after),
+                            acl_filter),
+            limit)
+
+    def add_change(self, entity_name, object_name, operation, session):
+        session.add_change({'entity': entity_name, 'name': object_name,
+                            'op': operation, 'stamp': time.time()})
+
+    def get_changes(self, since, entity_name, limit, session):
+        out = []
+        for key, value in self.db.RangeIter(
+                self._change_key(max(since, 0) + 1), self.CHANGES_PREFIX + '\xff'):
+            change = json.loads(value)
+            if entity_name and change['entity'] != entity_name:
+                continue
+            out.append(change)
+            if limit and len(out) >= limit:
+                break
+        return out
+
+    def get_changes_seq(self, session):
+        return self._last_seq
 
     def create(self, entity_name, attrs, session):
         entity = self.schema.get_entity(entity_name)
@@ -21,6 +21,21 @@ audit_table = Table('_audit', Base.metadata,
     Column('data', UnicodeText()))
 """
 
+    def _changes_table_def(self):
+        return """
+changes_table = Table('_changes', Base.metadata,
+    Column('seq', Integer, primary_key=True),
+    Column('entity', String(64), index=True),
+    Column('object', String(64)),
+    Column('op', String(8)),
+    Column('stamp', Float()))
+
+# Single row holding the last allocated change sequence number.
+changes_seq_table = Table('_changes_seq', Base.metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('seq', Integer, nullable=False))
+"""
+
     def _sa_entity_def(self, entity):
         cols = []
         for field in entity.fields.itervalues():
@@ -116,7 +131,8 @@ class %(class_name)s(Base):
         out = ['from sqlalchemy import *',
                'from sqlalchemy.orm import *',
                'from datetime import datetime',
-               self._audit_table_def()]
+               self._audit_table_def(),
+               self._changes_table_def()]
         for ent in self.schema.get_entities():
             out.append(self._sa_entity_aux_tables(ent))
             out.append(self._sa_entity_def(ent))
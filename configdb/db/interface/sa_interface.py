@@ -1,12 +1,15 @@
 import json
 import os
 import tempfile
+import time
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, false, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, defer, noload, subqueryload
 from sqlalchemy.ext.declarative import declarative_base
 
 from configdb import exceptions
+from configdb.db import slowlog
 from configdb.db.interface import base
 from configdb.db.interface import sa_generator
 
@@ -43,6 +46,9 @@ class SqlAlchemyDbInterface(base.DbInterface):
             })
 
     AUDIT_SUPPORT = True
+    CHANGES_SUPPORT = True
+
+    GET_MANY_CHUNK_SIZE = 500
 
     def __init__(self, uri, schema, schema_dir=None, opts={}):
         self.Session = sessionmaker(autocommit=False, autoflush=False)
@@ -54,8 +60,30 @@ class SqlAlchemyDbInterface(base.DbInterface):
         self._load_schema()
 
         self.engine = create_engine(uri, pool_recycle=1800, **opts)
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._count_round_trip)
         self.Session.configure(bind=self.engine)
         Base.metadata.create_all(self.engine)
+        self._init_changes_seq()
+
+    def _init_changes_seq(self):
+        """Create the row of the change sequence counter, if missing."""
+        seq_table = self._objs['changes_seq_table']
+        changes_table = self._objs['changes_table']
+        try:
+            with self.session() as session:
+                if session.execute(select([seq_table.c.seq]).where(
+                        seq_table.c.id == 1)).scalar() is None:
+                    last_seq = session.execute(
+                        select([func.max(changes_table.c.seq)])).scalar()
+                    session.execute(seq_table.insert(),
+                                    {'id': 1, 'seq': last_seq or 0})
+        except IntegrityError:
+            # Created by another process in the meantime.
+            pass
+
+    def _count_round_trip(self, *args):
+        slowlog.count_round_trips()
 
     def _load_schema(self):
         with tempfile.NamedTemporaryFile() as schema_file:
@@ -93,14 +121,90 @@ class SqlAlchemyDbInterface(base.DbInterface):
         return session.execute(
             audit_table.select().where(sql_query).order_by('stamp desc'))
 
+    def add_change(self, entity_name, object_name, operation, session):
+        # Incrementing the counter locks its row until the end of the
+        # transaction, so that concurrent writers get their sequence
+        # numbers in commit order: readers of the change log can't
+        # see a change before one with a lower number is committed.
+        seq_table = self._objs['changes_seq_table']
+        session.execute(seq_table.update().where(seq_table.c.id == 1).values(
+                seq=seq_table.c.seq + 1))
+        seq = session.execute(select([seq_table.c.seq]).where(
+                seq_table.c.id == 1)).scalar()
+        session.execute(self._objs['changes_table'].insert(),
+                        {'seq': seq,
+                         'entity': entity_name,
+                         'object': object_name,
+                         'op': operation,
+                         'stamp': time.time()})
+
+    def get_changes(self, since, entity_name, limit, session):
+        changes_table = self._objs['changes_table']
+        sql_query = changes_table.select().where(changes_table.c.seq > since)
+        if entity_name:
+            sql_query = sql_query.where(changes_table.c.entity == entity_name)
+        sql_query = sql_query.order_by(changes_table.c.seq)
+        if limit:
+            sql_query = sql_query.limit(limit)
+        return [{'seq': x.seq, 'entity': x.entity, 'name': x.object,
+                 'op': x.op, 'stamp': x.stamp}
+                for x in session.execute(sql_query)]
+
+    def get_changes_seq(self, session):
+        changes_table = self._objs['changes_table']
+        return session.execute(
+            select([func.max(changes_table.c.seq)])).scalar() or 0
+
     def get_by_name(self, entity_name, object_name, session):
         return session.query(self._get_class(entity_name)).filter_by(
             name=object_name).first()
 
-    def find(self, entity_name, query, session):
+    def detach(self, obj, session):
+        # Keep the loaded attributes, which would otherwise be expired
+        # when the session is committed.
+        session.expunge(obj)
+
+    def get_many(self, entity_name, object_names, session):
+        classobj = self._get_class(entity_name)
+        object_names = list(object_names)
+        out = {}
+        # Split the query in chunks, to keep the IN clause reasonably sized.
+        for i in xrange(0, len(object_names), self.GET_MANY_CHUNK_SIZE):
+            chunk = object_names[i:i + self.GET_MANY_CHUNK_SIZE]
+            for obj in session.query(classobj).filter(
+                    classobj.name.in_(chunk)):
+                out[obj.name] = obj
+        return out
+
+    def _projection_options(self, entity, fields):
+        """Loader options to fetch only the specified fields.
+
+        Columns that were not requested are deferred, and relations
+        are not loaded at all. The requested relations are loaded
+        with a single extra query, rather than once per object.
+        """
+        options = []
+        for field in entity.fields.itervalues():
+            if field.name == 'name':
+                continue
+            if field.is_relation():
+                if field.name in fields:
+                    options.append(subqueryload(field.name))
+                else:
+                    options.append(noload(field.name))
+            elif field.name not in fields:
+                options.append(defer(field.name))
+        return options
+
+    def find(self, entity_name, query, session, limit=None, after=None,
+             fields=None, acl_filter=None):
         classobj = self._get_class(entity_name)
         entity = self._schema.get_entity(entity_name)
         sa_query = session.query(classobj)
+        if fields is not None:
+            # Fields used in the query are needed for post-processing.
+            sa_query = sa_query.options(*self._projection_options(
+                    entity, set(fields) | set(query.keys())))
 
         # Assemble the SQL query.  The query is split between
         # SQL-compatible criteria, and postprocessed criteria (which
@@ -120,12 +224,62 @@ class SqlAlchemyDbInterface(base.DbInterface):
                     classattr = getattr(classobj, field_name)
                     sa_query = sa_query.filter(q.get_filter(classattr))
 
+        # Translate the ACL filter to SQL, unless it has rules that
+        # can only be checked by post-processing.
+        if acl_filter is not None and not acl_filter.other_rules:
+            sa_query = sa_query.filter(
+                self._acl_filter_clause(entity, classobj, acl_filter))
+            acl_filter = None
+
+        # Keyset pagination. The limit can only be pushed down to the
+        # database if there are no post-processed criteria.
+        if limit is not None or after is not None:
+            sa_query = sa_query.order_by(classobj.name)
+            if after is not None:
+                sa_query = sa_query.filter(classobj.name > after)
+            if limit is not None and not pp_query and acl_filter is None:
+                sa_query = sa_query.limit(limit)
+
         # Apply the post-process query to the SQL results.
-        return self._run_query(entity, pp_query, sa_query)
+        return self._paginate(self._run_query(entity, pp_query, sa_query,
+                                              acl_filter),
+                              limit)
+
+    def _acl_filter_clause(self, entity, classobj, acl_filter):
+        """Build the SQL criteria matching the rows of an ACL filter.
+
+        The '@self' rule compares the object name, relation rules
+        become an EXISTS subquery on the association table.
+        """
+        clauses = []
+        if acl_filter.match_self:
+            clauses.append(classobj.name == acl_filter.self_name)
+        for attr in acl_filter.rel_attrs:
+            field = entity.fields.get(attr)
+            if field is None or not field.is_relation():
+                continue
+            remote_cls = self._get_class(field.remote_name)
+            clauses.append(getattr(classobj, attr).any(
+                    remote_cls.name == acl_filter.self_name))
+        if not clauses:
+            return false()
+        return or_(*clauses)
 
     def delete(self, entity_name, object_name, session):
         session.delete(self.get_by_name(entity_name, object_name, session))
 
+    def set_timestamp(self, entity_name, ts, session):
+        # A single conditional UPDATE, so that the row is only locked
+        # when the timestamp actually needs to be raised.
+        classobj = self._get_class('__timestamp')
+        updated = session.query(classobj).filter(
+            classobj.name == entity_name, classobj.ts < ts).update(
+            {'ts': ts}, synchronize_session='evaluate')
+        if not updated and not session.query(classobj.name).filter(
+                classobj.name == entity_name).first():
+            self.create('__timestamp', {'name': entity_name, 'ts': ts},
+                        session)
+
     def create(self, entity_name, attrs, session):
         obj = self._get_class(entity_name)()
         entity = self._schema.get_entity(entity_name)
@@ -133,10 +287,12 @@ class SqlAlchemyDbInterface(base.DbInterface):
             field = entity.fields[k]
             if field.is_relation():
                 rel_attr = getattr(obj, k)
-                for lv in v:
-                    rel_obj = self.get_by_name(
-                        field.remote_name, lv, session)
-                    rel_attr.append(rel_obj)
+                rel_objs = self.get_many(field.remote_name, v or [], session)
+                for lv in v or []:
+                    if lv not in rel_objs:
+                        raise exceptions.RelationError(
+                            'no such object, %s=%s' % (field.remote_name, lv))
+                    rel_attr.append(rel_objs[lv])
             else:
                 setattr(obj, k, v)
         session.add(obj)
@@ -6,6 +6,7 @@ import kazoo.client
 import kazoo.exceptions
 
 from configdb import exceptions
+from configdb.db import slowlog
 from configdb.db.interface import base
 from configdb.db.interface import inmemory_interface
 
@@ -75,10 +76,33 @@ class ZookeeperSession(object):
             return None
         return self._deserialize_if_not_none(data)
 
-    def _find(self, entity_name):
+    def _get_many(self, entity_name, obj_names):
+        # Issue all the requests at once, then wait for the results.
+        pending = []
+        for obj_name in obj_names:
+            path = self._mkpath(entity_name, obj_name)
+            pending.append((obj_name, path, self.db.conn.get_async(path)))
+        out = {}
+        for obj_name, path, async_result in pending:
+            try:
+                data, stat = async_result.get()
+            except kazoo.exceptions.NoNodeException:
+                continue
+            self.revisions.setdefault(path, stat.version)
+            obj = self._deserialize_if_not_none(data)
+            if obj is not None:
+                out[obj_name] = obj
+        return out
+
+    def _find(self, entity_name, after=None, sort=False):
         path = self._mkpath(entity_name)
-        for name in self.db.conn.get_children(path):
-            yield self._get(entity_name, self._unescape(name))
+        names = [self._unescape(x) for x in self.db.conn.get_children(path)]
+        if sort or after is not None:
+            names = self.db._sorted_names(names, after)
+        # Objects are fetched lazily, so that a paginated find only
+        # reads the nodes it needs.
+        for name in names:
+            yield self._get(entity_name, name)
 
     def commit(self):
         pass
@@ -97,7 +121,8 @@ class ZookeeperInterface(base.DbInterface):
     """
 
     def __init__(self, hosts, schema, root, timeout=30):
-        self.conn = kazoo.client.KazooClient(hosts, timeout=timeout)
+        self.conn = slowlog.RoundTripCounter(
+            kazoo.client.KazooClient(hosts, timeout=timeout))
         self.conn.start()
         self.schema = schema
         self.root = root
@@ -114,10 +139,18 @@ class ZookeeperInterface(base.DbInterface):
     def get_by_name(self, entity_name, object_name, session):
         return session._get(entity_name, object_name)
 
-    def find(self, entity_name, query, session):
+    def get_many(self, entity_name, object_names, session):
+        return session._get_many(entity_name, object_names)
+
+    def find(self, entity_name, query, session, limit=None, after=None,
+             fields=None, acl_filter=None):
         entity = self.schema.get_entity(entity_name)
-        return self._run_query(entity, query,
-                               session._find(entity_name))
+        return self._paginate(
+            self._run_query(entity, query,
+                            session._find(entity_name, after,
+                                          sort=limit is not None),
+                            acl_filter),
+            limit)
 
     def create(self, entity_name, attrs, session):
         entity = self.schema.get_entity(entity_name)
@@ -1,4 +1,6 @@
+import datetime
 import json
+import keyword
 import re
 from dateutil import parser as dateutil_parser
 from configdb import exceptions
@@ -47,6 +49,28 @@ class BoolField(Field):
         Field.__init__(self, entity, name, attrs)
 
 
+# The formats produced by datetime.isoformat() for naive datetimes.
+ISO_DATETIME_PATTERN = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{6}))?$')
+
+
+def parse_datetime(value):
+    """Decode a timestamp.
+
+    The ISO 8601 formats emitted by DateTimeField.to_net() are decoded
+    directly, anything else is handed to the (much slower) dateutil
+    parser.
+    """
+    if isinstance(value, basestring):
+        m = ISO_DATETIME_PATTERN.match(value)
+        if m:
+            try:
+                return datetime.datetime(*map(int, m.groups(0)))
+            except ValueError:
+                pass
+    return dateutil_parser.parse(value)
+
+
 class DateTimeField(Field):
 
     def to_net(self, value):
@@ -55,7 +79,7 @@ class DateTimeField(Field):
 
     def from_net(self, value):
         if value:
-            return dateutil_parser.parse(value)
+            return parse_datetime(value)
 
 
 class Relation(Field):
@@ -137,23 +161,211 @@ class Entity(acl.AclMixin):
                     'invalid field name "%s"' % name)
         if 'name' not in self.fields:
             raise exceptions.SchemaError('missing required "name" field')
-
-    def to_net(self, item, ignore_missing=False):
-        if isinstance(item, dict):
-            attr_getter = lambda x, y: x.get(y)
-        else:
-            attr_getter = getattr
-        return dict(
-            (field.name, field.to_net(
-                    attr_getter(item, field.name)))
-            for field in self.fields.itervalues()
-            if not (ignore_missing and attr_getter(item, field.name) is None))
+        self._compile()
+
+    def _compile(self):
+        """Build the validation plan used by unpack().
+
+        The plan is a list of (name, converter, validator) tuples, one
+        per field, where 'converter' is the field's from_net() method
+        (None if it does nothing) and 'validator' is the function
+        validating non-empty values (None if there is no validator).
+        """
+        self.field_names = frozenset(self.fields)
+        self._plan = []
+        self._net_converters = {}
+        for field in self.fields.itervalues():
+            converter = field.from_net
+            if getattr(converter, 'im_func', None) is Field.to_net.im_func:
+                converter = None
+            self._plan.append((field.name, converter,
+                               field.compile_validator()))
+            converter = field.to_net
+            if getattr(converter, 'im_func', None) is Field.to_net.im_func:
+                converter = None
+            self._net_converters[field.name] = converter
+        self._to_net_object = self._make_serializer(False)
+        self._to_net_dict = self._make_serializer(True)
+
+    def _make_serializer(self, dict_input):
+        """Generate a function serializing all the fields of an item.
+
+        The function builds the result with a single dictionary
+        expression, calling the to_net() method only of those fields
+        that need a conversion. If 'dict_input' is True, the function
+        works on dictionaries, otherwise on objects.
+        """
+        namespace = {}
+        items = []
+        for name, converter in sorted(self._net_converters.iteritems()):
+            if dict_input:
+                expr = 'item.get(%r)' % str(name)
+            elif keyword.iskeyword(name):
+                expr = 'getattr(item, %r)' % str(name)
+            else:
+                expr = 'item.%s' % name
+            if converter:
+                namespace['_to_net_%s' % name] = converter
+                expr = '_to_net_%s(%s)' % (name, expr)
+            items.append('%r: %s' % (str(name), expr))
+        code = 'def _to_net(item):\n    return {%s}\n' % ', '.join(items)
+        exec code in namespace
+        return namespace['_to_net']
+
+    def to_net(self, item, ignore_missing=False, fields=None):
+        """Serialize an object.
+
+        If 'fields' is specified, only those fields will be
+        included in the result. Items can be objects or dictionaries.
+        The common case of serializing all the fields goes through
+        the functions generated by _make_serializer().
+        """
+        is_dict = isinstance(item, dict)
+        if fields is None and not ignore_missing:
+            if is_dict:
+                return self._to_net_dict(item)
+            return self._to_net_object(item)
+
+        if fields is None:
+            fields = self._net_converters.iterkeys()
+        out = {}
+        for name in fields:
+            if name not in self._net_converters:
+                continue
+            value = item.get(name) if is_dict else getattr(item, name)
+            if ignore_missing and value is None:
+                continue
+            converter = self._net_converters[name]
+            out[name] = converter(value) if converter else value
+        return out
 
     def from_net(self, data):
-        return dict(
-            (field.name, field.from_net(data[field.name]))
-            for field in self.fields.itervalues()
-            if field.name in data)
+        out = {}
+        for name, converter, unused in self._plan:
+            if name in data:
+                value = data[name]
+                out[name] = converter(value) if converter else value
+        return out
+
+    def from_net_many(self, items):
+        """Deserialize a list of objects.
+
+        Equivalent to calling from_net() on every item, but converted
+        values are shared across the batch: every distinct timestamp,
+        for instance, is only decoded once.
+        """
+        plain = []
+        converted = []
+        for name, converter, unused in self._plan:
+            if converter:
+                converted.append((name, converter, {}))
+            else:
+                plain.append(name)
+        results = []
+        for data in items:
+            out = {}
+            for name in plain:
+                if name in data:
+                    out[name] = data[name]
+            for name, converter, memo in converted:
+                if name in data:
+                    value = data[name]
+                    try:
+                        result = memo.get(value)
+                    except TypeError:
+                        # Unhashable value.
+                        out[name] = converter(value)
+                        continue
+                    if result is None:
+                        result = memo[value] = converter(value)
+                    out[name] = result
+            results.append(out)
+        return results
+
+    def unpack(self, data, validation_fn=None):
+        """Deserialize and validate input data, in a single pass.
+
+        Unknown fields are rejected. If 'validation_fn' is specified,
+        it is called as validation_fn(field, value) instead of the
+        field validator (used to parse query specifications).
+
+        Raises:
+          exceptions.ValidationError
+        """
+        extra_fields = [x for x in data if x not in self.field_names]
+        if extra_fields:
+            raise exceptions.ValidationError(
+                'Unknown extra fields for "%s": %s' % (
+                    self.name, ', '.join(extra_fields)))
+
+        out = {}
+        errors = []
+        for name, converter, validator in self._plan:
+            if name not in data:
+                continue
+            value = data[name]
+            if converter:
+                try:
+                    value = converter(value)
+                except (ValueError, TypeError), e:
+                    raise exceptions.ValidationError(
+                        'Validation error in deserialization: %s' % str(e))
+            try:
+                if validation_fn:
+                    value = validation_fn(self.fields[name], value)
+                elif validator and value:
+                    value = validator(value)
+            except validation.Invalid, e:
+                errors.append('%s: %s' % (name, e))
+                continue
+            out[name] = value
+
+        # If there have been any errors, raise a ValidationError.
+        if errors:
+            raise exceptions.ValidationError(
+                'Validation error for "%s": %s' % (
+                    self.name, ', '.join(errors)))
+        return out
+
+
+def _find_cycles(deps):
+    """Return the strongly connected components of a dependency graph.
+
+    'deps' maps every node to the set of nodes it depends on. Uses
+    Tarjan's algorithm, and only returns the components made of more
+    than one node (as sets), i.e. those containing a cycle.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+
+    def _visit(node):
+        index[node] = lowlink[node] = len(index)
+        stack.append(node)
+        on_stack.add(node)
+        for dep in sorted(deps[node]):
+            if dep not in index:
+                _visit(dep)
+                lowlink[node] = min(lowlink[node], lowlink[dep])
+            elif dep in on_stack:
+                lowlink[node] = min(lowlink[node], index[dep])
+        if lowlink[node] == index[node]:
+            component = set()
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.add(member)
+                if member == node:
+                    break
+            if len(component) > 1:
+                cycles.append(component)
+
+    for node in sorted(deps):
+        if node not in index:
+            _visit(node)
+    return cycles
 
 
 class Schema(object):
@@ -177,6 +389,7 @@ class Schema(object):
         self._relation_check()
         self.default_acl = acl.AclMixin()
         self.default_acl.set_acl(DEFAULT_ACL)
+        self._compile_acls()
 
     def _add_timestamp(self):
         ts_schema = {'name': {'type': 'string', 'size': 32},
@@ -202,18 +415,50 @@ class Schema(object):
     def get_entities(self):
         return self.entities.itervalues()
 
+    def _compile_acls(self):
+        """Resolve the ACL decision functions of entities and fields.
+
+        Entities without an ACL use the default one, fields without
+        an ACL use the one of their entity.
+        """
+        self._entity_acls = {}
+        self._field_acls = {}
+        for entity in self.entities.itervalues():
+            acl_src = entity if entity.has_acl() else self.default_acl
+            for op in ('r', 'w'):
+                self._entity_acls[entity.name, op] = acl_src.get_acl_fn(op)
+                self._field_acls[entity.name, op] = dict(
+                    (field.name, field.get_acl_fn(op))
+                    for field in entity.fields.itervalues()
+                    if field.has_acl())
+
+    def _acl_decide(self, auth_context, key, acl_fn, obj):
+        """Run an ACL decision function, memoized in the auth context."""
+        fn, uses_obj = acl_fn
+        if uses_obj:
+            key += (obj.name if obj else None,)
+        memo = auth_context.acl_memo
+        try:
+            return memo[key]
+        except KeyError:
+            result = memo[key] = fn(auth_context, obj)
+            return result
+
     def acl_check_fields(self, entity, fields, auth_context, op, obj):
         """Authorize an operation on the fields of an instance."""
-        base_acl_check = (
-            entity.acl_check(auth_context, op, obj)
-            if entity.has_acl()
-            else self.default_acl.acl_check(auth_context, op, obj))
+        field_acls = self._field_acls[entity.name, op]
+        base_acl_check = None
         for field_name in fields:
-            field = entity.fields[field_name]
-            acl_check = (
-                field.acl_check(auth_context, op, obj)
-                if field.has_acl()
-                else base_acl_check)
+            if field_name in field_acls:
+                acl_check = self._acl_decide(
+                    auth_context, (entity.name, field_name, op),
+                    field_acls[field_name], obj)
+            else:
+                if base_acl_check is None:
+                    base_acl_check = self._acl_decide(
+                        auth_context, (entity.name, None, op),
+                        self._entity_acls[entity.name, op], obj)
+                acl_check = base_acl_check
             if not acl_check:
                 raise exceptions.AclError(
                     'unauthorized change to %s.%s' % (
@@ -221,29 +466,94 @@ class Schema(object):
 
     def acl_check_entity(self, entity, auth_context, op, obj):
         """Authorize an operation on an entity."""
-        acl_check = (
-            entity.acl_check(auth_context, op, obj)
-            if entity.has_acl()
-            else self.default_acl.acl_check(auth_context, op, obj))
-        if not acl_check:
+        if not self._acl_decide(auth_context, (entity.name, None, op),
+                                self._entity_acls[entity.name, op], obj):
             raise exceptions.AclError(
                 'unauthorized change to %s' % (
                     entity.name,))
 
-    def get_dependency_sequence(self):
-        sequence = []
-        #create a copy of the entities dict.
-        num = len(self.entities)
-        while len(sequence) < num:
-            for entity in self.entities.itervalues():
-                if entity.name in sequence:
+    def get_row_filter(self, entity, auth_context, op='r'):
+        """Return the filter on the objects an operation is allowed on.
+
+        Returns None if the operation is allowed on all the objects
+        of the entity, or an acl.RowFilter. Raises AclError if it is
+        not allowed on any object.
+        """
+        acl_src = entity if entity.has_acl() else self.default_acl
+        row_filter = acl.make_row_filter(acl_src.get_acl_rules(op),
+                                         auth_context)
+        if row_filter is False:
+            raise exceptions.AclError(
+                'unauthorized change to %s' % (
+                    entity.name,))
+        return row_filter
+
+    def get_dependency_levels(self):
+        """Sort the entities so that they come after those they refer to.
+
+        Returns a (levels, deferred) tuple. 'levels' is a list of
+        lists of entity names: the entities in a level only refer to
+        entities in the previous levels, so they can be processed in
+        parallel. Relations that can't be satisfied this way, because
+        of cycles (including entities that relate to themselves), are
+        returned in 'deferred', a dictionary of relation field names
+        by entity name: those fields should be set in a second pass,
+        once all the objects exist.
+        """
+        deps = {}
+        deferred = {}
+        for entity in self.entities.itervalues():
+            deps[entity.name] = set()
+            for field in entity.fields.itervalues():
+                if not field.is_relation():
                     continue
-                valid = True
-                for (name, field) in entity.fields.iteritems():
-                    if field.is_relation() and field.remote_name not in sequence:
-                        # We have a relation which is still not rolled out.
-                        valid = False
-                        break
-                if valid:
-                    sequence.append(entity.name)
-        return sequence
+                if field.remote_name == entity.name:
+                    deferred.setdefault(entity.name, []).append(field.name)
+                else:
+                    deps[entity.name].add(field.remote_name)
+
+        # Break the cycles: in every strongly connected component,
+        # pick the entity with the fewest dependencies within the
+        # component, and defer its relations pointing to it. Repeat
+        # until no component is left, as the rest of the original
+        # component might still contain cycles.
+        cycles = _find_cycles(deps)
+        while cycles:
+            for component in cycles:
+                name = min(component,
+                           key=lambda x: (len(deps[x] & component), x))
+                entity = self.entities[name]
+                for field in entity.fields.itervalues():
+                    if (field.is_relation()
+                            and field.remote_name in component
+                            and field.remote_name in deps[name]):
+                        deferred.setdefault(name, []).append(field.name)
+                deps[name] -= component
+            cycles = _find_cycles(deps)
+
+        dependents = dict((x, []) for x in deps)
+        for name, remote_names in deps.iteritems():
+            for remote_name in remote_names:
+                dependents[remote_name].append(name)
+        levels = []
+        ready = sorted(x for x, d in deps.iteritems() if not d)
+        while ready:
+            levels.append(ready)
+            next_ready = []
+            for name in ready:
+                for dependent in dependents[name]:
+                    deps[dependent].discard(name)
+                    if not deps[dependent]:
+                        next_ready.append(dependent)
+            ready = sorted(next_ready)
+        for fields in deferred.itervalues():
+            fields.sort()
+        return levels, deferred
+
+    def get_dependency_sequence(self):
+        """Return the entity names sorted by dependency.
+
+        See get_dependency_levels().
+        """
+        levels, unused = self.get_dependency_levels()
+        return [name for level in levels for name in level]
@@ -0,0 +1,199 @@
+"""Slow operation log.
+
+AdmDbApi methods record some statistics about the work done on their
+behalf, and log a structured record to the 'configdb.slowlog' logger
+when they take longer than a configurable threshold.
+
+The database backends report their activity with count_round_trips()
+and count_rows_scanned(), which update the statistics of the
+operation currently running in the calling thread (if any).
+"""
+
+import functools
+import json
+import logging
+import threading
+import time
+
+log = logging.getLogger('configdb.slowlog')
+
+_local = threading.local()
+
+
+class OperationStats(object):
+    """Statistics about a single AdmDbApi operation."""
+
+    def __init__(self, op, entity=None, query=None, backend=None):
+        self.op = op
+        self.entity = entity
+        self.query = query
+        self.backend = backend
+        self.round_trips = 0
+        self.rows_scanned = 0
+        self.rows_returned = None
+        self.serialize_time = 0.0
+        self.start = time.time()
+        self.elapsed = 0.0
+
+    def add_serialize_time(self, elapsed):
+        self.serialize_time += elapsed
+
+    def to_dict(self):
+        return {'op': self.op,
+                'entity': self.entity,
+                'query': self.query,
+                'backend': self.backend,
+                'round_trips': self.round_trips,
+                'rows_scanned': self.rows_scanned,
+                'rows_returned': self.rows_returned,
+                'serialize_time': round(self.serialize_time, 6),
+                'total_time': round(self.elapsed, 6)}
+
+
+def current():
+    """Return the stats of the operation running in this thread."""
+    return getattr(_local, 'stats', None)
+
+
+def count_round_trips(n=1):
+    stats = current()
+    if stats is not None:
+        stats.round_trips += n
+
+
+def count_rows_scanned(n=1):
+    stats = current()
+    if stats is not None:
+        stats.rows_scanned += n
+
+
+class RoundTripCounter(object):
+    """Proxy for a database client, counting method calls.
+
+    Every call to a method of the client is counted as a round-trip
+    to the database, all other attributes are passed through.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr):
+            return attr
+
+        def _counted(*args, **kwargs):
+            count_round_trips()
+            return attr(*args, **kwargs)
+        return _counted
+
+
+def _query_to_net(query):
+    # Make the query spec printable.
+    try:
+        return json.loads(json.dumps(query, default=str))
+    except (TypeError, ValueError):
+        return repr(query)
+
+
+class SlowLogIterator(object):
+    """Iterator wrapper that keeps accounting for an operation.
+
+    The statistics of the operation are active while the wrapped
+    iterator is being consumed, and the operation is completed when
+    it is exhausted (or closed): its total time then includes the
+    time spent by the caller between results. The 'stats' attribute
+    can be used by the caller to add serialization time.
+    """
+
+    def __init__(self, slowlog, stats, items):
+        self._slowlog = slowlog
+        self._items = iter(items)
+        self._done = False
+        self.stats = stats
+        self.stats.rows_returned = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        _local.stats = self.stats
+        try:
+            item = self._items.next()
+        except:
+            self.close()
+            raise
+        finally:
+            _local.stats = None
+        self.stats.rows_returned += 1
+        return item
+
+    def close(self):
+        if not self._done:
+            self._done = True
+            self.stats.elapsed = time.time() - self.stats.start
+            self._slowlog.finish(self.stats)
+
+    def __del__(self):
+        self.close()
+
+
+class SlowLog(object):
+    """Log operations slower than 'threshold' seconds."""
+
+    def __init__(self, threshold, backend=None):
+        self.threshold = threshold
+        self.backend = backend
+
+    def finish(self, stats):
+        if stats.elapsed >= self.threshold:
+            record = stats.to_dict()
+            log.warning('slow operation: %s', json.dumps(record),
+                        extra={'slowlog': record})
+
+    def run(self, op, fn, entity=None, query=None):
+        """Run fn() as operation 'op', keeping track of its stats."""
+        if current() is not None:
+            # Nested operation, accounted for by the outer one.
+            return fn()
+        stats = OperationStats(op, entity, _query_to_net(query),
+                               self.backend)
+        _local.stats = stats
+        try:
+            result = fn()
+        except:
+            stats.elapsed = time.time() - stats.start
+            self.finish(stats)
+            raise
+        finally:
+            _local.stats = None
+        if hasattr(result, 'next'):
+            return SlowLogIterator(self, stats, result)
+        if isinstance(result, list):
+            stats.rows_returned = len(result)
+        stats.elapsed = time.time() - stats.start
+        self.finish(stats)
+        return result
+
+
+def slowlogged(op, with_query=False):
+    """Decorator for AdmDbApi methods, see SlowLog.run().
+
+    The first argument of the method, if a string, is the entity
+    name. If 'with_query' is set, the second one is the query.
+    """
+    def _decorator(fn):
+        @functools.wraps(fn)
+        def _slowlogged_wrapper(self, *args, **kwargs):
+            if self.slowlog is None:
+                return fn(self, *args, **kwargs)
+            entity = None
+            if args and isinstance(args[0], basestring):
+                entity = args[0]
+            query = args[1] if with_query and len(args) > 1 else None
+            return self.slowlog.run(
+                op, lambda: fn(self, *args, **kwargs), entity, query)
+        return _slowlogged_wrapper
+    return _decorator
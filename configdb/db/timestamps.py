@@ -0,0 +1,75 @@
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class TimestampCoalescer(object):
+    """Batch the timestamp updates of the entities in memory.
+
+    Rather than writing the '__timestamp' of an entity on every
+    change, touch() records the highest timestamp of each entity, and
+    a background thread writes them all, in a single session, every
+    'interval' seconds. Other processes can thus see timestamps that
+    are up to 'interval' seconds old, while pending() lets this
+    process take its own changes into account right away.
+    """
+
+    def __init__(self, db, interval):
+        self.db = db
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _merge(self, timestamps):
+        for entity_name, ts in timestamps.iteritems():
+            if ts > self._pending.get(entity_name, 0):
+                self._pending[entity_name] = ts
+
+    def touch(self, entity_name, ts):
+        """Record a change to an entity at time 'ts'."""
+        with self._lock:
+            self._merge({entity_name: ts})
+            if self._thread is None:
+                self._start()
+
+    def pending(self, entity_names):
+        """Return the unwritten timestamps of the given entities."""
+        with self._lock:
+            return dict((x, self._pending[x]) for x in entity_names
+                        if x in self._pending)
+
+    def flush(self):
+        """Write the pending timestamps to the database."""
+        with self._lock:
+            timestamps, self._pending = self._pending, {}
+        if not timestamps:
+            return
+        try:
+            with self.db.session() as session:
+                for entity_name, ts in sorted(timestamps.iteritems()):
+                    self.db.set_timestamp(entity_name, ts, session)
+        except Exception, e:
+            log.error('could not update the timestamps of %s: %s',
+                      ', '.join(sorted(timestamps)), e)
+            # Try again at the next flush.
+            with self._lock:
+                self._merge(timestamps)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        """Stop the background thread, and write what's left."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
@@ -43,9 +43,33 @@ _validator_map = {
 
 
 
+def _compile_validator(validator):
+    """Return a function validating a non-empty value.
+
+    The most common inputs of the relation and bool validators are
+    accepted without going through formencode.
+    """
+    to_python = validator.to_python
+    if validator is _validator_map['relation']:
+        def _validate_relation(value):
+            if isinstance(value, list) and isinstance(value[0], basestring):
+                return value
+            return to_python(value)
+        return _validate_relation
+    if validator is _validator_map['bool']:
+        def _validate_bool(value):
+            if isinstance(value, bool):
+                return value
+            return to_python(value)
+        return _validate_bool
+    return to_python
+
+
 class ValidatorMixin(object):
     """Mixin class for entity validation."""
 
+    _validator = None
+
     def set_validator(self, validator_def=None):
         if not validator_def:
             return
@@ -54,8 +78,14 @@ class ValidatorMixin(object):
             vclass = validators.Regex(validator_def)
         self._validator = vclass
 
+    def compile_validator(self):
+        """Return a function validating non-empty values, or None."""
+        if self._validator is None:
+            return None
+        return _compile_validator(self._validator)
+
     def validate(self, value):
-        if hasattr(self, '_validator') and value:
+        if self._validator is not None and value:
             return self._validator.to_python(value)
         else:
             return value
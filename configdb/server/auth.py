@@ -1,4 +1,7 @@
+import collections
 import crypt
+import threading
+import time
 from flask import request
 from configdb.db import acl
 
@@ -13,11 +16,13 @@ def user_auth_fn(user_entity_name='user'):
         username = data.get('username')
         password = data.get('password')
         if username and password:
-            user_obj = api.db.get_by_name(user_entity_name, username, api.db.Session())
-            if user_obj:
-                enc_password = crypt.crypt(password, user_obj.password)
-                if enc_password == user_obj.password:
-                    return username
+            with api.db.session() as session:
+                user_obj = api.db.get_by_name(
+                    user_entity_name, username, session)
+                if user_obj:
+                    enc_password = crypt.crypt(password, user_obj.password)
+                    if enc_password == user_obj.password:
+                        return username
     return _user_auth_fn
 
 
@@ -29,13 +34,72 @@ def user_auth_context_fn(user_entity_name='user'):
     """
     def _user_auth_context_fn(api, username):
         ctx = acl.AuthContext(username)
-        user_obj = api.db.get_by_name(user_entity_name, username, api.db.Session())
+        with api.db.session() as session:
+            user_obj = api.db.get_by_name(user_entity_name, username, session)
+            if user_obj:
+                api.db.detach(user_obj, session)
         if user_obj:
             ctx.set_self(user_obj)
         return ctx
     return _user_auth_context_fn
 
 
+class AuthContextCache(object):
+    """Caching wrapper for auth context functions.
+
+    Keeps the AuthContext objects built by the wrapped function,
+    indexed by auth token, for at most 'ttl' seconds. All the cached
+    contexts are dropped when the timestamp of the user entity
+    changes, which is checked at most once every 'ts_check_interval'
+    seconds.
+    """
+
+    def __init__(self, auth_context_fn, ttl=60, size=1000,
+                 user_entity_name='user', ts_check_interval=1):
+        self.auth_context_fn = auth_context_fn
+        self.ttl = ttl
+        self.size = size
+        self.user_entity_name = user_entity_name
+        self.ts_check_interval = ts_check_interval
+        self._cache = collections.OrderedDict()
+        self._ts = None
+        self._ts_checked = 0
+        self._lock = threading.Lock()
+
+    def _check_timestamp(self, api, now):
+        if now - self._ts_checked < self.ts_check_interval:
+            return
+        with api.db.session() as session:
+            ts_obj = api.db.get_by_name(
+                '__timestamp', self.user_entity_name, session)
+        ts = ts_obj.ts if ts_obj else None
+        with self._lock:
+            if ts != self._ts:
+                self._cache.clear()
+            self._ts = ts
+            self._ts_checked = now
+
+    def invalidate(self):
+        """Drop all the cached contexts."""
+        with self._lock:
+            self._cache.clear()
+
+    def __call__(self, api, auth_token):
+        now = time.time()
+        self._check_timestamp(api, now)
+        with self._lock:
+            entry = self._cache.pop(auth_token, None)
+            if entry and now - entry[0] < self.ttl:
+                self._cache[auth_token] = entry
+                return entry[1]
+        ctx = self.auth_context_fn(api, auth_token)
+        with self._lock:
+            self._cache[auth_token] = (now, ctx)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return ctx
+
+
 def external_auth_fn(api, data):
     """Auth function for external HTTP authentication.
 
@@ -0,0 +1,360 @@
+"""Request and database metrics, in the Prometheus text format.
+
+Every process keeps its own counters and histograms in memory. When
+a metrics directory is configured, each process periodically saves
+them to its own file there, and the exported values are the sum over
+all the files: this way the numbers are correct even when requests
+are served by multiple worker processes. Files are named after the
+process ID and the time the process started, so that a reused ID
+never overwrites them. When a process exits cleanly (see close()),
+or when its file is found but the process is gone, its metrics are
+folded into a shared 'retired' file, so that counters never go
+backwards while the number of files stays bounded.
+"""
+
+import collections
+import contextlib
+import errno
+import fcntl
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+
+# Latency buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+
+METRICS = {
+    'configdb_requests_total': (
+        'counter', 'Number of API requests, by route.'),
+    'configdb_request_duration_seconds': (
+        'histogram', 'Latency of API requests, by route.'),
+    'configdb_errors_total': (
+        'counter', 'Number of failed API requests, by route and error.'),
+    'configdb_db_calls_total': (
+        'counter', 'Number of database backend calls, by method.'),
+    'configdb_db_call_duration_seconds': (
+        'histogram', 'Latency of database backend calls, by method.'),
+    }
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, unicode(v).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels)
+
+
+_FILENAME_RE = re.compile(r'^metrics-(\d+)-(\d+)\.json$')
+
+RETIRED_FILENAME = 'metrics-retired.json'
+
+
+_start_lock = threading.Lock()
+_last_start = [0]
+
+
+def _unique_start():
+    """Return the current time in milliseconds, unique in this process."""
+    with _start_lock:
+        _last_start[0] = max(int(time.time() * 1000), _last_start[0] + 1)
+        return _last_start[0]
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        # EPERM means that the process exists.
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _empty_histogram(buckets):
+    return {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+
+
+def _add_state(counters, histograms, state, buckets):
+    """Add the metrics of a saved state to the given totals."""
+    if list(state['buckets']) != list(buckets):
+        return
+    for name, labels, value in state['counters']:
+        counters[(name, tuple(map(tuple, labels)))] += value
+    for name, labels, hist in state['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        total = histograms.get(key)
+        if total is None:
+            total = histograms[key] = _empty_histogram(buckets)
+        for i, n in enumerate(hist['buckets']):
+            total['buckets'][i] += n
+        total['sum'] += hist['sum']
+        total['count'] += hist['count']
+
+
+def _make_state(buckets, counters, histograms):
+    return {
+        'buckets': buckets,
+        'counters': [[name, labels, value] for (name, labels), value
+                     in counters.iteritems()],
+        'histograms': [[name, labels, {'buckets': list(h['buckets']),
+                                       'sum': h['sum'],
+                                       'count': h['count']}]
+                       for (name, labels), h in histograms.iteritems()],
+        }
+
+
+def _load_json(filename):
+    try:
+        with open(filename) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        # The process might have gone away, or be in the middle of
+        # writing the file.
+        return None
+
+
+def _write_json(filename, data):
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'w') as fd:
+        json.dump(data, fd)
+    os.rename(tmp_filename, filename)
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Metrics(object):
+    """Collection of counters and histograms.
+
+    If 'path' is set, the metrics of this process are saved to a file
+    in that directory at most every 'flush_interval' seconds (when
+    maybe_flush() is called), and render() exports the metrics of all
+    the processes sharing the directory.
+    """
+
+    def __init__(self, path=None, flush_interval=1,
+                 buckets=DEFAULT_BUCKETS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._counters = collections.defaultdict(float)
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0
+        self._start = _unique_start()
+        self._closed = False
+        # Serializes flush() and close().
+        self._flush_lock = threading.Lock()
+
+    def inc(self, name, labels={}, value=1):
+        """Increment a counter."""
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, labels={}):
+        """Add a value to a histogram."""
+        key = (name, _labels_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = _empty_histogram(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+                    break
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def observe_db_call(self, method, duration):
+        """Record a call to a database interface method."""
+        labels = {'method': method}
+        self.inc('configdb_db_calls_total', labels)
+        self.observe('configdb_db_call_duration_seconds', duration, labels)
+
+    def _state(self):
+        with self._lock:
+            return _make_state(self.buckets, self._counters,
+                               self._histograms)
+
+    def _filename(self, pid=None, start=None):
+        return os.path.join(self.path, 'metrics-%d-%d.json' % (
+                pid or os.getpid(), start or self._start))
+
+    @contextlib.contextmanager
+    def _retired_lock(self):
+        with open(os.path.join(self.path, 'metrics-retired.lock'),
+                  'w') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _retire(self, filenames):
+        """Fold the given metrics files into the retired totals.
+
+        Must be called with the retired lock held. Every file is
+        removed once its metrics have been saved in the retired file.
+        """
+        counters = collections.defaultdict(float)
+        histograms = {}
+        retired = self._load_retired()
+        if retired is not None:
+            _add_state(counters, histograms, retired, self.buckets)
+            done = set(retired.get('files', ()))
+        else:
+            done = set()
+        retired_names = []
+        for filename in filenames:
+            name = os.path.basename(filename)
+            if name in done:
+                # Already counted, but not removed yet.
+                retired_names.append(filename)
+                continue
+            if filename == self._filename():
+                state = self._state()
+            else:
+                state = _load_json(filename)
+            if state is not None:
+                _add_state(counters, histograms, state, self.buckets)
+                retired_names.append(filename)
+                done.add(name)
+        if not retired_names:
+            return
+        # The names of the retired files are saved along with the
+        # totals, so that they are never counted twice, even if they
+        # can't be removed.
+        retired = _make_state(self.buckets, counters, histograms)
+        retired['files'] = sorted(
+            x for x in done
+            if os.path.exists(os.path.join(self.path, x)))
+        _write_json(os.path.join(self.path, RETIRED_FILENAME), retired)
+        for filename in retired_names:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+    def _load_retired(self):
+        return _load_json(os.path.join(self.path, RETIRED_FILENAME))
+
+    def flush(self):
+        """Save the metrics of this process to the metrics directory."""
+        if not self.path:
+            return
+        with self._flush_lock:
+            if self._closed:
+                return
+            _write_json(self._filename(), self._state())
+            self._last_flush = time.time()
+
+    def maybe_flush(self):
+        if self.path and time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def close(self):
+        """Move the metrics of this process to the retired totals.
+
+        Should be called when the process exits.
+        """
+        if not self.path:
+            return
+        with self._flush_lock:
+            if self._closed:
+                return
+            with self._retired_lock():
+                self._closed = True
+                self._retire([self._filename()])
+
+    def _process_files(self):
+        """Return the metrics files of the other processes."""
+        own_filename = self._filename()
+        return [x for x in glob.glob(os.path.join(self.path, 'metrics-*.json'))
+                if x != own_filename
+                and _FILENAME_RE.match(os.path.basename(x))]
+
+    def _load_states(self):
+        # Once closed, the metrics of this process are in the retired
+        # totals.
+        states = [] if self._closed else [self._state()]
+        if not self.path:
+            return states
+        with self._retired_lock():
+            dead = [x for x in self._process_files()
+                    if not _pid_exists(int(_FILENAME_RE.match(
+                        os.path.basename(x)).group(1)))]
+            if dead:
+                self._retire(dead)
+            retired = self._load_retired()
+            done = set()
+            if retired is not None:
+                states.append(retired)
+                done = set(retired.get('files', ()))
+            for filename in self._process_files():
+                if os.path.basename(filename) in done:
+                    continue
+                state = _load_json(filename)
+                if state is not None:
+                    states.append(state)
+        return states
+
+    def collect(self):
+        """Aggregate the metrics of all processes.
+
+        Returns a (counters, histograms) tuple of dictionaries indexed
+        by (name, labels).
+        """
+        counters = collections.defaultdict(float)
+        histograms = {}
+        for state in self._load_states():
+            _add_state(counters, histograms, state, self.buckets)
+        return counters, histograms
+
+    def render(self):
+        """Export the metrics in the Prometheus text format."""
+        counters, histograms = self.collect()
+        by_name = collections.defaultdict(list)
+        for (name, labels), value in counters.iteritems():
+            by_name[name].append((labels, value))
+        for (name, labels), hist in histograms.iteritems():
+            by_name[name].append((labels, hist))
+
+        out = []
+        for name in sorted(by_name):
+            metric_type, help_text = METRICS.get(name, ('untyped', name))
+            out.append('# HELP %s %s' % (name, help_text))
+            out.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in sorted(by_name[name]):
+                if metric_type != 'histogram':
+                    out.append('%s%s %s' % (name, _format_labels(labels),
+                                            _format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, n in zip(self.buckets, value['buckets']):
+                    cumulative += n
+                    out.append('%s_bucket%s %d' % (
+                            name, _format_labels(labels, [('le', bound)]),
+                            cumulative))
+                out.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels, [('le', '+Inf')]),
+                        value['count']))
+                out.append('%s_sum%s %s' % (name, _format_labels(labels),
+                                            repr(value['sum'])))
+                out.append('%s_count%s %d' % (name, _format_labels(labels),
+                                              value['count']))
+        return '\n'.join(out) + '\n'
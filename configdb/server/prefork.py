@@ -0,0 +1,241 @@
+"""Pre-forking HTTP server for the database API.
+
+The master process opens the listening socket and forks a number of
+worker processes, each of them accepting connections from the shared
+socket and handling requests with a fixed pool of threads.
+
+The WSGI application is created separately in every worker, after
+the fork, so that connections to the database backend are never
+shared between processes. If the application has a close() method,
+it is called when the worker exits gracefully, after the requests in
+progress have been served.
+
+Signals understood by the master process:
+
+SIGHUP
+  Graceful reload: start a new set of workers (which will read the
+  configuration again), and tell the old ones to finish serving
+  their current requests and exit.
+
+SIGTERM, SIGINT
+  Graceful shutdown.
+"""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import Queue
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+log = logging.getLogger(__name__)
+
+
+def _make_handler(keepalive):
+    if not keepalive:
+        return WSGIRequestHandler
+
+    class _KeepAliveRequestHandler(WSGIRequestHandler):
+        # HTTP/1.1 connections are persistent by default. Idle
+        # connections are closed after 'keepalive' seconds.
+        protocol_version = 'HTTP/1.1'
+        timeout = keepalive
+
+    return _KeepAliveRequestHandler
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """WSGI server handling requests with a fixed pool of threads.
+
+    Serves connections accepted from an already listening socket,
+    given as a file descriptor. When all the threads are busy, new
+    connections are left in the listen queue, where they can be
+    picked up by other processes.
+    """
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host, app, fd, threads=8, keepalive=0):
+        BaseWSGIServer.__init__(self, host, 0, app,
+                                handler=_make_handler(keepalive), fd=fd)
+        # On Python 2, socket.fromfd() returns a low-level socket,
+        # whose connections do not support timeouts in makefile().
+        if not isinstance(self.socket, socket.socket):
+            self.socket = socket.socket(_sock=self.socket)
+        self._requests = Queue.Queue(threads)
+        self._threads = []
+        for i in xrange(threads):
+            thread = threading.Thread(target=self._process_requests)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _process_requests(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        # Wait for the queued requests to be served.
+        for thread in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+        BaseWSGIServer.server_close(self)
+
+
+def _run_worker(app_factory, host, fd, threads, keepalive):
+    app = app_factory()
+    server = ThreadPoolWSGIServer(host, app, fd, threads, keepalive)
+
+    def _stop(signo, frame):
+        # shutdown() waits for serve_forever() to return, so it can't
+        # be called from the main thread.
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    server.serve_forever()
+    # Workers leave with os._exit(), so atexit hooks are not run.
+    server.server_close()
+    close = getattr(app, 'close', None)
+    if close is not None:
+        close()
+
+
+class PreforkServer(object):
+    """Pre-forking multi-process, multi-threaded HTTP server.
+
+    'app_factory' is a function that returns the WSGI application,
+    it will be called once in every worker process.
+    """
+
+    def __init__(self, app_factory, host='127.0.0.1', port=3000,
+                 workers=4, threads=8, backlog=128, keepalive=5,
+                 graceful_timeout=30):
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.threads = threads
+        self.backlog = backlog
+        self.keepalive = keepalive
+        self.graceful_timeout = graceful_timeout
+        self._sock = None
+        self._workers = {}
+        self._generation = 0
+        self._reload = False
+        self._stop = False
+
+    def _listen(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        return sock
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            for signo in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signo, signal.SIG_DFL)
+            try:
+                _run_worker(self.app_factory, self.host, self._sock.fileno(),
+                            self.threads, self.keepalive)
+            except:
+                log.exception('worker %d failed', os.getpid())
+                status = 1
+            finally:
+                os._exit(status)
+        log.info('started worker %d', pid)
+        self._workers[pid] = self._generation
+
+    def _signal_workers(self, pids, signo):
+        for pid in pids:
+            try:
+                os.kill(pid, signo)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _reap_workers(self):
+        """Collect terminated workers, without blocking."""
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    self._workers.clear()
+                break
+            if not pid:
+                break
+            generation = self._workers.pop(pid, None)
+            if generation == self._generation and not self._stop:
+                log.warn('worker %d died unexpectedly (status %d)',
+                         pid, status)
+
+    def _handle_reload(self, signo, frame):
+        self._reload = True
+
+    def _handle_stop(self, signo, frame):
+        self._stop = True
+
+    def _shutdown(self):
+        self._signal_workers(self._workers.keys(), signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self._workers and time.time() < deadline:
+            self._reap_workers()
+            time.sleep(0.1)
+        if self._workers:
+            log.warn('killing %d workers', len(self._workers))
+            self._signal_workers(self._workers.keys(), signal.SIGKILL)
+            while self._workers:
+                self._reap_workers()
+                time.sleep(0.1)
+
+    def serve(self):
+        """Run the server until a SIGTERM or SIGINT is received."""
+        self._sock = self._listen()
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        log.info('listening on %s:%d', self.host, self.port)
+        try:
+            while not self._stop:
+                if self._reload:
+                    self._reload = False
+                    log.info('reloading')
+                    old_workers = self._workers.keys()
+                    self._generation += 1
+                    for i in xrange(self.num_workers):
+                        self._spawn_worker()
+                    self._signal_workers(old_workers, signal.SIGTERM)
+                self._reap_workers()
+                running = sum(1 for x in self._workers.itervalues()
+                              if x == self._generation)
+                for i in xrange(self.num_workers - running):
+                    self._spawn_worker()
+                time.sleep(0.5)
+        finally:
+            self._shutdown()
+            self._sock.close()
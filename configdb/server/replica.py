@@ -0,0 +1,158 @@
+"""Read replica of a configdb API server.
+
+A replica keeps a copy of the whole database of a primary server in
+memory: it loads a snapshot at startup, and then follows the change
+feed of the primary (the 'changes' endpoint) to stay up to date. Read
+requests are served from the local copy, while writes (and the
+requests that need the primary's logs) are forwarded to the primary.
+"""
+
+import logging
+import threading
+import time
+import urllib2
+
+log = logging.getLogger(__name__)
+
+# Response header telling how old the data served by a replica can be.
+STALENESS_HEADER = 'X-Configdb-Staleness'
+
+# Request headers forwarded to the primary.
+FORWARDED_HEADERS = ('Content-Type', 'Content-Encoding', 'Cookie')
+
+# Query matching all the objects of an entity.
+_ALL_OBJECTS = {'name': {'type': 'regexp', 'pattern': '^.*$'}}
+
+
+class Replica(object):
+    """Keep a local database in sync with a primary server.
+
+    'conn' is a client.connection.Connection to the primary, which
+    must be able to read all the entities; 'db' is the local database
+    interface (usually an InMemoryDbInterface). The changes are
+    fetched by a background thread with requests that wait up to
+    'wait' seconds for new changes, and at most 'batch_size' changes
+    at a time. Requests are forwarded to 'primary_url'.
+    """
+
+    def __init__(self, conn, schema, db, primary_url, wait=30,
+                 batch_size=1000, retry_interval=5, timeout=60):
+        self.conn = conn
+        self.schema = schema
+        self.db = db
+        self.primary_url = primary_url.rstrip('/')
+        self.wait = wait
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.seq = None
+        self.synced_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def staleness(self):
+        """How old the local data can be, in seconds (None if unknown)."""
+        if self.synced_at is None:
+            return None
+        return max(0, time.time() - self.synced_at)
+
+    def _put(self, entity_name, object_name, data, session):
+        if data is not None:
+            self.db.create(entity_name, data, session)
+        elif self.db.get_by_name(entity_name, object_name, session):
+            self.db.delete(entity_name, object_name, session)
+
+    def load_snapshot(self):
+        """Copy all the objects of the primary to the local database."""
+        start = time.time()
+        # Changes made while the snapshot is being loaded will be
+        # applied again, which is harmless.
+        unused, seq = self.conn.get_changes(-1)
+        levels, unused = self.schema.get_dependency_levels()
+        with self.db.session() as session:
+            for level in levels:
+                for entity_name in level:
+                    if entity_name in self.schema.sys_schema_tables:
+                        continue
+                    for obj in self.conn.find(entity_name, _ALL_OBJECTS):
+                        self._put(entity_name, obj['name'], obj, session)
+                    # The entity can't have been modified later than
+                    # this, and timestamps are only used to detect
+                    # changes.
+                    self.db.set_timestamp(entity_name, start, session)
+        self.seq = seq
+        self.synced_at = start
+        log.info('loaded snapshot of %s at change %d', self.primary_url, seq)
+
+    def apply_change(self, change):
+        """Apply a change of the primary to the local database.
+
+        The object is fetched from the primary, rather than reproducing
+        the operation, so applying a change more than once is harmless.
+        """
+        entity_name, object_name = change['entity'], change['name']
+        data = None
+        if change['op'] != 'delete':
+            result = self.conn.find(
+                entity_name, {'name': {'type': 'eq', 'value': object_name}})
+            if result:
+                data = result[0]
+        with self.db.session() as session:
+            self._put(entity_name, object_name, data, session)
+            # Use the local time, as the timestamps tell when the data
+            # served by the replica has changed.
+            self.db.set_timestamp(entity_name, time.time(), session)
+
+    def sync(self):
+        """Fetch and apply new changes, waiting for them if necessary."""
+        changes, seq = self.conn.get_changes(
+            self.seq, wait=self.wait, limit=self.batch_size)
+        # The request may have waited for up to 'wait' seconds: the
+        # response tells the state of the primary when it was sent.
+        received = time.time()
+        for change in changes:
+            self.apply_change(change)
+            self.seq = change['seq']
+        self.seq = seq
+        if len(changes) < self.batch_size:
+            # We got all the changes made until the response.
+            self.synced_at = received
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sync()
+            except Exception, e:
+                log.error('could not sync with %s: %s', self.primary_url, e)
+                self._stop.wait(self.retry_interval)
+
+    def start(self):
+        """Start following the changes in a background thread."""
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread.
+
+        Waits up to 'timeout' seconds for it to exit (a request for
+        changes might be waiting on the primary).
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def forward(self, method, path, data=None, headers=None):
+        """Forward a request to the primary.
+
+        Returns a (status, content_type, body) tuple.
+        """
+        request = urllib2.Request(self.primary_url + path, data=data,
+                                  headers=headers or {})
+        request.get_method = lambda: method
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError, e:
+            response = e
+        return (response.code, response.info().get('Content-Type'),
+                response.read())
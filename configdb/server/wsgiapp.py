@@ -9,36 +9,82 @@ a login session at the /login URL endpoint.
 
 """
 
+import atexit
+import cProfile
 import functools
+import hashlib
+import itertools
 import json
 import logging
-from flask import Flask, Blueprint, request, jsonify, current_app, \
-    session, abort, g
+import os
+import pstats
+import random
+import StringIO
+import time
+import zlib
+from flask import Flask, Blueprint, Response, request, jsonify, \
+    current_app, session, abort, g, stream_with_context
 from configdb import exceptions
 from configdb.db import acl
 from configdb.db import db_api
 from configdb.db import schema
 from configdb.server import auth
-from datetime import timedelta
+from configdb.server import metrics
+from configdb.server import replica
+from datetime import datetime, timedelta
 
 log = logging.getLogger(__name__)
 api_app = Blueprint('configdb', __name__)
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# zlib window bits selecting the gzip format.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Amount of uncompressed data after which a streamed compressed
+# response is flushed to the client.
+GZIP_STREAM_FLUSH_SIZE = 65536
+
+# Request header asking for a profile of the request.
+PROFILE_HEADER = 'X-Configdb-Profile'
+
+
+def _gunzip_request_data(data):
+    """Decompress a gzip-encoded request body.
+
+    The decompressed size is limited by MAX_CONTENT_LENGTH, if set.
+    """
+    max_size = current_app.config.get('MAX_CONTENT_LENGTH')
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    try:
+        if max_size:
+            result = decompressor.decompress(data, max_size)
+            if decompressor.unconsumed_tail:
+                abort(413)
+            return result
+        return decompressor.decompress(data) + decompressor.flush()
+    except zlib.error:
+        abort(400)
+
 
 def json_request(fn):
     """JSON request encoding.
 
     Incoming POST requests must have a Content-Type of
     'application/json', and the request body must contain a
-    JSON-encoded dictionary of key/value pairs.
+    JSON-encoded dictionary of key/value pairs. The body can be
+    compressed, with a Content-Encoding of 'gzip'.
     """
     @functools.wraps(fn)
     def _json_request_wrapper(*args, **kwargs):
         if request.method == 'POST':
             if request.content_type != 'application/json':
                 abort(400)
+            data = request.data
+            if request.headers.get('Content-Encoding') == 'gzip':
+                data = _gunzip_request_data(data)
             try:
-                g.request_data = json.loads(request.data)
+                g.request_data = json.loads(data)
             except:
                 abort(400)
         return fn(*args, **kwargs)
@@ -66,18 +112,348 @@ def json_response(fn):
                  'result': fn(*args, **kwargs)})
         except Exception, e:
             log.exception('exception in url=%s' % request.url)
+            g.error = e
             return jsonify(
                 {'ok': False,
                  'error': str(e)})
     return _json_response_wrapper
 
 
-def _to_net(class_name, item):
+def _stream_json(items):
+    """Encode an iterator as the 'result' list of a JSON response.
+
+    Objects are encoded one at a time. An error while generating the
+    list is reported by closing the list and appending 'ok' and
+    'error' attributes, which take precedence over the initial 'ok'.
+    """
+    yield '{"ok": true, "result": ['
+    try:
+        for i, item in enumerate(items):
+            if i:
+                yield ', '
+            yield json.dumps(item)
+    except Exception, e:
+        log.exception('exception in streamed response')
+        yield '], "ok": false, "error": %s}' % json.dumps(str(e))
+    else:
+        yield ']}'
+
+
+def _stream_ndjson(items):
+    """Encode an iterator as newline-delimited JSON.
+
+    An error while generating the results is reported with a final
+    line containing 'ok' and 'error' attributes.
+    """
+    try:
+        for item in items:
+            yield json.dumps(item) + '\n'
+    except Exception, e:
+        log.exception('exception in streamed response')
+        yield json.dumps({'ok': False, 'error': str(e)}) + '\n'
+
+
+def streaming_json_response(fn):
+    """JSON response encoding, with optional streaming of lists.
+
+    Works like json_response, except that when the wrapped method
+    returns an iterator, the results can be streamed to the client
+    one object at a time, rather than building the whole response in
+    memory first. Streaming is enabled by the 'stream' query
+    argument, or by asking for newline-delimited JSON using the
+    'Accept' header.
+
+    The first result is fetched before the response is started, so
+    that most errors (validation, ACLs) result in a regular error
+    response.
+    """
+    @functools.wraps(fn)
+    def _streaming_json_response_wrapper(*args, **kwargs):
+        ndjson = (request.accept_mimetypes.best_match(
+                ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE)
+        stream = ndjson or bool(request.args.get('stream'))
+        try:
+            result = fn(*args, **kwargs)
+            if not hasattr(result, 'next'):
+                return jsonify({'ok': True, 'result': result})
+            if not stream:
+                return jsonify({'ok': True, 'result': list(result)})
+            first = list(itertools.islice(result, 1))
+        except Exception, e:
+            log.exception('exception in url=%s' % request.url)
+            g.error = e
+            return jsonify(
+                {'ok': False,
+                 'error': str(e)})
+        items = itertools.chain(first, result)
+        if ndjson:
+            return Response(stream_with_context(_stream_ndjson(items)),
+                            mimetype=NDJSON_MIMETYPE)
+        return Response(stream_with_context(_stream_json(items)),
+                        mimetype='application/json')
+    return _streaming_json_response_wrapper
+
+
+def conditional(fn):
+    """Conditional requests support for read-only endpoints.
+
+    The ETag of a response is derived from the last update timestamp
+    of the entity (and of the related entities), the request itself
+    and the authenticated user. When the client sends a matching
+    'If-None-Match' header, a '304 Not Modified' response is returned
+    without running the wrapped method. Since 'find' queries use the
+    POST method, they are handled the same way as GET requests. Error
+    and streamed responses carry no validators.
+
+    Must be applied after 'authenticate' (and 'json_request').
+    """
+    @functools.wraps(fn)
+    def _conditional_wrapper(class_name, *args, **kwargs):
+        try:
+            ts = g.api.get_last_modified(class_name, g.auth_ctx)
+        except Exception:
+            # Let the wrapped method report the error.
+            ts = None
+        if ts is None:
+            return fn(class_name, *args, **kwargs)
+
+        etag = hashlib.sha1(json.dumps(
+                [repr(ts), request.full_path, g.get('request_data'),
+                 g.auth_ctx.get_username()], sort_keys=True)).hexdigest()
+        last_modified = datetime.utcfromtimestamp(int(ts))
+        if request.if_none_match:
+            # Compressed responses carry a weak ETag.
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            # Last-Modified has a resolution of one second, so only
+            # trust it for updates that happened in the past.
+            not_modified = (request.if_modified_since is not None
+                            and request.if_modified_since > last_modified)
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = fn(class_name, *args, **kwargs)
+            # Errors are returned with a 200 status: they must not be
+            # cached. Neither can streamed responses, which might
+            # still fail halfway through.
+            if g.get('error') is not None or response.is_streamed:
+                return response
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+    return _conditional_wrapper
+
+
+def _should_profile():
+    """Check whether the current request should be profiled.
+
+    Profiling is enabled by setting PROFILE_GROUP, and only members
+    of that group can request it. A fraction PROFILE_SAMPLE_RATE of
+    those requests is actually profiled.
+    """
+    group = current_app.config.get('PROFILE_GROUP')
+    if not group or request.headers.get(PROFILE_HEADER) != '1':
+        return False
+    if group not in g.auth_ctx.groups:
+        return False
+    return random.random() < current_app.config.get('PROFILE_SAMPLE_RATE', 1)
+
+
+def _save_profile(profiler, response):
+    """Report the profile of a request.
+
+    If PROFILE_DIR is set, the stats are saved there (in the binary
+    pstats format) and the file name is returned in the response
+    header. Otherwise, the top PROFILE_LIMIT entries sorted by
+    cumulative time are added as text to the 'profile' attribute of
+    the JSON response.
+    """
+    profile_dir = current_app.config.get('PROFILE_DIR')
+    if profile_dir:
+        filename = '%s-%.6f-%d.prof' % (
+            request.url_rule.rule.split('/')[1], time.time(), os.getpid())
+        profiler.dump_stats(os.path.join(profile_dir, filename))
+        response.headers[PROFILE_HEADER + '-File'] = filename
+        return
+
+    out = StringIO.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(
+        current_app.config.get('PROFILE_LIMIT', 50))
+    try:
+        data = json.loads(response.get_data())
+    except ValueError:
+        log.error('can\'t add the profile to a %s response, set '
+                  'PROFILE_DIR instead', response.mimetype)
+        return
+    data['profile'] = out.getvalue()
+    response.set_data(json.dumps(data))
+
+
+def profiled(fn):
+    """Profile requests on demand.
+
+    Requests with a 'X-Configdb-Profile: 1' header run under cProfile
+    (see _should_profile for who is allowed to do so), and the stats
+    are reported by _save_profile. Streamed responses are buffered,
+    so that generating them is accounted for too. Profiled responses
+    do not carry an ETag, since their body is not cacheable.
+
+    Must be applied after 'authenticate'.
+    """
+    @functools.wraps(fn)
+    def _profiled_wrapper(*args, **kwargs):
+        if not _should_profile():
+            return fn(*args, **kwargs)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            response = current_app.make_response(fn(*args, **kwargs))
+            if response.is_streamed:
+                response.make_sequence()
+        finally:
+            profiler.disable()
+        response.headers.pop('ETag', None)
+        _save_profile(profiler, response)
+        return response
+    return _profiled_wrapper
+
+
+def _iter_to_net(class_name, items, fields=None):
+    """Lazily serialize a sequence of objects.
+
+    The serialization time is added to the slow log statistics of
+    the operation that returned the objects, if any.
+    """
+    entity = g.api.schema.get_entity(class_name)
+    stats = getattr(items, 'stats', None)
+    for item in items:
+        start = time.time()
+        data = entity.to_net(item, fields=fields)
+        if stats is not None:
+            stats.add_serialize_time(time.time() - start)
+        yield data
+
+
+def _to_net(class_name, item, fields=None):
     """An Entity.to_net() wrapper that works on items and lists."""
     if hasattr(item, 'next'):
-        return [_to_net(class_name, x) for x in item]
+        return [_to_net(class_name, x, fields) for x in item]
+    entity = g.api.schema.get_entity(class_name)
+    return entity.to_net(item, fields=fields)
+
+
+def _get_arg(name, arg_type, default=None):
+    """Return a query argument converted to 'arg_type'.
+
+    Unlike request.args.get(), a malformed value is an error rather
+    than being silently replaced by the default.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return arg_type(value)
+    except ValueError:
+        raise exceptions.QueryError('invalid value for "%s"' % name)
+
+
+def _get_fields(class_name):
+    """Return the field projection requested with the 'fields' argument.
+
+    The value should be a comma-separated list of field names.
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return None
     entity = g.api.schema.get_entity(class_name)
-    return entity.to_net(item)
+    if not entity:
+        raise exceptions.NotFound(class_name)
+    return g.api.check_fields(entity, fields.split(','))
+
+
+def _gzip_stream(chunks, level):
+    """Compress a streamed response.
+
+    The compressed data is flushed whenever enough input has been
+    accumulated, so that clients can start decoding the response
+    before it is complete.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    pending = 0
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= GZIP_STREAM_FLUSH_SIZE:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_response(response):
+    """Compress responses for clients that accept the gzip encoding.
+
+    Responses smaller than GZIP_MIN_SIZE are sent uncompressed,
+    streamed responses are always compressed.
+    """
+    if (response.status_code != 200
+        or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings:
+        return response
+
+    level = current_app.config.get('GZIP_LEVEL', 6)
+    if response.is_streamed:
+        response.response = _gzip_stream(response.response, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config.get('GZIP_MIN_SIZE', 1024):
+            return response
+        compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+        response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = 'gzip'
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def start_request_timer():
+    g.request_start = time.time()
+
+
+def record_request_metrics(response):
+    """Update the request metrics.
+
+    Routes are identified by the first component of their URL. For
+    streamed responses, the time spent sending the response is not
+    accounted for.
+    """
+    if request.url_rule is not None:
+        route = request.url_rule.rule.split('/')[1]
+    else:
+        route = 'unknown'
+    labels = {'route': route}
+    app_metrics = current_app.metrics
+    app_metrics.inc('configdb_requests_total', labels)
+    app_metrics.observe('configdb_request_duration_seconds',
+                        time.time() - g.request_start, labels)
+    error = g.get('error')
+    if error is not None:
+        app_metrics.inc('configdb_errors_total',
+                        {'route': route, 'error': error.__class__.__name__})
+    elif response.status_code >= 400:
+        app_metrics.inc('configdb_errors_total',
+                        {'route': route,
+                         'error': 'HTTP%d' % response.status_code})
+    app_metrics.maybe_flush()
+    return response
 
 
 @api_app.before_request
@@ -87,6 +463,63 @@ def set_api():
     current_app.permanent_session_lifetime = timedelta(minutes=120)
 
 
+# Endpoints that a replica forwards to the primary server.
+REPLICA_FORWARDED_ENDPOINTS = frozenset([
+    'configdb.create', 'configdb.update', 'configdb.delete',
+    'configdb.bulk', 'configdb.changes', 'configdb.get_audit'])
+
+# Endpoints that a replica serves from its local copy of the data.
+REPLICA_READ_ENDPOINTS = frozenset([
+    'configdb.get', 'configdb.find', 'configdb.ts'])
+
+
+@api_app.before_request
+def replica_dispatch():
+    """Forward writes to the primary, when running as a replica.
+
+    Reads are refused if the local data is older than the configured
+    REPLICA_MAX_STALENESS.
+    """
+    rep = current_app.replica
+    if rep is None:
+        return
+    if request.endpoint in REPLICA_FORWARDED_ENDPOINTS:
+        path = request.path
+        if request.query_string:
+            path += '?' + request.query_string
+        headers = dict((k, request.headers[k])
+                       for k in replica.FORWARDED_HEADERS
+                       if k in request.headers)
+        data = request.get_data() if request.method == 'POST' else None
+        try:
+            status, content_type, body = rep.forward(
+                request.method, path, data, headers)
+        except Exception, e:
+            log.error('could not forward request to the primary: %s', e)
+            g.error = e
+            response = jsonify({'ok': False, 'error': str(e)})
+            response.status_code = 502
+            return response
+        return Response(body, status=status, content_type=content_type)
+    max_staleness = current_app.config.get('REPLICA_MAX_STALENESS')
+    if max_staleness and request.endpoint in REPLICA_READ_ENDPOINTS:
+        staleness = rep.staleness()
+        if staleness is None or staleness > max_staleness:
+            response = jsonify({'ok': False, 'error': 'replica is stale'})
+            response.status_code = 503
+            return response
+
+
+@api_app.after_request
+def replica_staleness(response):
+    rep = current_app.replica
+    if rep is not None:
+        staleness = rep.staleness()
+        if staleness is not None:
+            response.headers[replica.STALENESS_HEADER] = '%.3f' % staleness
+    return response
+
+
 def authenticate(fn):
     @functools.wraps(fn)
     def _auth_wrapper(*args, **kwargs):
@@ -98,7 +531,10 @@ def authenticate(fn):
                 or not session.get('auth_token')):
                 abort(403)
             auth_ctx_fn = current_app.config['AUTH_CONTEXT_FN']
-            g.auth_ctx = auth_ctx_fn(g.api, session['auth_token'])
+            # The context might be shared with other requests (see
+            # auth.AuthContextCache), while the ACL decisions it
+            # memoizes must not be.
+            g.auth_ctx = auth_ctx_fn(g.api, session['auth_token']).copy()
         return fn(*args, **kwargs)
     return _auth_wrapper
 
@@ -119,6 +555,7 @@ def login():
 
 @api_app.route('/create/<class_name>', methods=['POST'])
 @authenticate
+@profiled
 @json_request
 @json_response
 def create(class_name):
@@ -127,14 +564,19 @@ def create(class_name):
 
 @api_app.route('/get/<class_name>/<path:object_name>')
 @authenticate
+@profiled
+@conditional
 @json_response
 def get(class_name, object_name):
+    fields = _get_fields(class_name)
     return _to_net(class_name,
-                   g.api.get(class_name, object_name, g.auth_ctx))
+                   g.api.get(class_name, object_name, g.auth_ctx),
+                   fields)
 
 
 @api_app.route('/update/<class_name>/<path:object_name>', methods=['POST'])
 @authenticate
+@profiled
 @json_request
 @json_response
 def update(class_name, object_name):
@@ -143,20 +585,42 @@ def update(class_name, object_name):
 
 @api_app.route('/find/<class_name>', methods=['POST'])
 @authenticate
+@profiled
 @json_request
-@json_response
+@conditional
+@streaming_json_response
 def find(class_name):
-    return _to_net(class_name,
-                   g.api.find(class_name, g.request_data, g.auth_ctx))
+    fields = _get_fields(class_name)
+    limit = _get_arg('limit', int)
+    cursor = request.args.get('cursor')
+    if limit is None and cursor is None:
+        return _iter_to_net(class_name,
+                            g.api.find(class_name, g.request_data,
+                                       g.auth_ctx, fields=fields),
+                            fields)
+    results, next_cursor = g.api.find_page(
+        class_name, g.request_data, g.auth_ctx, limit, cursor, fields)
+    return {'results': [_to_net(class_name, x, fields) for x in results],
+            'cursor': next_cursor}
 
 
 @api_app.route('/delete/<class_name>/<path:object_name>')
 @authenticate
+@profiled
 @json_response
 def delete(class_name, object_name):
     return g.api.delete(class_name, object_name, g.auth_ctx)
 
 
+@api_app.route('/bulk', methods=['POST'])
+@authenticate
+@profiled
+@json_request
+@json_response
+def bulk():
+    return g.api.bulk(g.request_data, g.auth_ctx)
+
+
 @api_app.route('/timestamp/<class_name>')
 @authenticate
 @json_response
@@ -164,10 +628,26 @@ def ts(class_name):
     return g.api.get_timestamp(class_name, g.auth_ctx)
 
 
+@api_app.route('/changes')
+@authenticate
+@json_response
+def changes():
+    since = _get_arg('since', int, 0)
+    limit = _get_arg('limit', int)
+    wait = _get_arg('wait', float, 0)
+    max_limit = current_app.config.get('CHANGES_MAX_LIMIT', 1000)
+    if not limit or limit > max_limit:
+        limit = max_limit
+    wait = max(0, min(wait, current_app.config.get('CHANGES_MAX_WAIT', 60)))
+    result, seq = g.api.wait_for_changes(
+        since, g.auth_ctx, request.args.get('entity'), limit, wait)
+    return {'changes': result, 'seq': seq}
+
+
 @api_app.route('/audit', methods=['POST'])
 @authenticate
 @json_request
-@json_response
+@streaming_json_response
 def get_audit():
     def _audit_to_dict(x):
         return {'entity': x.entity,
@@ -176,8 +656,14 @@ def get_audit():
                 'data': x.data,
                 'user': x.user,
                 'stamp': x.stamp.isoformat()}
-    return [_audit_to_dict(x)
-            for x in g.api.get_audit(g.request_data, g.auth_ctx)]
+    return (_audit_to_dict(x)
+            for x in g.api.get_audit(g.request_data, g.auth_ctx))
+
+
+@api_app.route('/metrics')
+def get_metrics():
+    return Response(current_app.metrics.render(),
+                    content_type='text/plain; version=0.0.4')
 
 
 @api_app.route('/schema')
@@ -200,11 +686,22 @@ def make_app(config={}):
     app.config.from_envvar('APP_CONFIG', silent=True)
     app.config.update(config)
     app.register_blueprint(api_app)
+    if app.config.get('GZIP_MIN_SIZE', 1024) is not None:
+        app.after_request(compress_response)
+    app.metrics = metrics.Metrics(app.config.get('METRICS_DIR'))
+    app.before_request(start_request_timer)
+    app.after_request(record_request_metrics)
     # Initialize configdb configuration.
     if 'AUTH_FN' not in app.config:
         app.config['AUTH_FN'] = auth.user_auth_fn()
     if 'AUTH_CONTEXT_FN' not in app.config:
         app.config['AUTH_CONTEXT_FN'] = auth.user_auth_context_fn()
+    if (app.config.get('AUTH_CONTEXT_CACHE_TTL', 60)
+        and not isinstance(app.config['AUTH_CONTEXT_FN'],
+                           auth.AuthContextCache)):
+        app.config['AUTH_CONTEXT_FN'] = auth.AuthContextCache(
+            app.config['AUTH_CONTEXT_FN'],
+            ttl=app.config.get('AUTH_CONTEXT_CACHE_TTL', 60))
 
     # Read schema from the schema file.
     if 'SCHEMA_FILE' not in app.config:
@@ -216,7 +713,12 @@ def make_app(config={}):
     schema_obj = schema.Schema(app.config['SCHEMA_JSON'])
     db_driver = app.config.get('DB_DRIVER', 'sqlalchemy')
     db_opts = app.config.get('DB_OPTIONS', {})
-    if db_driver == 'sqlalchemy':
+    if app.config.get('REPLICA_OF'):
+        # Replicas keep all the data in memory.
+        from configdb.db.interface import inmemory_interface
+        db_driver = 'inmemory'
+        db = inmemory_interface.InMemoryDbInterface(schema_obj)
+    elif db_driver == 'sqlalchemy':
         from configdb.db.interface import sa_interface
         db = sa_interface.SqlAlchemyDbInterface(
             app.config.get('DB_URI', 'sqlite:///:memory:'),
@@ -241,11 +743,62 @@ def make_app(config={}):
     else:
         raise Exception('DB_DRIVER not supported: %s' % db_driver)
 
-    app.api = db_api.AdmDbApi(schema_obj, db)
+    from configdb.db.interface import instrumented_interface
+    db = instrumented_interface.InstrumentedDbInterface(
+        db, app.metrics.observe_db_call)
+
+    if app.config.get('DB_CACHE_SIZE'):
+        if db_driver == 'sqlalchemy':
+            raise Exception(
+                'DB_CACHE_SIZE is not supported by the sqlalchemy backend')
+        from configdb.db.interface import caching_interface
+        db = caching_interface.CachingDbInterface(
+            db, size=app.config['DB_CACHE_SIZE'],
+            ts_check_interval=app.config.get('DB_CACHE_TS_CHECK_INTERVAL', 1))
+
+    app.api = db_api.AdmDbApi(
+        schema_obj, db,
+        slow_threshold=app.config.get('SLOW_OPERATION_THRESHOLD'),
+        timestamp_flush_interval=app.config.get('TIMESTAMP_FLUSH_INTERVAL'))
+
+    app.replica = None
+    if app.config.get('REPLICA_OF'):
+        app.replica = _make_replica(app, schema_obj, db)
+
+    def _close():
+        app.api.close()
+        app.metrics.close()
+
+    # Called by the prefork server when a worker exits.
+    app.close = _close
+    if app.api.timestamps or app.metrics.path:
+        # Write the pending timestamps, and retire the metrics of this
+        # process, when it exits.
+        atexit.register(app.close)
 
     return app
 
 
+def _make_replica(app, schema_obj, db):
+    """Load a copy of the primary server data, and keep it updated."""
+    url = app.config['REPLICA_OF']
+    conn = app.config.get('REPLICA_CONNECTION')
+    if conn is None:
+        from configdb.client import connection
+        conn = connection.Connection(
+            url, schema_obj,
+            username=app.config.get('REPLICA_USERNAME'),
+            password=app.config.get('REPLICA_PASSWORD'),
+            cache_size=0)
+    rep = replica.Replica(
+        conn, schema_obj, db, url,
+        wait=app.config.get('REPLICA_WAIT', 30),
+        batch_size=app.config.get('REPLICA_BATCH_SIZE', 1000))
+    rep.load_snapshot()
+    rep.start()
+    return rep
+
+
 def main(argv=None):
     import argparse
     import os
@@ -253,9 +806,24 @@ def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--config',
                         help='Location of the app config file')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on (default 127.0.0.1)')
     parser.add_argument('--port', type=int, default=3000,
                         help='TCP port to listen to (default 3000)')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of worker processes. If set, run the '
+                        'pre-forking production server instead of the '
+                        'development one')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Threads per worker process (default 8)')
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='Listen queue size (default 128)')
+    parser.add_argument('--keepalive', type=int, default=5,
+                        help='Timeout for idle persistent connections, '
+                        'in seconds, 0 to disable them (default 5)')
+    parser.add_argument('--replica-of', metavar='URL',
+                        help='Run as a read replica of the server at URL')
     args = parser.parse_args(argv)
 
     if args.config:
@@ -264,9 +832,22 @@ def main(argv=None):
     logging.basicConfig(
         level=logging.DEBUG if args.debug else logging.INFO)
 
+    config = {}
+    if args.replica_of:
+        config['REPLICA_OF'] = args.replica_of
+    app_factory = functools.partial(make_app, config)
+
     try:
-        app = make_app()
-        app.run(port=args.port, debug=args.debug)
+        if args.workers > 0:
+            from configdb.server import prefork
+            server = prefork.PreforkServer(
+                app_factory, host=args.host, port=args.port,
+                workers=args.workers, threads=args.threads,
+                backlog=args.backlog, keepalive=args.keepalive)
+            server.serve()
+        else:
+            app = app_factory()
+            app.run(host=args.host, port=args.port, debug=args.debug)
     except Exception, e:
         log.exception('Fatal error')
         return 1
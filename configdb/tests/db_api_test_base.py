@@ -1,7 +1,10 @@
 from configdb import exceptions
 from configdb.db import db_api
 from configdb.db import acl
+import sys
+import threading
 import time
+import traceback
 
 
 class DbApiTestBase(object):
@@ -113,6 +116,56 @@ class DbApiTestBase(object):
         self.assertEquals(1, len(result))
         self.assertEquals('obz', result[0].name)
 
+    def test_find_paginated(self):
+        result = list(self.api.find('role', {}, self.ctx, limit=2))
+        self.assertEquals(['a/i', 'role1'], [x.name for x in result])
+
+        results, cursor = self.api.find_page('role', {}, self.ctx, 2)
+        self.assertEquals(['a/i', 'role1'], [x.name for x in results])
+        results, cursor = self.api.find_page('role', {}, self.ctx, 2, cursor)
+        self.assertEquals(['role1b', 'role2'], [x.name for x in results])
+        results, cursor = self.api.find_page('role', {}, self.ctx, 2, cursor)
+        self.assertEquals([], results)
+        self.assertEquals(None, cursor)
+
+    def test_find_paginated_with_query(self):
+        query = {'name': {'type': 'regexp', 'pattern': '^role'}}
+        results, cursor = self.api.find_page('role', query, self.ctx, 1)
+        self.assertEquals(['role1'], [x.name for x in results])
+        results, cursor = self.api.find_page('role', query, self.ctx, 5,
+                                             cursor)
+        self.assertEquals(['role1b', 'role2'], [x.name for x in results])
+        self.assertEquals(None, cursor)
+
+    def test_find_paginated_bad_arguments(self):
+        self.assertRaises(exceptions.QueryError,
+                          self.api.find, 'role', {}, self.ctx, limit=0)
+        self.assertRaises(exceptions.QueryError,
+                          self.api.find, 'role', {}, self.ctx,
+                          cursor='not a cursor')
+
+    def test_find_with_fields(self):
+        result = list(
+            self.api.find('host',
+                          {'name': {'type': 'eq', 'value': 'obz'}},
+                          self.ctx, fields=['ip']))
+        self.assertEquals(1, len(result))
+        self.assertEquals('obz', result[0].name)
+        self.assertEquals('1.2.3.4', result[0].ip)
+
+    def test_find_with_relation_fields(self):
+        result = list(
+            self.api.find('host', {'ip': {'type': 'eq', 'value': '1.2.3.4'}},
+                          self.ctx, fields=['roles']))
+        self.assertEquals(1, len(result))
+        self.assertEquals(set(['role1', 'role1b', 'a/i']),
+                          set(x.name for x in result[0].roles))
+
+    def test_find_with_unknown_fields(self):
+        self.assertRaises(exceptions.ValidationError,
+                          self.api.find, 'host', {}, self.ctx,
+                          fields=['unknown'])
+
     def test_find_bad_query_spec_unknown_type(self):
         self.assertRaises(exceptions.QueryError,
                           self.api.find,
@@ -239,6 +292,14 @@ class DbApiTestBase(object):
             self.api.update('host', 'obz', {'roles': None}, self.ctx))
         self.assertEquals(0, len(self.api.get('host', 'obz', self.ctx).roles))
 
+    def test_update_add_and_remove_relations(self):
+        self.assertTrue(
+            self.api.update('host', 'obz',
+                            {'roles': ['role1', 'role2', 'a/i']}, self.ctx))
+        new_roles = set(x.name
+                        for x in self.api.get('host', 'obz', self.ctx).roles)
+        self.assertEquals(set(['role1', 'role2', 'a/i']), new_roles)
+
     def test_update_modify_relation_error(self):
         self.assertRaises(exceptions.RelationError,
                           self.api.update,
@@ -341,6 +402,143 @@ class DbApiTestBase(object):
         r = self.api.update('user', 'testuser', user_data, auth_ctx)
         self.assertTrue(r)
 
+    def test_acl_memo_is_scoped_to_a_call(self):
+        self.ctx.acl_memo['stale'] = True
+        self.api.get('host', 'obz', self.ctx)
+        self.assertEquals({}, self.ctx.acl_memo)
+        self.api.update('host', 'obz', {'ip': '2.3.4.5'}, self.ctx)
+        self.assertEquals({}, self.ctx.acl_memo)
+
+    def _create_projects(self):
+        with self.db.session() as s:
+            u = self.db.get_by_name('user', 'testuser', s)
+            u2 = self.db.create('user', {'name': u'otheruser'}, s)
+            for i in xrange(5):
+                p = self.db.create('project', {'name': u'project%d' % i}, s)
+                p.members.append(u2)
+                if i % 2:
+                    p.members.append(u)
+                s.add(p)
+        with self.db.session() as s:
+            testuser = self.db.get_by_name('user', 'testuser', s)
+            self.db.detach(testuser, s)
+        auth_ctx = acl.AuthContext(testuser.name)
+        auth_ctx.set_self(testuser)
+        return auth_ctx
+
+    def test_find_filters_by_relation_acl(self):
+        auth_ctx = self._create_projects()
+        query = {'name': {'type': 'substring', 'value': 'project'}}
+        result = self.api.find('project', query, auth_ctx)
+        self.assertEquals(['project1', 'project3'],
+                          sorted(x.name for x in result))
+
+        # The admin can see all the projects.
+        result = self.api.find('project', query, self.ctx)
+        self.assertEquals(5, len(list(result)))
+
+        # Without a 'self' object, no project is visible.
+        result = self.api.find('project', query,
+                               acl.AuthContext('testuser'))
+        self.assertEquals([], list(result))
+
+    def test_find_bad_arguments_without_visible_objects(self):
+        # No project is visible without a 'self' object, but bad
+        # arguments are still rejected.
+        auth_ctx = acl.AuthContext('testuser')
+        self.assertEquals([], list(self.api.find('project', {}, auth_ctx)))
+        self.assertRaises(exceptions.QueryError,
+                          self.api.find, 'project', {}, auth_ctx,
+                          limit='abc')
+        self.assertRaises(exceptions.QueryError,
+                          self.api.find, 'project', {}, auth_ctx,
+                          cursor='not a cursor')
+        self.assertRaises(exceptions.ValidationError,
+                          self.api.find, 'project', {}, auth_ctx,
+                          fields=['nonexisting'])
+
+    def test_find_page_filters_by_relation_acl(self):
+        auth_ctx = self._create_projects()
+        query = {'name': {'type': 'substring', 'value': 'project'}}
+        results, cursor = self.api.find_page('project', query, auth_ctx, 1)
+        self.assertEquals(['project1'], [x.name for x in results])
+        results, cursor = self.api.find_page('project', query, auth_ctx, 1,
+                                             cursor)
+        self.assertEquals(['project3'], [x.name for x in results])
+        results, cursor = self.api.find_page('project', query, auth_ctx, 1,
+                                             cursor)
+        self.assertEquals([], results)
+        self.assertEquals(None, cursor)
+
+    def test_changes(self):
+        if not self.db.CHANGES_SUPPORT:
+            return
+        self.assertEquals(([], 0), self.api.get_changes(0, self.ctx))
+        self.api.create('role', {'name': 'role3'}, self.ctx)
+        self.api.update('host', 'obz', {'ip': '2.3.4.5'}, self.ctx)
+        # Updates that don't change anything are not recorded.
+        self.api.update('host', 'obz', {'ip': '2.3.4.5'}, self.ctx)
+        self.api.delete('role', 'role3', self.ctx)
+
+        changes, seq = self.api.get_changes(0, self.ctx)
+        self.assertEquals([('role', 'role3', 'create'),
+                           ('host', 'obz', 'update'),
+                           ('role', 'role3', 'delete')],
+                          [(x['entity'], x['name'], x['op'])
+                           for x in changes])
+        seqs = [x['seq'] for x in changes]
+        self.assertEquals(sorted(seqs), seqs)
+        self.assertEquals(seqs[-1], seq)
+
+        changes, seq2 = self.api.get_changes(seqs[0], self.ctx, 'role')
+        self.assertEquals([seqs[2]], [x['seq'] for x in changes])
+        changes, seq2 = self.api.get_changes(0, self.ctx, limit=1)
+        self.assertEquals([seqs[0]], [x['seq'] for x in changes])
+        self.assertEquals(([], seq), self.api.get_changes(seq, self.ctx))
+        # A negative sequence number only asks for the last one.
+        self.assertEquals(([], seq), self.api.get_changes(-1, self.ctx))
+        self.assertEquals(([], seq), self.api.wait_for_changes(
+                -1, self.ctx, timeout=10))
+
+    def test_changes_not_supported(self):
+        self.db.CHANGES_SUPPORT = False
+        for since in (-1, 0):
+            try:
+                self.api.get_changes(since, self.ctx)
+                self.fail('no error raised')
+            except exceptions.Error, e:
+                self.assertTrue('not supported' in str(e))
+        self.assertRaises(exceptions.Error, self.api.wait_for_changes,
+                          0, self.ctx, timeout=10)
+
+    def test_changes_are_filtered_by_acl(self):
+        if not self.db.CHANGES_SUPPORT:
+            return
+        self.api.create('private', {'name': 'secret'}, self.ctx)
+        self.api.create('role', {'name': 'role3'}, self.ctx)
+        changes, seq = self.api.get_changes(
+            0, acl.AuthContext('bad_user'))
+        self.assertEquals(['role3'], [x['name'] for x in changes])
+        self.assertRaises(exceptions.AclError, self.api.get_changes,
+                          0, acl.AuthContext('bad_user'), 'private')
+
+    def test_wait_for_changes(self):
+        if not self.db.CHANGES_SUPPORT:
+            return
+        self.assertEquals(([], 0), self.api.wait_for_changes(
+                0, self.ctx, timeout=0.01))
+
+        def _create():
+            time.sleep(0.05)
+            self.api.create('role', {'name': 'role3'}, self.ctx)
+        t = threading.Thread(target=_create)
+        t.start()
+        start = time.time()
+        changes, seq = self.api.wait_for_changes(0, self.ctx, timeout=10)
+        t.join()
+        self.assertEquals(['role3'], [x['name'] for x in changes])
+        self.assertTrue(time.time() - start < 5)
+
     def test_get_audit_fails_if_not_supported(self):
         if not self.db.AUDIT_SUPPORT:
             self.assertRaises(NotImplementedError,
@@ -370,6 +568,58 @@ class DbApiTestBase(object):
                           {'entity': 'private', 'op': 'create'},
                           auth_ctx)
 
+    def test_bulk(self):
+        ops = [{'op': 'create', 'entity': 'role',
+                'data': {'name': 'role3'}},
+               {'op': 'create', 'entity': 'host',
+                'data': {'name': 'utz', 'ip': '2.3.4.5',
+                         'roles': ['role3']}},
+               {'op': 'update', 'entity': 'host', 'name': 'obz',
+                'data': {'ip': '2.3.4.6'}},
+               {'op': 'delete', 'entity': 'role', 'name': 'role2'}]
+        self.assertEquals([True, True, True, True],
+                          self.api.bulk(ops, self.ctx))
+
+        self.assertEquals(
+            ['role3'],
+            [x.name for x in self.api.get('host', 'utz', self.ctx).roles])
+        self.assertEquals('2.3.4.6', self.api.get('host', 'obz', self.ctx).ip)
+        self.assertRaises(exceptions.NotFound,
+                          self.api.get, 'role', 'role2', self.ctx)
+        self.assertTrue(self.api.get_timestamp('role', self.ctx).ts > 0)
+        self.assertTrue(self.api.get_timestamp('host', self.ctx).ts > 0)
+
+    def test_bulk_error_reports_operation(self):
+        ops = [{'op': 'update', 'entity': 'host', 'name': 'obz',
+                'data': {'ip': '2.3.4.6'}},
+               {'op': 'update', 'entity': 'host', 'name': 'obz',
+                'data': {'ip': '299.0.0.1'}}]
+        try:
+            self.api.bulk(ops, self.ctx)
+            self.fail('ValidationError not raised')
+        except exceptions.ValidationError, e:
+            self.assertTrue(str(e).startswith('operation 1: '))
+            # The traceback leads to where the error was raised.
+            tb = traceback.extract_tb(sys.exc_info()[2])
+            self.assertNotEquals('bulk', tb[-1][2])
+
+    def test_bulk_bad_operation(self):
+        self.assertRaises(exceptions.ValidationError,
+                          self.api.bulk,
+                          [{'op': 'rename', 'entity': 'host', 'name': 'obz'}],
+                          self.ctx)
+        self.assertRaises(exceptions.ValidationError,
+                          self.api.bulk,
+                          {'op': 'delete', 'entity': 'host', 'name': 'obz'},
+                          self.ctx)
+
+    def test_bulk_bad_acl(self):
+        auth_ctx = acl.AuthContext('bad_user')
+        self.assertRaises(exceptions.AclError,
+                          self.api.bulk,
+                          [{'op': 'delete', 'entity': 'host', 'name': 'obz'}],
+                          auth_ctx)
+
     def test_timestamp_is_updated(self):
         result = self.api.update('host', 'obz', {'ip': '2.3.4.5'}, self.ctx)
         self.assertTrue(result)
@@ -381,5 +631,52 @@ class DbApiTestBase(object):
         ts2 = self.api.get_timestamp('host', self.ctx).ts
         self.assertTrue(ts2 > ts1)
 
+    def test_last_modified_includes_related_entities(self):
+        self.assertEquals(None, self.api.get_last_modified('host', self.ctx))
+        self.api.update('host', 'obz', {'ip': '2.3.4.5'}, self.ctx)
+        ts1 = self.api.get_last_modified('host', self.ctx)
+        self.assertEquals(self.api.get_timestamp('host', self.ctx).ts, ts1)
+        time.sleep(0.01)
+        self.api.update('role', 'role2', {'name': 'role2'}, self.ctx)
+        ts2 = self.api.get_last_modified('host', self.ctx)
+        self.assertTrue(ts2 > ts1)
+        self.assertEquals(ts2, self.api.get_last_modified('role', self.ctx))
+
+    def test_coalesced_timestamps(self):
+        api = db_api.AdmDbApi(self.get_schema(), self.db,
+                              timestamp_flush_interval=3600)
+        api.update('host', 'obz', {'ip': '2.3.4.5'}, self.ctx)
+        ts = api.get_last_modified('host', self.ctx)
+        self.assertTrue(ts > 0)
+        # The timestamp has not been written yet.
+        self.assertEquals(None, self.api.get_last_modified('host', self.ctx))
+
+        # Reading it forces a flush.
+        self.assertEquals(ts, api.get_timestamp('host', self.ctx).ts)
+        self.assertEquals(ts, self.api.get_last_modified('host', self.ctx))
+
+        api.update('role', 'role2', {'name': 'role2'}, self.ctx)
+        self.assertEquals(None, self.api.get_last_modified('role', self.ctx))
+        api.timestamps.close()
+        self.assertTrue(self.api.get_last_modified('role', self.ctx) >= ts)
+
+    def test_coalesced_timestamps_are_dropped_on_rollback(self):
+        api = db_api.AdmDbApi(self.get_schema(), self.db,
+                              timestamp_flush_interval=3600)
+        self.assertRaises(exceptions.RelationError, api.bulk,
+                          [{'op': 'update', 'entity': 'host', 'name': 'obz',
+                            'data': {'ip': '2.3.4.5'}},
+                           {'op': 'update', 'entity': 'role', 'name': 'role1',
+                            'data': {'name': 'role1'}},
+                           {'op': 'update', 'entity': 'host', 'name': 'obz',
+                            'data': {'roles': ['nonexisting']}}],
+                          self.ctx)
+        self.assertEquals({}, api.timestamps.pending(['host', 'role']))
+        before = time.time()
+        api.update('host', 'obz', {'ip': '2.3.4.5'}, self.ctx)
+        # Stamped with the commit time.
+        self.assertTrue(api.timestamps.pending(['host'])['host'] >= before)
+        api.timestamps.close()
+
     def test_timestamp_for_non_updated_entity(self):
         self.assertRaises(ValueError, self.api.get_timestamp, 'role', self.ctx)
@@ -48,6 +48,15 @@ class DbInterfaceTestBase(object):
             self.assertEquals(['role1'], role_names)
         db.close()
 
+    def test_get_many(self):
+        db = self.load_db()
+        with db.session() as s:
+            result = db.get_many('host', ['obz', 'oba', 'nonexisting'], s)
+            self.assertEquals(set(['obz', 'oba']), set(result.keys()))
+            self.assertEquals('1.2.3.4', result['obz'].ip)
+            self.assertEquals({}, db.get_many('host', [], s))
+        db.close()
+
     def _find(self, db, entity_name, raw_query):
         query = dict((k, db.parse_query_spec(v))
                      for k, v in raw_query.iteritems())
@@ -68,6 +77,17 @@ class DbInterfaceTestBase(object):
         self.assertEquals('obz', r[0].name)
         db.close()
 
+    def test_find_paginated(self):
+        db = self.load_db()
+        with db.session() as s:
+            r = list(db.find('host', {}, s, limit=1))
+            self.assertEquals(['oba'], [x.name for x in r])
+            r = list(db.find('host', {}, s, limit=1, after='oba'))
+            self.assertEquals(['obz'], [x.name for x in r])
+            r = list(db.find('host', {}, s, after='obz'))
+            self.assertEquals([], r)
+        db.close()
+
     def test_find_nonexisting(self):
         db = self.load_db()
         r = self._find(db, 'host', {'name': {'type': 'eq', 'value': 'nonexisting'}})
@@ -94,3 +114,12 @@ class DbInterfaceTestBase(object):
         r = self._find(db, 'host', {'roles': {'type': 'eq', 'value':'zzzz'}})
         self.assertEquals(0, len(r))
         db.close()
+
+    def test_set_timestamp_only_increases(self):
+        db = self.init_db()
+        for ts in (100, 50, 200, 150):
+            with db.session() as s:
+                db.set_timestamp('host', ts, s)
+        with db.session() as s:
+            self.assertEquals(200, db.get_by_name('__timestamp', 'host', s).ts)
+        db.close()
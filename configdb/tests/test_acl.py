@@ -152,4 +152,112 @@ class AclCheckTest(TestBase):
 
         self.assertFalse(
             obj.acl_check(self.ctx, 'w', StubDbObj('other')))
-            
+
+    def test_check_user_by_relation_compares_names(self):
+        obj = StubObj({'w': '@parents'})
+        dbobj = StubDbObj('cur', [StubDbObj('self')])
+        # The 'self' object usually comes from another session.
+        self.ctx.set_self(StubDbObj('self'))
+        self.assertTrue(
+            obj.acl_check(self.ctx, 'w', dbobj))
+
+    def test_check_user_by_relation_uses_relation_index(self):
+        obj = StubObj({'w': '@parents'})
+        dbobj = StubDbObj('cur', frozenset(['self']))
+        self.ctx.set_self(StubDbObj('self'))
+        self.assertTrue(
+            obj.acl_check(self.ctx, 'w', dbobj))
+
+
+class CountingRule(acl.AclRule):
+
+    def __init__(self):
+        self.calls = 0
+
+    def match(self, ctx, obj):
+        self.calls += 1
+        return False
+
+
+class AclCompileTest(TestBase):
+
+    def test_compile_any(self):
+        fn, uses_obj = acl.compile_acl_rules(
+            acl._parse_acl_rules('user/admin,*'))
+        self.assertFalse(uses_obj)
+        self.assertTrue(fn(acl.AuthContext('bad_user'), None))
+
+    def test_compile_none(self):
+        fn, uses_obj = acl.compile_acl_rules(acl._parse_acl_rules('!'))
+        self.assertFalse(uses_obj)
+        self.assertFalse(fn(acl.AuthContext('admin'), None))
+
+    def test_compile_users_and_groups(self):
+        fn, uses_obj = acl.compile_acl_rules(
+            acl._parse_acl_rules('user/admin,group/admins'))
+        self.assertFalse(uses_obj)
+        self.assertTrue(fn(acl.AuthContext('admin'), None))
+        self.assertTrue(fn(acl.AuthContext('user', ['admins']), None))
+        self.assertFalse(fn(acl.AuthContext('user', ['users']), None))
+
+    def test_compile_object_rules(self):
+        fn, uses_obj = acl.compile_acl_rules(acl._parse_acl_rules('@self'))
+        self.assertTrue(uses_obj)
+        ctx = acl.AuthContext('user')
+        ctx.set_self(StubDbObj('user'))
+        self.assertTrue(fn(ctx, StubDbObj('user')))
+        self.assertFalse(fn(ctx, StubDbObj('other')))
+
+    def test_compile_custom_rules(self):
+        rule = CountingRule()
+        fn, uses_obj = acl.compile_acl_rules([acl.RuleNone(), rule])
+        self.assertTrue(uses_obj)
+        self.assertFalse(fn(acl.AuthContext('admin'), None))
+        self.assertEquals(1, rule.calls)
+
+    def test_copy_context(self):
+        ctx = acl.AuthContext('admin', ['admins'])
+        ctx.set_self(StubDbObj('admin'))
+        ctx.acl_memo['key'] = True
+        ctx2 = ctx.copy()
+        self.assertEquals('admin', ctx2.get_username())
+        self.assertEquals(['admins'], ctx2.groups)
+        self.assertEquals('admin', ctx2.get_self().name)
+        self.assertEquals({}, ctx2.acl_memo)
+        self.assertEquals({'key': True}, ctx.acl_memo)
+
+
+class RowFilterTest(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.ctx = acl.AuthContext('user', ['users'])
+        self.ctx.set_self(StubDbObj('user'))
+
+    def test_no_filter_when_context_matches(self):
+        self.assertEquals(None, acl.make_row_filter(
+                acl._parse_acl_rules('group/users,@self'), self.ctx))
+        self.assertEquals(None, acl.make_row_filter(
+                acl._parse_acl_rules('*'), self.ctx))
+
+    def test_denied(self):
+        self.assertEquals(False, acl.make_row_filter(
+                acl._parse_acl_rules('user/admin,!'), self.ctx))
+
+    def test_filter(self):
+        f = acl.make_row_filter(
+            acl._parse_acl_rules('user/admin,@self,@parents'), self.ctx)
+        self.assertEquals('user', f.self_name)
+        self.assertTrue(f.match_self)
+        self.assertEquals(['parents'], f.rel_attrs)
+        self.assertFalse(f.matches_nothing())
+        self.assertTrue(f(StubDbObj('user')))
+        self.assertTrue(f(StubDbObj('x', [StubDbObj('user')])))
+        self.assertFalse(f(StubDbObj('x', [StubDbObj('other')])))
+        self.assertFalse(f(StubDbObj('x')))
+
+    def test_filter_without_self(self):
+        f = acl.make_row_filter(acl._parse_acl_rules('@self'),
+                                acl.AuthContext('user'))
+        self.assertTrue(f.matches_nothing())
+        self.assertFalse(f(StubDbObj('user')))
@@ -1,3 +1,4 @@
+import contextlib
 import crypt
 import mox
 import os
@@ -16,6 +17,17 @@ class UserObj(object):
             self.password = crypt.crypt(password, 'az')
 
 
+class TsObj(object):
+
+    def __init__(self, ts):
+        self.ts = ts
+
+
+@contextlib.contextmanager
+def fake_session(session):
+    yield session
+
+
 class ApiObj(object):
 
     def __init__(self, db):
@@ -36,7 +48,7 @@ class UserAuthTest(TestBase):
         TestBase.tearDown(self)
 
     def test_auth_user_fn_ok(self):
-        self.db.Session().AndReturn(self.session)
+        self.db.session().AndReturn(fake_session(self.session))
         self.db.get_by_name('user', 'admin', self.session).AndReturn(
             UserObj('admin', 'pw'))
         self.mox.ReplayAll()
@@ -48,7 +60,7 @@ class UserAuthTest(TestBase):
                                  'password': 'pw'}))
 
     def test_auth_user_fn_wrong_password(self):
-        self.db.Session().AndReturn(self.session)
+        self.db.session().AndReturn(fake_session(self.session))
         self.db.get_by_name('user', 'admin', self.session).AndReturn(
             UserObj('admin', 'pw'))
         self.mox.ReplayAll()
@@ -68,7 +80,7 @@ class UserAuthTest(TestBase):
             fn(ApiObj(self.db), {'username': 'admin'}))
 
     def test_auth_user_fn_nonexisting_user(self):
-        self.db.Session().AndReturn(self.session)
+        self.db.session().AndReturn(fake_session(self.session))
         self.db.get_by_name('user', 'admin', self.session).AndReturn(None)
         self.mox.ReplayAll()
 
@@ -80,9 +92,10 @@ class UserAuthTest(TestBase):
 
 
     def test_auth_user_context_ok(self):
-        self.db.Session().AndReturn(self.session)
+        self.db.session().AndReturn(fake_session(self.session))
         user_obj = UserObj('admin', 'pw')
         self.db.get_by_name('user', 'admin', self.session).AndReturn(user_obj)
+        self.db.detach(user_obj, self.session)
         self.mox.ReplayAll()
 
         fn = auth.user_auth_context_fn()
@@ -90,3 +103,60 @@ class UserAuthTest(TestBase):
         self.assertTrue(isinstance(ctx, acl.AuthContext))
         self.assertEquals(user_obj, ctx.get_self())
 
+
+class AuthContextCacheTest(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.mox = mox.Mox()
+        self.db = self.mox.CreateMockAnything()
+        self.ctx_fn = self.mox.CreateMockAnything()
+        self.session = 'Session'
+        self.api = ApiObj(self.db)
+
+    def tearDown(self):
+        self.mox.VerifyAll()
+        self.mox.UnsetStubs()
+        TestBase.tearDown(self)
+
+    def _expect_timestamp(self, ts):
+        self.db.session().AndReturn(fake_session(self.session))
+        self.db.get_by_name('__timestamp', 'user', self.session).AndReturn(
+            TsObj(ts) if ts else None)
+
+    def test_cached_context(self):
+        ctx = acl.AuthContext('admin')
+        self._expect_timestamp(None)
+        self.ctx_fn(self.api, 'admin').AndReturn(ctx)
+        self.mox.ReplayAll()
+
+        cache = auth.AuthContextCache(self.ctx_fn, ts_check_interval=60)
+        self.assertEquals(ctx, cache(self.api, 'admin'))
+        self.assertEquals(ctx, cache(self.api, 'admin'))
+
+    def test_ttl(self):
+        ctx = acl.AuthContext('admin')
+        self._expect_timestamp(None)
+        self.ctx_fn(self.api, 'admin').AndReturn(ctx)
+        self.ctx_fn(self.api, 'admin').AndReturn(ctx)
+        self.mox.ReplayAll()
+
+        cache = auth.AuthContextCache(self.ctx_fn, ttl=-1,
+                                      ts_check_interval=60)
+        cache(self.api, 'admin')
+        cache(self.api, 'admin')
+
+    def test_invalidate_on_user_timestamp_change(self):
+        ctx1 = acl.AuthContext('admin')
+        ctx2 = acl.AuthContext('admin')
+        self._expect_timestamp(None)
+        self.ctx_fn(self.api, 'admin').AndReturn(ctx1)
+        self._expect_timestamp(None)
+        self._expect_timestamp(1234)
+        self.ctx_fn(self.api, 'admin').AndReturn(ctx2)
+        self.mox.ReplayAll()
+
+        cache = auth.AuthContextCache(self.ctx_fn, ts_check_interval=0)
+        self.assertEquals(ctx1, cache(self.api, 'admin'))
+        self.assertEquals(ctx1, cache(self.api, 'admin'))
+        self.assertEquals(ctx2, cache(self.api, 'admin'))
@@ -20,7 +20,8 @@ class BackupTest(mox.MoxTestBase):
         self.conn._schema = self.mox.CreateMockAnything()
 
     def test_dump_and_restore(self):
-        self.conn._schema.get_dependency_sequence().AndReturn(['user', 'group'])
+        self.conn._schema.get_dependency_levels().MultipleTimes().AndReturn(
+            ([['user'], ['group']], {}))
         self.conn.find('user',{'name': {'pattern': '^.*$', 'type': 'regexp'} }).AndReturn([
                 {'id': 1, 'name': 'user1'},
                 {'id': 2, 'name': 'user2'}])
@@ -49,6 +50,7 @@ class BackupTest(mox.MoxTestBase):
         data = ''.join([struct.pack('I', 1024), 'short record'])
         buf = StringIO.StringIO(data)
 
+        self.conn._schema.get_dependency_levels().AndReturn(([], {}))
         self.mox.ReplayAll()
 
         b = backup.Dumper(self.conn)
@@ -59,10 +61,30 @@ class BackupTest(mox.MoxTestBase):
         data += self._create_record('user', {'id': 1, 'name': 'user1'})
         buf = StringIO.StringIO(data)
 
-        self.conn.create('user', {'id': 1, 'name': 'user1'})        
+        self.conn._schema.get_dependency_levels().AndReturn(([], {}))
+        self.conn.create('user', {'id': 1, 'name': 'user1'})
+
+        self.mox.ReplayAll()
+
+        b = backup.Dumper(self.conn)
+        b.restore(buf)
+
+    def test_restore_deferred_relations(self):
+        data = self._create_record(
+            'group', {'name': 'group1', 'users': ['user1']})
+        data += self._create_record(
+            'user', {'name': 'user1', 'groups': ['group1']})
+        data += self._create_record('group', {'name': 'group2', 'users': []})
+        buf = StringIO.StringIO(data)
+
+        self.conn._schema.get_dependency_levels().AndReturn(
+            ([['group'], ['user']], {'group': ['users']}))
+        self.conn.create('group', {'name': 'group1'})
+        self.conn.create('user', {'name': 'user1', 'groups': ['group1']})
+        self.conn.create('group', {'name': 'group2', 'users': []})
+        self.conn.update('group', 'group1', {'users': ['user1']})
 
         self.mox.ReplayAll()
 
         b = backup.Dumper(self.conn)
         b.restore(buf)
-        
@@ -0,0 +1,91 @@
+import json
+import os
+import subprocess
+import sys
+from configdb.tests import *
+from configdb.benchmarks import dataset
+from configdb.benchmarks import main
+from configdb.benchmarks import report
+from configdb.benchmarks import suite
+from configdb.db.interface import inmemory_interface
+
+
+class DatasetTest(TestBase):
+
+    def test_dataset(self):
+        data = dataset.Dataset(scale=200, fanout=5)
+        objects = list(data.objects())
+        self.assertEquals(len(data), len(objects))
+        self.assertEquals(200, len([x for x in objects if x[0] == 'host']))
+        for entity_name, obj in objects:
+            if entity_name == 'host':
+                self.assertTrue(len(obj['roles']) <= 5)
+        self.assertEquals(objects, list(dataset.Dataset(200, 5).objects()))
+
+
+class SuiteTest(TestBase):
+
+    def test_run_suite(self):
+        schema_obj = self.get_large_schema()
+        driver = suite.ApiDriver(
+            schema_obj, inmemory_interface.InMemoryDbInterface(schema_obj))
+        results = suite.run_suite(driver, dataset.Dataset(50, 3), samples=5)
+        self.assertEquals(
+            set(['create', 'get', 'find_indexed', 'find_scan', 'update',
+                 'relation_diff', 'delete']),
+            set(results))
+        self.assertEquals(5, results['get']['ops'])
+        self.assertEquals(1, results['find_scan']['ops'])
+        self.assertEquals(45, len(driver.find('host', {})))
+
+    def test_run_micro(self):
+        results = suite.run_micro(samples=1, width=8)
+        self.assertEquals(set(['unpack_wide', 'unpack_query', 'to_net_wide',
+                               'to_net_wide_dict', 'from_net_dated',
+                               'from_net_many_dated']),
+                          set(results))
+        self.assertEquals(10, results['unpack_wide']['ops'])
+
+    def get_large_schema(self):
+        from configdb.db import schema
+        with open(main.DEFAULT_SCHEMA_FILE) as fd:
+            return schema.Schema(fd.read())
+
+
+class ReportTest(TestBase):
+
+    def _report(self, **times):
+        return report.make_report(
+            {'inmemory': dict((op, {'ops': 1, 'seconds': t,
+                                    'seconds_per_op': t})
+                              for op, t in times.iteritems())},
+            {'scale': 1})
+
+    def test_compare(self):
+        baseline = self._report(get=1.0, find=1.0)
+        self.assertEquals([], report.compare(
+                self._report(get=1.1, find=0.5, update=9), baseline))
+        self.assertEquals([('inmemory', 'get', 1.0, 2.0)],
+                          report.compare(self._report(get=2.0), baseline))
+
+    def test_main_fails_on_regression(self):
+        output = os.path.join(self._tmpdir, 'out.json')
+        baseline = os.path.join(self._tmpdir, 'baseline.json')
+        args = ['--backends=inmemory', '--scale=20', '--samples=2',
+                '--output', output]
+        self.assertEquals(0, main.main(args))
+        rep = report.load_report(output)
+        self.assertTrue(rep['results']['inmemory']['get']['ops'] > 0)
+
+        for result in rep['results']['inmemory'].itervalues():
+            result['seconds_per_op'] = 0
+        report.save_report(rep, baseline)
+        self.assertEquals(1, main.main(args + ['--baseline', baseline]))
+
+    def test_main_does_not_import_tests(self):
+        # The configdb-benchmark script must run without the test
+        # dependencies (nose).
+        code = ('import sys; import configdb.benchmarks.main; '
+                'sys.exit("configdb.tests" in sys.modules)')
+        self.assertEquals(0, subprocess.call([sys.executable, '-c', code]))
+        self.assertTrue(os.path.exists(main.DEFAULT_SCHEMA_FILE))
@@ -0,0 +1,129 @@
+import threading
+from configdb.db import acl
+from configdb.db import db_api
+from configdb.db.interface import caching_interface
+from configdb.db.interface import inmemory_interface
+from configdb.tests import *
+
+
+class CountingDbInterface(inmemory_interface.InMemoryDbInterface):
+
+    def __init__(self, schema):
+        inmemory_interface.InMemoryDbInterface.__init__(self, schema)
+        self.calls = 0
+
+    def get_by_name(self, entity_name, object_name, session):
+        if not entity_name.startswith('__'):
+            self.calls += 1
+        return inmemory_interface.InMemoryDbInterface.get_by_name(
+            self, entity_name, object_name, session)
+
+
+class CachingDbInterfaceTest(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.backend = CountingDbInterface(self.get_schema())
+        self.db = caching_interface.CachingDbInterface(
+            self.backend, size=2, ts_check_interval=0)
+        with self.db.session() as s:
+            for name in ('role1', 'role2', 'role3'):
+                self.db.create('role', {'name': name}, s)
+        self.api = db_api.AdmDbApi(self._schema, self.db)
+        self.ctx = acl.AuthContext('admin')
+
+    def _get(self, name):
+        with self.db.session() as s:
+            return self.db.get_by_name('role', name, s)
+
+    def test_hit_and_miss(self):
+        self.assertEquals('role1', self._get('role1').name)
+        self.assertEquals('role1', self._get('role1').name)
+        self.assertEquals(1, self.backend.calls)
+        self.assertEquals({'hits': 1, 'misses': 1, 'size': 1},
+                          self.db.stats())
+
+    def test_missing_objects_are_not_cached(self):
+        self.assertEquals(None, self._get('nonexisting'))
+        self.assertEquals(None, self._get('nonexisting'))
+        self.assertEquals(2, self.backend.calls)
+
+    def test_lru_eviction(self):
+        self._get('role1')
+        self._get('role2')
+        self._get('role1')
+        self._get('role3')
+        self.assertEquals(3, self.backend.calls)
+        self._get('role1')
+        self.assertEquals(3, self.backend.calls)
+        self._get('role2')
+        self.assertEquals(4, self.backend.calls)
+
+    def test_delete_invalidates(self):
+        self._get('role1')
+        self.api.delete('role', 'role1', self.ctx)
+        self.assertEquals(None, self._get('role1'))
+
+    def test_update_invalidates(self):
+        self._get('role1')
+        calls = self.backend.calls
+        with self.db.session() as s:
+            obj = self.db.get_by_name('role', 'role1', s)
+            s.add(obj)
+        self._get('role1')
+        self.assertEquals(calls + 1, self.backend.calls)
+
+    def test_rollback_invalidates_read_objects(self):
+        self._get('role1')
+        calls = self.backend.calls
+        try:
+            with self.db.session() as s:
+                self.db.get_by_name('role', 'role1', s)
+                raise RuntimeError('rollback')
+        except RuntimeError:
+            pass
+        self._get('role1')
+        self.assertEquals(calls + 1, self.backend.calls)
+
+    def test_timestamp_change_invalidates_entity(self):
+        self._get('role1')
+        self._get('role2')
+        # Simulate a change made by another process.
+        with self.backend.session() as s:
+            self.backend.create('__timestamp', {'name': 'role', 'ts': 42}, s)
+        calls = self.backend.calls
+        self._get('role1')
+        self._get('role2')
+        self.assertEquals(calls + 2, self.backend.calls)
+
+    def test_uncommitted_changes_are_not_shared(self):
+        with self.db.session() as s:
+            self.db.create('host', {'name': 'obz', 'ip': '1.2.3.4'}, s)
+        # Load the object in the cache.
+        with self.db.session() as s:
+            self.db.get_by_name('host', 'obz', s)
+
+        seen = []
+        def _read():
+            with self.db.session() as s:
+                seen.append(self.db.get_by_name('host', 'obz', s).ip)
+        try:
+            with self.db.session() as s:
+                obj = self.db.get_by_name('host', 'obz', s)
+                obj.ip = '2.3.4.5'
+                reader = threading.Thread(target=_read)
+                reader.start()
+                reader.join()
+                raise RuntimeError('rollback')
+        except RuntimeError:
+            pass
+        _read()
+        self.assertEquals(['1.2.3.4', '1.2.3.4'], seen)
+
+    def test_committed_changes_are_visible(self):
+        with self.db.session() as s:
+            self.db.create('host', {'name': 'obz', 'ip': '1.2.3.4'}, s)
+        self.api.update('host', 'obz', {'ip': '2.3.4.5'}, self.ctx)
+        self.assertEquals('2.3.4.5', self.api.get('host', 'obz', self.ctx).ip)
+        self.api.update('host', 'obz', {'ip': '3.4.5.6'}, self.ctx)
+        self.assertEquals('3.4.5.6', self.api.get('host', 'obz', self.ctx).ip)
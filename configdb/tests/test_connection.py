@@ -5,6 +5,8 @@ import mox
 import os
 import sys
 import urllib2
+import zlib
+import StringIO
 from configdb import exceptions
 from configdb.tests import *
 from configdb.client import connection
@@ -21,24 +23,66 @@ class FakeResponse(object):
     def read(self):
         return json.dumps({'ok': True, 'result': self.data})
 
+    def info(self):
+        return {}
+
+
+class ETagResponse(FakeResponse):
+
+    def __init__(self, data, etag):
+        FakeResponse.__init__(self, data)
+        self.etag = etag
+
+    def info(self):
+        return {'ETag': self.etag}
+
+
+class ETagComparator(mox.Comparator):
+
+    def __init__(self, etag):
+        self._etag = etag
+
+    def equals(self, rhs):
+        return rhs.get_header('If-none-match') == self._etag
+
+
+class StreamedResponse(object):
+
+    def __init__(self, data):
+        self.fd = StringIO.StringIO(data)
+
+    def read(self, size=-1):
+        return self.fd.read(size)
+
 
 class ErrorResponse(object):
 
     def read(self):
         return json.dumps({'ok': False, 'error': 'errmsg'})
 
+    def info(self):
+        return {}
+
+
+class ETagErrorResponse(ErrorResponse):
+
+    def info(self):
+        return {'ETag': '"tag1"'}
+
 
 class RequestComparator(mox.Comparator):
 
     def __init__(self, url, data):
         self._url = url
-        self._data = json.dumps(data) if data else None
+        self._data = data or None
 
     def equals(self, rhs):
         print 'REQUEST:', rhs.get_full_url(), rhs.get_data()
+        rhs_data = rhs.get_data()
         return (isinstance(rhs, urllib2.Request)
                 and (self._url == rhs.get_full_url())
-                and (self._data == rhs.get_data()))
+                and (self._data == (json.loads(rhs_data)
+                                    if rhs_data else None)))
 
 
 class ConnectionTest(TestBase):
@@ -167,6 +211,16 @@ class ConnectionTest(TestBase):
         conn = self._connect()
         self.assertEquals(obj, conn.get('host', 'obz'))
 
+    def test_get_with_fields(self):
+        obj = {'name': 'obz',
+               'ip': '1.2.3.4'}
+        self._mock_request('/get/host/obz?fields=ip', None, obj)
+
+        self.mox.ReplayAll()
+
+        conn = self._connect()
+        self.assertEquals(obj, conn.get('host', 'obz', fields=['ip']))
+
     def test_get_user(self):
         # test deserialization.
         obj = {'name': 'testuser',
@@ -247,6 +301,124 @@ class ConnectionTest(TestBase):
         result = conn.get_audit({'entity': 'host', 'object': 'obz'})
         self.assertEquals(1, len(result))
 
+    def test_iter_changes(self):
+        change = {'seq': 1, 'entity': 'host', 'name': 'obz', 'op': 'create',
+                  'stamp': 1.0}
+        self._mock_request('/changes?since=0', None,
+                           {'changes': [change], 'seq': 1})
+        self._mock_request('/changes?since=1', None,
+                           {'changes': [], 'seq': 3})
+        self._mock_request('/changes?since=3', None,
+                           {'changes': [], 'seq': 3})
+        self.mox.ReplayAll()
+
+        conn = self._connect()
+        self.assertEquals([change], list(conn.iter_changes(follow=False)))
+
+    def test_find_paginated(self):
+        self._mock_request('/find/host?limit=1',
+                           {'name': {'type': 'eq', 'value': 'obz'}},
+                           {'results': [{'name': 'obz'}],
+                            'cursor': 'CURSOR'})
+        self.mox.ReplayAll()
+
+        conn = self._connect()
+        result = conn.find('host', {'name': {'type': 'eq', 'value': 'obz'}},
+                           limit=1)
+        self.assertEquals([{'name': 'obz'}], result)
+        self.assertEquals('CURSOR', result.cursor)
+
+    def test_conditional_get(self):
+        self.opener.open(ETagComparator(None)).AndReturn(
+            ETagResponse({'name': 'obz'}, '"tag1"'))
+        self.opener.open(ETagComparator('"tag1"')).AndRaise(
+            urllib2.HTTPError(TEST_URL + '/get/host/obz', 304,
+                              'Not Modified', {}, None))
+        self.opener.open(ETagComparator('"tag1"')).AndReturn(
+            ETagResponse({'name': 'obz', 'ip': '1.2.3.4'}, '"tag2"'))
+        self.mox.ReplayAll()
+
+        conn = self._connect()
+        self.assertEquals({'name': 'obz'}, conn.get('host', 'obz'))
+        self.assertEquals({'name': 'obz'}, conn.get('host', 'obz'))
+        self.assertEquals({'name': 'obz', 'ip': '1.2.3.4'},
+                          conn.get('host', 'obz'))
+
+    def test_errors_are_not_cached(self):
+        self.opener.open(ETagComparator(None)).AndReturn(ETagErrorResponse())
+        self.opener.open(ETagComparator(None)).AndReturn(
+            ETagResponse({'name': 'obz'}, '"tag2"'))
+        self.mox.ReplayAll()
+
+        conn = self._connect()
+        self.assertRaises(exceptions.RpcError, conn.get, 'host', 'obz')
+        self.assertEquals({'name': 'obz'}, conn.get('host', 'obz'))
+
+    def test_compress_requests(self):
+        def _check_request(req):
+            return (req.get_header('Content-encoding') == 'gzip'
+                    and json.loads(zlib.decompress(
+                        req.get_data(), connection.GZIP_WBITS)) == {
+                        'ip': '2.3.4.5'})
+        self.opener.open(mox.Func(_check_request)).AndReturn(
+            FakeResponse(True))
+        self.mox.ReplayAll()
+
+        conn = self._connect(compress_requests=True)
+        self.assertTrue(conn.update('host', 'obz', {'ip': '2.3.4.5'}))
+
+    def test_find_streamed(self):
+        self.opener.open(
+            RequestComparator(TEST_URL + '/find/host?stream=1',
+                              {'name': {'type': 'eq', 'value': 'obz'}})
+            ).AndReturn(StreamedResponse(
+                '{"ok": true, "result": [{"name": "obz"}, {"name": "a]b"}]}'))
+        self.mox.ReplayAll()
+
+        conn = self._connect()
+        result = conn.find('host', {'name': {'type': 'eq', 'value': 'obz'}},
+                           stream=True)
+        self.assertEquals([{'name': 'obz'}, {'name': 'a]b'}], list(result))
+
+    def test_find_streamed_error(self):
+        self.opener.open(
+            RequestComparator(TEST_URL + '/find/host?stream=1',
+                              {'name': {'type': 'eq', 'value': 'obz'}})
+            ).AndReturn(StreamedResponse(
+                '{"ok": true, "result": [{"name": "obz"}], '
+                '"ok": false, "error": "errmsg"}'))
+        self.mox.ReplayAll()
+
+        conn = self._connect()
+        result = conn.find('host', {'name': {'type': 'eq', 'value': 'obz'}},
+                           stream=True)
+        self.assertEquals({'name': 'obz'}, result.next())
+        self.assertRaises(exceptions.RpcError, result.next)
+
+    def test_bulk(self):
+        ops = [{'op': 'update', 'entity': 'user', 'name': 'testuser',
+                'data': {'last_login': datetime(2006, 1, 1)}},
+               {'op': 'delete', 'entity': 'host', 'name': 'obz'}]
+        self._mock_request(
+            '/bulk',
+            [{'op': 'update', 'entity': 'user', 'name': 'testuser',
+              'data': {'last_login': '2006-01-01T00:00:00'}},
+             {'op': 'delete', 'entity': 'host', 'name': 'obz'}],
+            [True, True])
+
+        self.mox.ReplayAll()
+
+        conn = self._connect()
+        self.assertEquals([True, True], conn.bulk(ops))
+
+    def test_bulk_unknown_entity(self):
+        self.mox.ReplayAll()
+
+        conn = self._connect()
+        self.assertRaises(exceptions.NotFound,
+                          conn.bulk, [{'op': 'delete', 'entity': 'noent',
+                                       'name': 'obz'}])
+
     def test_app_error(self):
         self.opener.open(
             mox.IsA(urllib2.Request)).AndReturn(ErrorResponse())
@@ -275,3 +447,43 @@ class ConnectionTest(TestBase):
         conn = self._connect()
         self.assertRaises(exceptions.RpcError,
                           conn.get, 'host', 'obz')
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, connection.GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipTest(TestBase):
+
+    def test_gzip_reader(self):
+        data = json.dumps({'ok': True, 'result': range(1000)})
+        fd = StringIO.StringIO(gzip_compress(data))
+        reader = connection.GzipReader(fd.read, chunk_size=16)
+        self.assertEquals(data[:10], reader.read(10))
+        self.assertEquals(data[10:], reader.read())
+        self.assertEquals('', reader.read())
+
+    def test_gzip_reader_streamed_results(self):
+        data = '{"ok": true, "result": [%s]}' % ', '.join(
+            json.dumps({'name': 'obj%d' % i}) for i in xrange(100))
+        fd = StringIO.StringIO(gzip_compress(data))
+        reader = connection.GzipReader(fd.read, chunk_size=16)
+        results = list(connection.iter_json_results(reader, chunk_size=32))
+        self.assertEquals(100, len(results))
+        self.assertEquals({'name': 'obj99'}, results[-1])
+
+
+class IterJsonResultsTest(TestBase):
+
+    def test_iter_json_results_small_chunks(self):
+        data = StringIO.StringIO(
+            '{"ok": true, "result": [{"a": "x, y"}, 1, [2, 3]]}')
+        self.assertEquals(
+            [{'a': 'x, y'}, 1, [2, 3]],
+            list(connection.iter_json_results(data, chunk_size=3)))
+
+    def test_iter_json_results_not_streamed(self):
+        data = StringIO.StringIO(json.dumps({'ok': True, 'result': [1, 2]}))
+        self.assertEquals([1, 2],
+                          list(connection.iter_json_results(data)))
@@ -0,0 +1,15 @@
+from configdb.db.interface import caching_interface
+from configdb.db.interface import inmemory_interface
+from configdb.tests import *
+from configdb.tests.db_api_test_base import DbApiTestBase
+
+
+class DbApiCachingTest(DbApiTestBase, TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        DbApiTestBase.setUp(self)
+
+    def init_db(self):
+        return caching_interface.CachingDbInterface(
+            inmemory_interface.InMemoryDbInterface(self.get_schema()))
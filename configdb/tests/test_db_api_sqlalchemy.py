@@ -1,3 +1,4 @@
+from configdb import exceptions
 from configdb.db.interface import sa_interface
 from configdb.tests import *
 from configdb.tests.db_api_test_base import DbApiTestBase
@@ -12,3 +13,14 @@ class DbApiSqlAlchemyTest(DbApiTestBase, TestBase):
     def init_db(self):
         dburi = 'sqlite:///:memory:'
         return sa_interface.SqlAlchemyDbInterface(dburi, self.get_schema())
+
+    def test_wait_for_changes(self):
+        # In-memory SQLite databases can't be shared between threads.
+        self.assertEquals(([], 0), self.api.wait_for_changes(
+                0, self.ctx, timeout=0.01))
+
+    def test_create_with_missing_relation(self):
+        host_data = {'name': 'utz', 'ip': '2.3.4.5',
+                     'roles': ['role1', 'blah']}
+        self.assertRaises(exceptions.RelationError,
+                          self.api.create, 'host', host_data, self.ctx)
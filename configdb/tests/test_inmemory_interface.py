@@ -0,0 +1,106 @@
+import json
+from configdb.db import schema
+from configdb.db.interface import inmemory_interface
+from configdb.tests import *
+from configdb.tests.db_interface_test_base import DbInterfaceTestBase
+
+
+INDEXED_SCHEMA = json.dumps({
+    'host': {
+        'name': {'type': 'string'},
+        'ip': {'type': 'string', 'index': True},
+        'location': {'type': 'string'},
+        'roles': {'type': 'relation', 'rel': 'role'},
+    },
+    'role': {
+        'name': {'type': 'string'},
+    },
+})
+
+
+class TestInMemoryInterface(DbInterfaceTestBase, TestBase):
+
+    def init_db(self):
+        return inmemory_interface.InMemoryDbInterface(self.get_schema())
+
+
+class TestInMemoryIndexes(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.db = inmemory_interface.InMemoryDbInterface(
+            schema.Schema(INDEXED_SCHEMA))
+        with self.db.session() as s:
+            self.db.create('role', {'name': 'role1'}, s)
+            self.db.create('role', {'name': 'role2'}, s)
+            self.db.create('host', {'name': 'obz', 'ip': '1.2.3.4',
+                                    'location': 'here',
+                                    'roles': ['role1']}, s)
+            h = self.db.create('host', {'name': 'oba', 'ip': '1.2.3.4',
+                                        'location': 'there'}, s)
+            # Relations modified in-place are indexed at commit time.
+            h.roles.append(self.db.get_by_name('role', 'role1', s))
+
+    def _find(self, raw_query, **kw):
+        query = dict((k, self.db.parse_query_spec(v))
+                     for k, v in raw_query.iteritems())
+        with self.db.session() as s:
+            return [x.name for x in self.db.find('host', query, s, **kw)]
+
+    def _eq(self, value):
+        return {'type': 'eq', 'value': value}
+
+    def test_lookup_uses_most_selective_index(self):
+        self.assertEquals(
+            ['obz'], self.db._index_lookup('host', {
+                'ip': self.db.parse_query_spec(self._eq('1.2.3.4')),
+                'name': self.db.parse_query_spec(self._eq('obz'))}))
+        self.assertEquals(None, self.db._index_lookup('host', {
+            'location': self.db.parse_query_spec(self._eq('here'))}))
+        self.assertEquals(None, self.db._index_lookup('host', {
+            'ip': self.db.parse_query_spec(
+                {'type': 'substring', 'value': '1.2'})}))
+
+    def test_find_with_indexes(self):
+        self.assertEquals(['oba', 'obz'],
+                          sorted(self._find({'ip': self._eq('1.2.3.4')})))
+        self.assertEquals(['oba', 'obz'],
+                          sorted(self._find({'roles': self._eq('role1')})))
+        self.assertEquals(['obz'], self._find({'ip': self._eq('1.2.3.4'),
+                                               'location': self._eq('here')}))
+        self.assertEquals([], self._find({'ip': self._eq('2.3.4.5')}))
+        self.assertEquals([], self._find({'ip': self._eq(['unhashable'])}))
+
+    def test_find_paginated_with_indexes(self):
+        self.assertEquals(['oba'], self._find({'ip': self._eq('1.2.3.4')},
+                                              limit=1))
+        self.assertEquals(['obz'], self._find({'ip': self._eq('1.2.3.4')},
+                                              limit=1, after='oba'))
+
+    def test_indexes_follow_updates(self):
+        with self.db.session() as s:
+            h = self.db.get_by_name('host', 'obz', s)
+            h.ip = '2.3.4.5'
+            h.roles.remove(self.db.get_by_name('role', 'role1', s))
+            h.roles.append(self.db.get_by_name('role', 'role2', s))
+            s.add(h)
+        self.assertEquals(['oba'], self._find({'ip': self._eq('1.2.3.4')}))
+        self.assertEquals(['obz'], self._find({'ip': self._eq('2.3.4.5')}))
+        self.assertEquals(['oba'], self._find({'roles': self._eq('role1')}))
+        self.assertEquals(['obz'], self._find({'roles': self._eq('role2')}))
+
+    def test_indexes_follow_deletes(self):
+        with self.db.session() as s:
+            self.db.delete('host', 'obz', s)
+        self.assertEquals(['oba'], self._find({'ip': self._eq('1.2.3.4')}))
+        with self.db.session() as s:
+            self.db.delete('host', 'oba', s)
+        self.assertEquals([], self._find({'roles': self._eq('role1')}))
+        self.assertEquals({}, dict(self.db._indexes[('host', 'ip')]))
+
+    def test_create_replaces_index_entries(self):
+        with self.db.session() as s:
+            self.db.create('host', {'name': 'obz', 'ip': '2.3.4.5'}, s)
+        self.assertEquals(['oba'], self._find({'ip': self._eq('1.2.3.4')}))
+        self.assertEquals(['obz'], self._find({'ip': self._eq('2.3.4.5')}))
+        self.assertEquals(['oba'], self._find({'roles': self._eq('role1')}))
@@ -15,3 +15,22 @@ class TestLevelDbInterface(DbInterfaceTestBase, TestBase):
         dburi = os.path.join(self._tmpdir, 'db')
         return leveldb_interface.LevelDbInterface(dburi, self.get_schema())
 
+
+    def test_changes_sequence_survives_reopen(self):
+        def _add_changes():
+            db = self.init_db()
+            with db.session() as s:
+                db.add_change('host', 'obz', 'create', s)
+                db.add_change('host', 'oba', 'create', s)
+            db.close()
+        # Release the database lock.
+        _add_changes()
+
+        db = self.init_db()
+        with db.session() as s:
+            db.add_change('host', 'obz', 'delete', s)
+        with db.session() as s:
+            changes = db.get_changes(1, None, None, s)
+        self.assertEquals([(2, 'oba', 'create'), (3, 'obz', 'delete')],
+                          [(x['seq'], x['name'], x['op']) for x in changes])
+        db.close()
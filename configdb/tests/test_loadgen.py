@@ -0,0 +1,84 @@
+import random
+from configdb.tests import *
+from configdb.client import loadgen
+
+
+class FakeConnection(object):
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def __getattr__(self, name):
+        def _call(*args):
+            if 'missing' in repr(args):
+                raise Exception('not found')
+            self.calls.append((name,) + args)
+        return _call
+
+
+class LoadgenTest(TestBase):
+
+    def test_parse_mix(self):
+        self.assertEquals({'get': 3, 'update': 1},
+                          loadgen.parse_mix('get=3,update=1'))
+        for bad in ('get', 'get=x', 'create=1', 'get=0', 'get=-1'):
+            self.assertRaises(ValueError, loadgen.parse_mix, bad)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(50, loadgen.percentile(values, 50))
+        self.assertEquals(95, loadgen.percentile(values, 95))
+        self.assertEquals(99, loadgen.percentile(values, 99))
+        self.assertEquals(7, loadgen.percentile([7], 99))
+        self.assertEquals(None, loadgen.percentile([], 50))
+
+    def test_choose_op(self):
+        workload = loadgen.Workload(self.get_schema(),
+                                    {'get': 1, 'update': 0}, [])
+        rng = random.Random(1)
+        self.assertEquals(set(['get']),
+                          set(workload.choose_op(rng) for i in xrange(100)))
+
+    def test_run(self):
+        calls = []
+        workload = loadgen.Workload(
+            self.get_schema(), {'get': 1, 'find': 1, 'update': 1},
+            [('host', 'obz'), ('host', 'missing')], 'ip')
+        stats, elapsed = loadgen.run(
+            workload, lambda: FakeConnection(calls), concurrency=2,
+            duration=0.2, rate=100, seed=1)
+        summary = stats.summary(elapsed)
+        self.assertEquals(set(['get', 'find', 'update']), set(summary))
+        total = sum(r['count'] + r['errors'] for r in summary.itervalues())
+        self.assertEquals(len(calls), sum(r['count']
+                                          for r in summary.itervalues()))
+        # The rate limit allows about 20 requests.
+        self.assertTrue(10 <= total <= 25, total)
+        self.assertTrue(sum(r['errors'] for r in summary.itervalues()) > 0)
+        for call in calls:
+            self.assertEquals('host', call[1])
+            self.assertTrue('obz' in repr(call), call)
+
+    def test_replay(self):
+        audit_log = [
+            {'entity': 'host', 'object': 'h1', 'op': 'create',
+             'data': '{"name": "h1", "ip": "1.2.3.4"}'},
+            {'entity': 'host', 'object': 'h1', 'op': 'update',
+             'data': {'ip': '2.3.4.5'}},
+            {'entity': 'host', 'object': 'h1', 'op': 'delete', 'data': None},
+            {'entity': 'host', 'object': 'h1', 'op': 'login'},
+            ]
+        calls = []
+        conn = FakeConnection(calls)
+        workload = loadgen.ReplayWorkload(self.get_schema(), {'update': 1},
+                                          audit_log)
+        self.assertEquals([('host', 'h1')], workload.targets)
+        rng = random.Random(1)
+        for i in xrange(4):
+            workload.run_op('update', conn, rng)
+        self.assertEquals(
+            [('create', 'host', {'name': 'h1', 'ip': '1.2.3.4'}),
+             ('update', 'host', 'h1', {'ip': '2.3.4.5'}),
+             ('delete', 'host', 'h1'),
+             ('create', 'host', {'name': 'h1', 'ip': '1.2.3.4'})],
+            calls)
@@ -0,0 +1,151 @@
+import json
+import os
+import shutil
+import tempfile
+from configdb.tests import *
+from configdb.db.interface import inmemory_interface
+from configdb.db.interface import instrumented_interface
+from configdb.server import metrics
+
+
+class MetricsTest(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        TestBase.tearDown(self)
+
+    def test_render(self):
+        m = metrics.Metrics(buckets=(0.1, 1))
+        m.inc('configdb_requests_total', {'route': 'find'})
+        m.inc('configdb_requests_total', {'route': 'find'})
+        m.observe('configdb_request_duration_seconds', 0.5,
+                  {'route': 'find'})
+        m.observe('configdb_request_duration_seconds', 2,
+                  {'route': 'find'})
+        out = m.render().splitlines()
+        self.assertTrue('# TYPE configdb_requests_total counter' in out)
+        self.assertTrue('configdb_requests_total{route="find"} 2' in out)
+        self.assertTrue(
+            '# TYPE configdb_request_duration_seconds histogram' in out)
+        for line in [
+            'configdb_request_duration_seconds_bucket{route="find",le="0.1"} 0',
+            'configdb_request_duration_seconds_bucket{route="find",le="1"} 1',
+            'configdb_request_duration_seconds_bucket{route="find",le="+Inf"} 2',
+            'configdb_request_duration_seconds_sum{route="find"} 2.5',
+            'configdb_request_duration_seconds_count{route="find"} 2']:
+            self.assertTrue(line in out, line)
+
+    def test_label_escaping(self):
+        m = metrics.Metrics()
+        m.inc('test', {'label': 'a"b\\c'})
+        self.assertTrue('test{label="a\\"b\\\\c"} 1' in m.render())
+
+    def test_aggregate_processes(self):
+        m = metrics.Metrics(self.tmpdir, buckets=(1,))
+        m.inc('configdb_requests_total', {'route': 'get'}, 3)
+        m.observe('configdb_request_duration_seconds', 0.5, {'route': 'get'})
+        m.flush()
+        # Pretend the file was written by another process.
+        os.rename(m._filename(), m._filename(1))
+
+        m2 = metrics.Metrics(self.tmpdir, buckets=(1,))
+        m2.inc('configdb_requests_total', {'route': 'get'}, 2)
+        m2.observe('configdb_request_duration_seconds', 2, {'route': 'get'})
+        out = m2.render().splitlines()
+        self.assertTrue('configdb_requests_total{route="get"} 5' in out)
+        self.assertTrue(
+            'configdb_request_duration_seconds_bucket{route="get",le="1"} 1'
+            in out)
+        self.assertTrue(
+            'configdb_request_duration_seconds_count{route="get"} 2' in out)
+
+
+    def _dead_pid(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        return pid
+
+    def _requests(self, m):
+        for line in m.render().splitlines():
+            if line.startswith('configdb_requests_total{route="get"}'):
+                return int(line.split()[1])
+
+    def test_close_retires_metrics(self):
+        m = metrics.Metrics(self.tmpdir)
+        m.inc('configdb_requests_total', {'route': 'get'}, 3)
+        m.flush()
+        m.close()
+        self.assertFalse(os.path.exists(m._filename()))
+        # Closed processes don't write their file anymore.
+        m.flush()
+        self.assertFalse(os.path.exists(m._filename()))
+        self.assertEquals(3, self._requests(m))
+
+        m2 = metrics.Metrics(self.tmpdir)
+        m2.inc('configdb_requests_total', {'route': 'get'}, 2)
+        self.assertEquals(5, self._requests(m2))
+        m2.close()
+        self.assertEquals(5, self._requests(metrics.Metrics(self.tmpdir)))
+        self.assertEquals(
+            ['metrics-retired.json', 'metrics-retired.lock'],
+            sorted(os.listdir(self.tmpdir)))
+
+    def test_dead_processes_are_retired(self):
+        m = metrics.Metrics(self.tmpdir)
+        m.inc('configdb_requests_total', {'route': 'get'}, 3)
+        m.flush()
+        dead_filename = m._filename(self._dead_pid())
+        os.rename(m._filename(), dead_filename)
+        with open(dead_filename) as fd:
+            data = fd.read()
+
+        m2 = metrics.Metrics(self.tmpdir)
+        self.assertEquals(3, self._requests(m2))
+        self.assertFalse(os.path.exists(dead_filename))
+        self.assertEquals(3, self._requests(m2))
+
+        # A file that could not be removed is not counted again.
+        with open(dead_filename, 'w') as fd:
+            fd.write(data)
+        self.assertEquals(3, self._requests(m2))
+        self.assertFalse(os.path.exists(dead_filename))
+
+    def test_files_are_unique_per_process_start(self):
+        m = metrics.Metrics(self.tmpdir)
+        m2 = metrics.Metrics(self.tmpdir)
+        m2._start = m._start + 1
+        m.inc('configdb_requests_total', {'route': 'get'}, 3)
+        m.flush()
+        m2.flush()
+        self.assertEquals(3, self._requests(m2))
+
+
+class InstrumentedDbInterfaceTest(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.calls = []
+        self.db = instrumented_interface.InstrumentedDbInterface(
+            inmemory_interface.InMemoryDbInterface(self.get_schema()),
+            lambda method, duration: self.calls.append(method))
+        with self.db.session() as s:
+            self.db.create('host', {'name': 'obz', 'ip': '1.2.3.4'}, s)
+
+    def test_calls_are_observed(self):
+        self.assertEquals(['create', 'commit'], self.calls)
+        with self.db.session() as s:
+            self.assertEquals('obz', self.db.get_by_name('host', 'obz', s).name)
+            results = self.db.find('host', {}, s)
+            self.assertEquals(['obz'], [x.name for x in results])
+        self.assertEquals(['create', 'commit', 'get_by_name', 'find', 'commit'],
+                          self.calls)
+
+    def test_other_attributes_are_passed_through(self):
+        self.assertEquals(self.db.db.parse_query_spec,
+                          self.db.parse_query_spec)
@@ -0,0 +1,147 @@
+import httplib
+import json
+import os
+import signal
+import socket
+import threading
+import time
+from configdb.tests import *
+from configdb.db.interface import sa_interface
+from configdb.server import prefork
+
+
+def pid_app(environ, start_response):
+    body = str(os.getpid())
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ThreadPoolWSGIServerTest(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+
+    def tearDown(self):
+        self.sock.close()
+        TestBase.tearDown(self)
+
+    def test_keepalive(self):
+        server = prefork.ThreadPoolWSGIServer(
+            '127.0.0.1', pid_app, self.sock.fileno(), threads=2, keepalive=5)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', self.port)
+            for i in xrange(3):
+                conn.request('GET', '/')
+                resp = conn.getresponse()
+                self.assertEquals(200, resp.status)
+                self.assertEquals(str(os.getpid()), resp.read())
+                self.assertEquals(11, resp.version)
+            conn.close()
+        finally:
+            server.shutdown()
+            thread.join()
+
+
+class PreforkServerTest(TestBase):
+
+    def _get(self, port):
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/')
+        return int(conn.getresponse().read())
+
+    def _wait_for_server(self, port):
+        deadline = time.time() + 10
+        while True:
+            try:
+                return self._get(port)
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def test_serve_and_reload(self):
+        port = _free_port()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                prefork.PreforkServer(lambda: pid_app, port=port,
+                                      workers=1, threads=2,
+                                      keepalive=0).serve()
+            finally:
+                os._exit(0)
+
+        try:
+            worker_pid = self._wait_for_server(port)
+            self.assertNotEquals(pid, worker_pid)
+            self.assertNotEquals(os.getpid(), worker_pid)
+
+            # Reloading replaces the workers.
+            os.kill(pid, signal.SIGHUP)
+            deadline = time.time() + 10
+            while self._get(port) == worker_pid:
+                self.assertTrue(time.time() < deadline)
+                time.sleep(0.1)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            unused, status = os.waitpid(pid, 0)
+        self.assertEquals(0, status)
+
+    def test_worker_writes_pending_timestamps_on_exit(self):
+        port = _free_port()
+        db_uri = 'sqlite:///' + os.path.join(self._tmpdir, 'db')
+        config = {
+            'SCHEMA_FILE': os.path.join(os.path.dirname(__file__),
+                                        'schema-simple.json'),
+            'DB_URI': db_uri,
+            'AUTH_BYPASS': True,
+            'SECRET_KEY': 'test key',
+            'TIMESTAMP_FLUSH_INTERVAL': 3600,
+        }
+        pid = os.fork()
+        if pid == 0:
+            try:
+                prefork.PreforkServer(lambda: wsgiapp.make_app(config),
+                                      port=port, workers=1, threads=2,
+                                      keepalive=0).serve()
+            finally:
+                os._exit(0)
+
+        try:
+            deadline = time.time() + 10
+            while True:
+                try:
+                    conn = httplib.HTTPConnection('127.0.0.1', port,
+                                                  timeout=5)
+                    conn.request('POST', '/create/role',
+                                 json.dumps({'name': 'role1'}),
+                                 {'Content-Type': 'application/json'})
+                    break
+                except socket.error:
+                    self.assertTrue(time.time() < deadline)
+                    time.sleep(0.1)
+            self.assertTrue(json.loads(conn.getresponse().read())['ok'])
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            unused, status = os.waitpid(pid, 0)
+        self.assertEquals(0, status)
+
+        # The timestamp was still pending when the worker was stopped.
+        db = sa_interface.SqlAlchemyDbInterface(db_uri, self.get_schema())
+        with db.session() as s:
+            self.assertTrue(db.get_by_name('__timestamp', 'role', s).ts > 0)
+        db.close()
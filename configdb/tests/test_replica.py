@@ -0,0 +1,156 @@
+import json
+import time
+from configdb.db import acl
+from configdb.db import db_api
+from configdb.db.interface import inmemory_interface
+from configdb.server import replica
+from configdb.tests import *
+
+
+class FakeConnection(object):
+    """Connection to a primary served by a local AdmDbApi."""
+
+    def __init__(self, api):
+        self.api = api
+        self.ctx = acl.AuthContext('admin')
+
+    def find(self, entity_name, query):
+        entity = self.api.schema.get_entity(entity_name)
+        return [entity.from_net(entity.to_net(x))
+                for x in self.api.find(entity_name, query, self.ctx)]
+
+    def get_changes(self, since=0, entity_name=None, wait=0, limit=None):
+        return self.api.get_changes(since, self.ctx, entity_name, limit)
+
+
+class ReplicaTestBase(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.schema = self.get_schema()
+        self.primary = db_api.AdmDbApi(
+            self.schema, inmemory_interface.InMemoryDbInterface(self.schema))
+        self.ctx = acl.AuthContext('admin')
+        self.primary.create('role', {'name': 'role1'}, self.ctx)
+        self.primary.create('host', {'name': 'obz', 'ip': '1.2.3.4',
+                                     'roles': ['role1']}, self.ctx)
+        self.conn = FakeConnection(self.primary)
+
+
+class ReplicaTest(ReplicaTestBase):
+
+    def setUp(self):
+        ReplicaTestBase.setUp(self)
+        self.db = inmemory_interface.InMemoryDbInterface(self.schema)
+        self.replica = replica.Replica(
+            self.conn, self.schema, self.db, 'http://primary/', batch_size=2)
+        self.replica.load_snapshot()
+        self.api = db_api.AdmDbApi(self.schema, self.db)
+
+    def test_load_snapshot(self):
+        host = self.api.get('host', 'obz', self.ctx)
+        self.assertEquals('1.2.3.4', host.ip)
+        self.assertTrue('role1' in host.roles)
+        self.assertEquals(2, self.replica.seq)
+        self.assertTrue(self.api.get_last_modified('host', self.ctx))
+        self.assertTrue(self.replica.staleness() < 5)
+
+    def test_sync(self):
+        self.primary.create('role', {'name': 'role2'}, self.ctx)
+        self.primary.update('host', 'obz', {'ip': '2.3.4.5'}, self.ctx)
+        self.primary.create('role', {'name': 'role3'}, self.ctx)
+        self.primary.delete('role', 'role2', self.ctx)
+
+        # The first sync only gets a batch of changes.
+        self.replica.sync()
+        self.assertEquals(4, self.replica.seq)
+        self.assertEquals('2.3.4.5', self.api.get('host', 'obz', self.ctx).ip)
+        self.replica.sync()
+        self.assertEquals(6, self.replica.seq)
+        self.assertEquals(
+            ['role1', 'role3'],
+            sorted(x.name for x in self.api.find(
+                'role', {'name': {'type': 'regexp', 'pattern': '.*'}},
+                self.ctx)))
+
+    def test_waiting_sync_is_not_stale(self):
+        get_changes = self.conn.get_changes
+
+        def _waiting_get_changes(since=0, entity_name=None, wait=0,
+                                 limit=None):
+            # Nothing changes on the primary while the request waits.
+            time.sleep(wait)
+            return get_changes(since, entity_name, wait, limit)
+        self.conn.get_changes = _waiting_get_changes
+        self.replica.wait = 0.5
+        self.replica.sync()
+        self.assertEquals(2, self.replica.seq)
+        self.assertTrue(self.replica.staleness() < 0.1)
+
+    def test_apply_change_is_idempotent(self):
+        self.primary.delete('host', 'obz', self.ctx)
+        changes, unused = self.conn.get_changes(self.replica.seq)
+        self.replica.apply_change(changes[0])
+        self.replica.apply_change(changes[0])
+        self.assertEquals(
+            [], list(self.api.find(
+                'host', {'name': {'type': 'eq', 'value': 'obz'}}, self.ctx)))
+
+    def test_staleness_unknown_before_snapshot(self):
+        rep = replica.Replica(self.conn, self.schema, self.db, 'http://x')
+        self.assertEquals(None, rep.staleness())
+
+
+class WsgiReplicaTest(ReplicaTestBase, WsgiTestBase):
+
+    def setUp(self):
+        ReplicaTestBase.setUp(self)
+        self.forwarded = []
+        app = self.create_app_with_schema(
+            'schema-simple.json',
+            REPLICA_OF='http://primary/',
+            REPLICA_CONNECTION=self.conn,
+            REPLICA_WAIT=0.1)
+        app.replica.stop()
+
+        def _forward(method, path, data=None, headers=None):
+            self.forwarded.append((method, path, data, headers))
+            return 200, 'application/json', json.dumps(
+                {'ok': True, 'result': 'forwarded'})
+        app.replica.forward = _forward
+        self.wsgiapp = app
+        self.app = app.test_client()
+        self._login()
+
+    def test_reads_are_local(self):
+        rv = self.app.get('/get/host/obz')
+        self.assertEquals('1.2.3.4', self._parse(rv)['ip'])
+        self.assertTrue(replica.STALENESS_HEADER in rv.headers)
+        self.assertEquals([], self.forwarded)
+
+    def test_writes_are_forwarded(self):
+        rv = self.app.post('/update/host/obz',
+                           data=json.dumps({'ip': '2.3.4.5'}),
+                           content_type='application/json')
+        self.assertEquals('forwarded', self._parse(rv))
+        self.assertEquals(1, len(self.forwarded))
+        method, path, data, headers = self.forwarded[0]
+        self.assertEquals('POST', method)
+        self.assertEquals('/update/host/obz', path)
+        self.assertEquals({'ip': '2.3.4.5'}, json.loads(data))
+        self.assertEquals('application/json', headers['Content-Type'])
+        self.assertTrue('Cookie' in headers)
+        # The local copy is only updated by the change feed.
+        rv = self.app.get('/get/host/obz')
+        self.assertEquals('1.2.3.4', self._parse(rv)['ip'])
+
+    def test_changes_are_forwarded(self):
+        self._parse(self.app.get('/changes?since=3'))
+        self.assertEquals('/changes?since=3', self.forwarded[0][1])
+
+    def test_stale_replica_refuses_reads(self):
+        self.wsgiapp.config['REPLICA_MAX_STALENESS'] = 10
+        self._parse(self.app.get('/get/host/obz'))
+        self.wsgiapp.replica.synced_at -= 60
+        rv = self.app.get('/get/host/obz')
+        self.assertEquals(503, rv.status_code)
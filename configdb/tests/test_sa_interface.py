@@ -1,3 +1,4 @@
+import os
 from configdb.db.interface import sa_interface
 from configdb.tests import *
 from configdb.tests.db_interface_test_base import DbInterfaceTestBase
@@ -9,3 +10,40 @@ class TestSaInterface(DbInterfaceTestBase, TestBase):
         dburi = 'sqlite:///:memory:'
         return sa_interface.SqlAlchemyDbInterface(dburi, self.get_schema())
 
+
+    def test_change_sequence_follows_commits(self):
+        db = self.init_db()
+        with db.session() as s:
+            db.add_change('host', 'obz', 'create', s)
+        try:
+            with db.session() as s:
+                db.add_change('host', 'oba', 'create', s)
+                raise Exception('rollback')
+        except Exception:
+            pass
+        # The number allocated by the rolled back transaction is
+        # given out again, leaving no gaps.
+        with db.session() as s:
+            db.add_change('host', 'obz', 'delete', s)
+            changes = db.get_changes(0, None, None, s)
+        self.assertEquals([(1, 'create'), (2, 'delete')],
+                          [(x['seq'], x['op']) for x in changes])
+
+    def test_change_sequence_counter_is_initialized(self):
+        path = os.path.join(self._tmpdir, 'db')
+        db = sa_interface.SqlAlchemyDbInterface(
+            'sqlite:///' + path, self.get_schema())
+        with db.session() as s:
+            db.add_change('host', 'obz', 'create', s)
+            db.add_change('host', 'oba', 'create', s)
+            # Databases created before the counter existed.
+            s.execute(db._objs['changes_seq_table'].delete())
+        db.close()
+
+        db = sa_interface.SqlAlchemyDbInterface(
+            'sqlite:///' + path, self.get_schema())
+        with db.session() as s:
+            db.add_change('host', 'obz', 'delete', s)
+        with db.session() as s:
+            self.assertEquals(3, db.get_changes_seq(s))
+        db.close()
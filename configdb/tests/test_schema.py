@@ -1,3 +1,4 @@
+import json
 from configdb import exceptions
 from configdb.db import acl
 from configdb.db import schema
@@ -113,6 +114,62 @@ class SchemaTest(TestBase):
         self.assertTrue(seq.index("role") < seq.index("host"))
         self.assertTrue(seq.index("ssh_key") < seq.index("user"))
 
+    def test_dependency_levels(self):
+        levels, deferred = self.get_schema().get_dependency_levels()
+        self.assertEquals(
+            [['__timestamp', 'private', 'role', 'ssh_key'], ['host', 'user'],
+             ['project']],
+            levels)
+        self.assertEquals({}, deferred)
+
+    def test_dependency_levels_with_cycles(self):
+        name = {'type': 'string', 'name': 'name'}
+        s = schema.Schema(json.dumps({
+            'user': {'name': name,
+                     'groups': {'type': 'relation', 'rel': 'group'},
+                     'boss': {'type': 'relation', 'rel': 'user'}},
+            'group': {'name': name,
+                      'users': {'type': 'relation', 'rel': 'user'}},
+            'host': {'name': name,
+                     'owners': {'type': 'relation', 'rel': 'user'}},
+            }))
+        levels, deferred = s.get_dependency_levels()
+        self.assertEquals(
+            [['__timestamp', 'group'], ['user'], ['host']], levels)
+        self.assertEquals({'group': ['users'], 'user': ['boss']}, deferred)
+        self.assertEquals(['__timestamp', 'group', 'user', 'host'],
+                          s.get_dependency_sequence())
+
+    def test_dependency_levels_only_break_cycles(self):
+        name = {'type': 'string', 'name': 'name'}
+        s = schema.Schema(json.dumps({
+            # Depends on a cycle, but isn't part of it.
+            'alert': {'name': name,
+                      'host': {'type': 'relation', 'rel': 'host'}},
+            'host': {'name': name,
+                     'cluster': {'type': 'relation', 'rel': 'cluster'}},
+            'cluster': {'name': name,
+                        'hosts': {'type': 'relation', 'rel': 'host'},
+                        'master': {'type': 'relation', 'rel': 'host'},
+                        'site': {'type': 'relation', 'rel': 'site'}},
+            'site': {'name': name},
+            # Two cycles sharing an entity.
+            'a': {'name': name,
+                  'b': {'type': 'relation', 'rel': 'b'},
+                  'c': {'type': 'relation', 'rel': 'c'}},
+            'b': {'name': name,
+                  'a': {'type': 'relation', 'rel': 'a'}},
+            'c': {'name': name,
+                  'a': {'type': 'relation', 'rel': 'a'}},
+            }))
+        levels, deferred = s.get_dependency_levels()
+        self.assertEquals(
+            {'cluster': ['hosts', 'master'], 'a': ['c'], 'b': ['a']},
+            deferred)
+        self.assertEquals(
+            [['__timestamp', 'b', 'site'], ['a', 'cluster'], ['c', 'host'],
+             ['alert']], levels)
+
 
 class FakeRole(object):
 
@@ -190,6 +247,31 @@ class SchemaSerializationTest(TestBase):
              'stamp': '2006-01-01T00:00:00'},
             self.ent.to_net(obj))
 
+    def test_object_serialization_with_fields(self):
+        obj = FakeEnt('a', datetime(2006, 1, 1),
+                      [FakeRole('role1'), FakeRole('role2')])
+        self.assertEquals(
+            {'name': 'a',
+             'stamp': '2006-01-01T00:00:00'},
+            self.ent.to_net(obj, fields=['name', 'stamp']))
+
+    def test_dict_serialization_with_missing_fields(self):
+        self.assertEquals({'name': 'a', 'roles': None, 'stamp': None},
+                          self.ent.to_net({'name': 'a'}))
+        self.assertEquals({'name': 'a'},
+                          self.ent.to_net({'name': 'a'}, ignore_missing=True))
+
+    def test_serialization_of_keyword_fields(self):
+        ent = schema.Schema(
+            '{"ent": {"name": {}, "class": {}, "if": {"type": "datetime"}}}'
+            ).get_entity('ent')
+        obj = FakeRole('a')
+        setattr(obj, 'class', 'c')
+        setattr(obj, 'if', datetime(2006, 1, 1))
+        expected = {'name': 'a', 'class': 'c', 'if': '2006-01-01T00:00:00'}
+        self.assertEquals(expected, ent.to_net(obj))
+        self.assertEquals(expected, ent.to_net(obj.__dict__))
+
     def test_deserialization(self):
         data = {'name': 'a',
                 'roles': ['role1', 'role2'],
@@ -210,12 +292,100 @@ class SchemaSerializationTest(TestBase):
              'stamp': None},
             self.ent.from_net(data))
 
+    def test_deserialization_of_other_timestamp_formats(self):
+        self.assertEquals(
+            {'stamp': datetime(2006, 1, 1, 10, 30)},
+            self.ent.from_net({'stamp': '2006-01-01 10:30'}))
+        self.assertEquals(
+            {'stamp': datetime(2006, 1, 1, 10, 30, 5, 1234)},
+            self.ent.from_net({'stamp': '2006-01-01T10:30:05.001234'}))
+        self.assertEquals(
+            3600, self.ent.from_net(
+                {'stamp': '2006-01-01T10:30:05+01:00'}
+                )['stamp'].utcoffset().seconds)
+
+    def test_deserialize_many(self):
+        data = [{'name': 'a', 'stamp': '2006-01-01T00:00:00'},
+                {'name': 'b', 'stamp': '2006-01-01T00:00:00',
+                 'roles': ['role1']},
+                {'name': 'c', 'stamp': None}]
+        result = self.ent.from_net_many(data)
+        self.assertEquals([self.ent.from_net(x) for x in data], result)
+        self.assertTrue(result[0]['stamp'] is result[1]['stamp'])
+
     def test_deserialization_error(self):
         data = {'stamp': 'not-a-timestamp'}
         self.assertRaises(
             TypeError,
             self.ent.from_net, data)
 
+    def test_unpack(self):
+        data = {'name': 'a',
+                'roles': 'role1',
+                'stamp': '2006-01-01T00:00:00'}
+        self.assertEquals(
+            {'name': 'a',
+             'roles': ['role1'],
+             'stamp': datetime(2006, 1, 1)},
+            self.ent.unpack(data))
+
+    def test_unpack_extra_fields(self):
+        self.assertRaises(
+            exceptions.ValidationError,
+            self.ent.unpack, {'name': 'a', 'unknown': 1})
+
+    def test_unpack_deserialization_error(self):
+        self.assertRaises(
+            exceptions.ValidationError,
+            self.ent.unpack, {'stamp': 'not-a-timestamp'})
+
+    def test_unpack_with_validation_fn(self):
+        self.assertEquals(
+            {'name': ('name', 'a'), 'roles': ('roles', 42)},
+            self.ent.unpack({'name': 'a', 'roles': 42},
+                            lambda field, value: (field.name, value)))
+
+
+class SchemaValidationTest(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        data = """
+{
+"ent": {
+  "name": {
+    "type": "string"
+  },
+  "enabled": {
+    "type": "bool"
+  },
+  "ip": {
+    "type": "string",
+    "validator": "ip"
+  }
+}
+}
+"""
+        self.ent = schema.Schema(data).get_entity('ent')
+
+    def test_unpack_validates_fields(self):
+        self.assertEquals({'name': 'a', 'enabled': True, 'ip': '1.2.3.4'},
+                          self.ent.unpack({'name': 'a', 'enabled': 'yes',
+                                           'ip': '1.2.3.4'}))
+        self.assertEquals({'enabled': False},
+                          self.ent.unpack({'enabled': False}))
+        self.assertEquals({'enabled': None, 'ip': ''},
+                          self.ent.unpack({'enabled': None, 'ip': ''}))
+
+    def test_unpack_validation_errors(self):
+        try:
+            self.ent.unpack({'enabled': 'maybe', 'ip': '1.2.3'})
+        except exceptions.ValidationError, e:
+            self.assertTrue('enabled: ' in str(e))
+            self.assertTrue('ip: ' in str(e))
+        else:
+            self.fail('no ValidationError raised')
+
 
 class SchemaAclTest(TestBase):
 
@@ -325,3 +495,36 @@ class SchemaAclTest(TestBase):
             ent, ['name', 'role'],
             acl.AuthContext('testuser'),
             'w', None)
+
+    def test_acl_decisions_are_memoized(self):
+        data = """
+{
+"ent": {
+  "name": {
+    "type": "string"
+  },
+  "_acl": {
+    "r": "*", "w": "@self"
+  }
+}
+}
+"""
+        sch = schema.Schema(data)
+        ent = sch.get_entity('ent')
+        ctx = acl.AuthContext('testuser')
+        ctx.set_self(FakeRole('testuser'))
+
+        sch.acl_check_entity(ent, ctx, 'w', FakeRole('testuser'))
+        self.assertRaises(
+            exceptions.AclError,
+            sch.acl_check_entity,
+            ent, ctx, 'w', FakeRole('other'))
+        self.assertEquals(2, len(ctx.acl_memo))
+
+        # Decisions that don't depend on the object are shared.
+        sch.acl_check_entity(ent, ctx, 'r', FakeRole('testuser'))
+        sch.acl_check_entity(ent, ctx, 'r', FakeRole('other'))
+        self.assertEquals(3, len(ctx.acl_memo))
+
+        ctx.clear_acl_memo()
+        self.assertEquals({}, ctx.acl_memo)
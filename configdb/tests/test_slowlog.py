@@ -0,0 +1,128 @@
+import logging
+from configdb.tests import *
+from configdb.db import acl
+from configdb.db import db_api
+from configdb.db import slowlog
+from configdb.db.interface import inmemory_interface
+from configdb.db.interface import sa_interface
+
+
+class _RecordHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.slowlog)
+
+
+class SlowLogTestBase(object):
+
+    def setUp(self):
+        self.db = self.init_db()
+        with self.db.session() as s:
+            for name in ('obz', 'utz', 'zap'):
+                self.db.create('host', {'name': unicode(name), 'ip': u'1.2.3.4'}, s)
+        self.api = db_api.AdmDbApi(self.get_schema(), self.db,
+                                   slow_threshold=0)
+        self.ctx = acl.AuthContext('admin', ['admins'])
+        self.handler = _RecordHandler()
+        slowlog.log.addHandler(self.handler)
+
+    def tearDown(self):
+        slowlog.log.removeHandler(self.handler)
+        self.db.close()
+
+    def test_find_is_logged(self):
+        results = list(self.api.find('host', {'name': {'type': 'eq',
+                                                       'value': 'obz'}},
+                                     self.ctx))
+        self.assertEquals(1, len(results))
+        self.assertEquals(1, len(self.handler.records))
+        record = self.handler.records[0]
+        self.assertEquals('find', record['op'])
+        self.assertEquals('host', record['entity'])
+        self.assertEquals({'name': {'type': 'eq', 'value': 'obz'}},
+                          record['query'])
+        self.assertEquals(self.backend, record['backend'])
+        self.assertEquals(1, record['rows_returned'])
+        self.assertTrue(record['round_trips'] > 0)
+        self.assertTrue(record['total_time'] >= 0)
+
+    def test_create_is_logged_once(self):
+        self.api.create('host', {'name': u'new', 'ip': u'2.3.4.5'}, self.ctx)
+        self.assertEquals(['create'],
+                          [r['op'] for r in self.handler.records])
+
+    def test_threshold(self):
+        self.api.slowlog.threshold = 3600
+        self.api.get('host', 'obz', self.ctx)
+        self.assertEquals([], self.handler.records)
+
+
+class SlowLogInMemoryTest(SlowLogTestBase, TestBase):
+
+    backend = 'InMemoryDbInterface'
+
+    def setUp(self):
+        TestBase.setUp(self)
+        SlowLogTestBase.setUp(self)
+
+    def tearDown(self):
+        SlowLogTestBase.tearDown(self)
+        TestBase.tearDown(self)
+
+    def init_db(self):
+        return inmemory_interface.InMemoryDbInterface(self.get_schema())
+
+    def test_find_is_logged(self):
+        # The in-memory backend has no round-trips, and only scans the
+        # rows found with its indexes.
+        list(self.api.find('host', {'name': {'type': 'eq', 'value': 'obz'}},
+                           self.ctx))
+        record = self.handler.records[0]
+        self.assertEquals(0, record['round_trips'])
+        self.assertEquals(1, record['rows_scanned'])
+        self.assertEquals(1, record['rows_returned'])
+
+
+class SlowLogSqlAlchemyTest(SlowLogTestBase, TestBase):
+
+    backend = 'SqlAlchemyDbInterface'
+
+    def setUp(self):
+        TestBase.setUp(self)
+        SlowLogTestBase.setUp(self)
+
+    def tearDown(self):
+        SlowLogTestBase.tearDown(self)
+        TestBase.tearDown(self)
+
+    def init_db(self):
+        return sa_interface.SqlAlchemyDbInterface(
+            'sqlite:///:memory:', self.get_schema())
+
+
+class RoundTripCounterTest(TestBase):
+
+    def test_counts_method_calls(self):
+        class Client(object):
+            value = 42
+
+            def get(self, key):
+                return key
+
+        conn = slowlog.RoundTripCounter(Client())
+        stats = slowlog.OperationStats('get')
+        slowlog._local.stats = stats
+        try:
+            self.assertEquals('a', conn.get('a'))
+            self.assertEquals('b', conn.get('b'))
+            self.assertEquals(42, conn.value)
+        finally:
+            slowlog._local.stats = None
+        self.assertEquals(2, stats.round_trips)
+        # Calls outside of an operation are not counted.
+        conn.get('c')
+        self.assertEquals(2, stats.round_trips)
@@ -0,0 +1,69 @@
+import contextlib
+import time
+from configdb.db import timestamps
+from configdb.tests import *
+
+
+class FakeDb(object):
+
+    def __init__(self):
+        self.timestamps = {}
+        self.fail = False
+
+    @contextlib.contextmanager
+    def session(self):
+        yield 'session'
+
+    def set_timestamp(self, entity_name, ts, session):
+        if self.fail:
+            raise Exception('write failed')
+        self.timestamps[entity_name] = ts
+
+
+class TimestampCoalescerTest(TestBase):
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.db = FakeDb()
+        self.coalescer = timestamps.TimestampCoalescer(self.db, 3600)
+
+    def tearDown(self):
+        self.coalescer.close()
+        TestBase.tearDown(self)
+
+    def test_touch_keeps_highest_timestamp(self):
+        self.coalescer.touch('host', 2)
+        self.coalescer.touch('host', 1)
+        self.coalescer.touch('role', 3)
+        self.assertEquals({'host': 2}, self.coalescer.pending(['host', 'x']))
+        self.assertEquals({}, self.db.timestamps)
+
+        self.coalescer.flush()
+        self.assertEquals({'host': 2, 'role': 3}, self.db.timestamps)
+        self.assertEquals({}, self.coalescer.pending(['host', 'role']))
+
+    def test_failed_flush_is_retried(self):
+        self.coalescer.touch('host', 2)
+        self.db.fail = True
+        self.coalescer.flush()
+        self.assertEquals({'host': 2}, self.coalescer.pending(['host']))
+
+        self.db.fail = False
+        self.coalescer.touch('host', 1)
+        self.coalescer.flush()
+        self.assertEquals({'host': 2}, self.db.timestamps)
+
+    def test_background_flush(self):
+        coalescer = timestamps.TimestampCoalescer(self.db, 0.01)
+        coalescer.touch('host', 1)
+        for i in xrange(100):
+            if self.db.timestamps:
+                break
+            time.sleep(0.01)
+        coalescer.close()
+        self.assertEquals({'host': 1}, self.db.timestamps)
+
+    def test_close_flushes(self):
+        self.coalescer.touch('host', 1)
+        self.coalescer.close()
+        self.assertEquals({'host': 1}, self.db.timestamps)
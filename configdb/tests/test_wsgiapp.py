@@ -1,5 +1,6 @@
 import json
 import os
+import zlib
 from werkzeug.exceptions import Forbidden
 from datetime import datetime
 from configdb.db import acl
@@ -68,6 +69,19 @@ class WsgiTest(WsgiTestBase):
                            'roles': ['role1']},
                           result)
 
+    def test_get_host_with_fields(self):
+        self._login()
+        result = self._parse(self.app.get('/get/host/obz?fields=ip,roles'))
+        self.assertEquals({'name': 'obz',
+                           'ip': '1.2.3.4',
+                           'roles': ['role1']},
+                          result)
+
+    def test_get_host_with_unknown_fields(self):
+        self._login()
+        data = json.loads(self.app.get('/get/host/obz?fields=blah').data)
+        self.assertFalse(data['ok'])
+
     def test_get_user(self):
         # same as above, with more data types
         self._login()
@@ -163,6 +177,220 @@ class WsgiTest(WsgiTestBase):
         self.assertEquals('obz', result[0]['name'])
 
 
+    def test_bulk(self):
+        self._login()
+        ops = [{'op': 'create', 'entity': 'role', 'data': {'name': 'role2'}},
+               {'op': 'update', 'entity': 'host', 'name': 'obz',
+                'data': {'roles': ['role1', 'role2']}}]
+        result = self._parse(
+            self.app.post('/bulk',
+                          data=json.dumps(ops),
+                          content_type='application/json'))
+        self.assertEquals([True, True], result)
+        result = self._parse(self.app.get('/get/host/obz'))
+        self.assertEquals(set(['role1', 'role2']), set(result['roles']))
+
+    def test_bulk_is_atomic(self):
+        self._login()
+        ops = [{'op': 'create', 'entity': 'role', 'data': {'name': 'role2'}},
+               {'op': 'update', 'entity': 'host', 'name': 'obz',
+                'data': {'roles': ['role3']}}]
+        rv = self.app.post('/bulk',
+                           data=json.dumps(ops),
+                           content_type='application/json')
+        self.assertEquals(200, rv.status_code)
+        data = json.loads(rv.data)
+        self.assertFalse(data['ok'])
+        self.assertTrue(data['error'].startswith('operation 1: '))
+
+        data = json.loads(self.app.get('/get/role/role2').data)
+        self.assertFalse(data['ok'])
+
+    def test_get_conditional(self):
+        self._login()
+        rv = self.app.get('/get/host/obz')
+        self.assertEquals(None, rv.headers.get('ETag'))
+
+        self._parse(self.app.post('/update/host/obz',
+                                  data=json.dumps({'ip': '2.3.4.5'}),
+                                  content_type='application/json'))
+        rv = self.app.get('/get/host/obz')
+        self.assertEquals(200, rv.status_code)
+        etag = rv.headers.get('ETag')
+        self.assertTrue(etag)
+        self.assertTrue(rv.headers.get('Last-Modified'))
+
+        rv = self.app.get('/get/host/obz', headers={'If-None-Match': etag})
+        self.assertEquals(304, rv.status_code)
+        self.assertEquals('', rv.data)
+        self.assertEquals(etag, rv.headers.get('ETag'))
+
+        # Different requests have different validators.
+        rv = self.app.get('/get/host/obz?fields=ip',
+                          headers={'If-None-Match': etag})
+        self.assertEquals(200, rv.status_code)
+
+        # Updates to related entities invalidate the ETag.
+        self._parse(self.app.post('/update/role/role1',
+                                  data=json.dumps({'name': 'role1'}),
+                                  content_type='application/json'))
+        rv = self.app.get('/get/host/obz', headers={'If-None-Match': etag})
+        self.assertEquals(200, rv.status_code)
+        self.assertNotEquals(etag, rv.headers.get('ETag'))
+
+    def test_errors_have_no_validators(self):
+        self._login()
+        self._parse(self.app.post('/update/host/obz',
+                                  data=json.dumps({'ip': '2.3.4.5'}),
+                                  content_type='application/json'))
+        rv = self.app.get('/get/host/nonexisting')
+        self.assertFalse(json.loads(rv.data)['ok'])
+        self.assertEquals(None, rv.headers.get('ETag'))
+        self.assertEquals(None, rv.headers.get('Last-Modified'))
+
+        rv = self.app.post('/find/host?stream=1',
+                           data=json.dumps({}),
+                           content_type='application/json')
+        self.assertEquals(None, rv.headers.get('ETag'))
+
+    def test_find_conditional(self):
+        self._login()
+        self._parse(self.app.post('/update/host/obz',
+                                  data=json.dumps({'ip': '2.3.4.5'}),
+                                  content_type='application/json'))
+        query = json.dumps({'name': {'type': 'eq', 'value': 'obz'}})
+        rv = self.app.post('/find/host', data=query,
+                           content_type='application/json')
+        etag = rv.headers.get('ETag')
+        self.assertTrue(etag)
+        rv = self.app.post('/find/host', data=query,
+                           content_type='application/json',
+                           headers={'If-None-Match': etag})
+        self.assertEquals(304, rv.status_code)
+        rv = self.app.post('/find/host', data=json.dumps({}),
+                           content_type='application/json',
+                           headers={'If-None-Match': etag})
+        self.assertEquals(200, rv.status_code)
+
+    def test_gzip_response(self):
+        self._login()
+        self.wsgiapp.config['GZIP_MIN_SIZE'] = 0
+        rv = self.app.post('/find/role',
+                           data=json.dumps({}),
+                           content_type='application/json',
+                           headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals(200, rv.status_code)
+        self.assertEquals('gzip', rv.headers.get('Content-Encoding'))
+        self.assertTrue('Accept-Encoding' in rv.headers.get('Vary'))
+        data = json.loads(zlib.decompress(rv.data, 16 + zlib.MAX_WBITS))
+        self.assertEquals(2, len(data['result']))
+
+    def test_gzip_response_min_size(self):
+        self._login()
+        rv = self.app.get('/get/role/role1',
+                          headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals(None, rv.headers.get('Content-Encoding'))
+        self.assertEquals('role1', self._parse(rv)['name'])
+
+    def test_gzip_streamed_response(self):
+        self._login()
+        rv = self.app.post('/find/role?stream=1',
+                           data=json.dumps({}),
+                           content_type='application/json',
+                           headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals('gzip', rv.headers.get('Content-Encoding'))
+        data = json.loads(zlib.decompress(rv.data, 16 + zlib.MAX_WBITS))
+        self.assertEquals(2, len(data['result']))
+
+    def test_gzip_request(self):
+        self._login()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = (compressor.compress(json.dumps({'ip': '2.3.4.5'}))
+                + compressor.flush())
+        self._parse(self.app.post('/update/host/obz',
+                                  data=body,
+                                  content_type='application/json',
+                                  headers={'Content-Encoding': 'gzip'}))
+        result = self._parse(self.app.get('/get/host/obz'))
+        self.assertEquals('2.3.4.5', result['ip'])
+
+    def test_gzip_request_corrupted(self):
+        self._login()
+        rv = self.app.post('/update/host/obz',
+                           data='not gzip',
+                           content_type='application/json',
+                           headers={'Content-Encoding': 'gzip'})
+        self.assertEquals(400, rv.status_code)
+
+    def test_find_streamed(self):
+        self._login()
+        rv = self.app.post('/find/role?stream=1',
+                           data=json.dumps({}),
+                           content_type='application/json')
+        self.assertEquals(200, rv.status_code)
+        data = json.loads(rv.data)
+        self.assertTrue(data['ok'])
+        self.assertEquals(set([u'a/i black ops', u'role1']),
+                          set(x['name'] for x in data['result']))
+
+    def test_find_ndjson(self):
+        self._login()
+        rv = self.app.post('/find/role',
+                           data=json.dumps({}),
+                           content_type='application/json',
+                           headers={'Accept': 'application/x-ndjson'})
+        self.assertEquals(200, rv.status_code)
+        self.assertEquals('application/x-ndjson', rv.mimetype)
+        lines = rv.data.splitlines()
+        self.assertEquals(set([u'a/i black ops', u'role1']),
+                          set(json.loads(x)['name'] for x in lines))
+
+    def test_find_streamed_error(self):
+        self._login()
+        rv = self.app.post('/find/noent?stream=1',
+                           data=json.dumps({}),
+                           content_type='application/json')
+        self.assertEquals(200, rv.status_code)
+        data = json.loads(rv.data)
+        self.assertFalse(data['ok'])
+
+    def test_find_with_fields(self):
+        self._login()
+        query = {'name': {'type': 'eq', 'value': 'obz'}}
+        result = self._parse(
+            self.app.post('/find/host?fields=ip',
+                          data=json.dumps(query),
+                          content_type='application/json'))
+        self.assertEquals([{'name': 'obz', 'ip': '1.2.3.4'}], result)
+
+    def test_find_paginated(self):
+        self._login()
+        names = []
+        url = '/find/role?limit=1'
+        while True:
+            result = self._parse(
+                self.app.post(url, data=json.dumps({}),
+                              content_type='application/json'))
+            names.extend(x['name'] for x in result['results'])
+            if not result['cursor']:
+                break
+            url = '/find/role?limit=1&cursor=%s' % result['cursor']
+        self.assertEquals([u'a/i black ops', u'role1'], names)
+
+    def test_find_malformed_limit(self):
+        self._login()
+        rv = self.app.post('/find/role?limit=abc', data=json.dumps({}),
+                           content_type='application/json')
+        data = json.loads(rv.data)
+        self.assertFalse(data['ok'])
+        self.assertTrue('limit' in data['error'])
+
+    def test_changes_malformed_args(self):
+        self._login()
+        for args in ('since=x', 'limit=1.5', 'wait=soon'):
+            data = json.loads(self.app.get('/changes?' + args).data)
+            self.assertFalse(data['ok'], args)
+
     def test_delete(self):
         self._login()
         rv = self.app.get('/delete/host/obz')
@@ -190,6 +418,56 @@ class WsgiTest(WsgiTestBase):
         self.assertEquals('create', result[0]['op'])
         self.assertEquals('admin', result[0]['user'])
 
+    def test_changes(self):
+        self._login()
+        result = self._parse(self.app.get('/changes'))
+        self.assertEquals({'changes': [], 'seq': 0}, result)
+
+        self.app.post('/update/host/obz',
+                      data=json.dumps({'ip': '2.3.4.5'}),
+                      content_type='application/json')
+        self.app.post('/create/role',
+                      data=json.dumps({'name': 'role3'}),
+                      content_type='application/json')
+        result = self._parse(self.app.get('/changes?since=0'))
+        self.assertEquals([('host', 'obz', 'update'),
+                           ('role', 'role3', 'create')],
+                          [(x['entity'], x['name'], x['op'])
+                           for x in result['changes']])
+        self.assertEquals(result['changes'][-1]['seq'], result['seq'])
+
+        result = self._parse(self.app.get('/changes?since=0&entity=role'))
+        self.assertEquals(['role3'], [x['name'] for x in result['changes']])
+
+        result = self._parse(self.app.get('/changes?since=%d&wait=0.01' %
+                                          result['seq']))
+        self.assertEquals([], result['changes'])
+
+    def test_get_audit_streamed(self):
+        self._login()
+        result = self._parse(
+            self.app.post('/audit?stream=1',
+                          data=json.dumps({'entity': 'host',
+                                           'object': 'obz'}),
+                          content_type='application/json'))
+        self.assertEquals(1, len(result))
+        self.assertEquals('create', result[0]['op'])
+
+    def test_metrics(self):
+        self._login()
+        self.app.get('/get/host/obz')
+        self.app.get('/get/host/nonexisting')
+        rv = self.app.get('/metrics')
+        self.assertEquals(200, rv.status_code)
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        lines = rv.data.splitlines()
+        self.assertTrue('configdb_requests_total{route="get"} 2' in lines)
+        self.assertTrue(
+            'configdb_errors_total{error="NotFound",route="get"} 1' in lines)
+        self.assertTrue(
+            [x for x in lines
+             if x.startswith('configdb_db_calls_total{method="get_by_name"}')])
+
     def test_get_schema(self):
         self._login()
         rv = self.app.get('/schema')
@@ -215,3 +493,56 @@ class WsgiTest(WsgiTestBase):
         self.assertEquals(
             {'ok': False, 'error': 'Authentication error'}, data)
 
+
+    def _enable_profiling(self, **config):
+        self.wsgiapp.config['AUTH_CONTEXT_FN'] = (
+            lambda api, token: acl.AuthContext(token, ['admins']))
+        self.wsgiapp.config['PROFILE_GROUP'] = 'admins'
+        self.wsgiapp.config.update(config)
+
+    def test_profile(self):
+        self._enable_profiling()
+        self._login()
+        rv = self.app.get('/get/host/obz',
+                          headers={'X-Configdb-Profile': '1'})
+        self.assertEquals(200, rv.status_code)
+        self.assertEquals(None, rv.headers.get('ETag'))
+        data = json.loads(rv.data)
+        self.assertEquals('obz', data['result']['name'])
+        self.assertTrue('cumulative' in data['profile'])
+
+    def test_profile_streamed_find(self):
+        self._enable_profiling()
+        self._login()
+        rv = self.app.post('/find/host?stream=1',
+                           data=json.dumps({'name': {'type': 'eq',
+                                                     'value': 'obz'}}),
+                           content_type='application/json',
+                           headers={'X-Configdb-Profile': '1'})
+        data = json.loads(rv.data)
+        self.assertEquals(['obz'], [x['name'] for x in data['result']])
+        self.assertTrue('profile' in data)
+
+    def test_profile_to_dir(self):
+        self._enable_profiling(PROFILE_DIR=self._tmpdir)
+        self._login()
+        rv = self.app.get('/get/host/obz',
+                          headers={'X-Configdb-Profile': '1'})
+        filename = rv.headers['X-Configdb-Profile-File']
+        self.assertTrue(filename.startswith('get-'))
+        self.assertEquals([filename], os.listdir(self._tmpdir))
+        self.assertFalse('profile' in json.loads(rv.data))
+
+    def test_profile_requires_group(self):
+        self.wsgiapp.config['PROFILE_GROUP'] = 'admins'
+        self._login()
+        rv = self.app.get('/get/host/obz',
+                          headers={'X-Configdb-Profile': '1'})
+        self.assertFalse('profile' in json.loads(rv.data))
+
+    def test_profile_sample_rate(self):
+        self._enable_profiling(PROFILE_SAMPLE_RATE=0)
+        self._login()
+        rv = self.app.get('/get/host/obz',
+                          headers={'X-Configdb-Profile': '1'})
+        self.assertFalse('profile' in json.loads(rv.data))
@@ -1,6 +1,7 @@
 import json
 from werkzeug.exceptions import Forbidden
 from datetime import datetime
+from configdb.benchmarks import main as benchmarks_main
 #from configdb.tests import *
 
 
@@ -8,7 +9,8 @@ class WsgiComplexTestBase(object):
 
     def setUp(self):
         args = self.get_app_args()
-        app = self.create_app_with_schema('schema-large-noacl.json', **args)
+        app = self.create_app(SCHEMA_FILE=benchmarks_main.DEFAULT_SCHEMA_FILE,
+                              **args)
         self.wsgiapp = app
         self.app = app.test_client()
 
@@ -12,12 +12,15 @@ setup(
   install_requires=['argparse', 'Flask', 'formencode', 'inflect',
                     'SQLAlchemy>0.7', 'python-dateutil', 'ipaddr'],
   setup_requires=[],
-  zip_safe=True,
+  zip_safe=False,
   packages=find_packages(),
+  package_data={'configdb.benchmarks': ['*.json']},
   entry_points={
     'console_scripts': [
       'configdb-api-server = configdb.server.wsgiapp:main',
       'configdb-client = configdb.client.cli:main',
+      'configdb-bench = configdb.client.loadgen:main',
+      'configdb-benchmark = configdb.benchmarks.main:main',
     ],
   },
   )